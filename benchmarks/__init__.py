@@ -0,0 +1 @@
+"""Benchmarks of *fMRIPrep-rodents* (see ``python -m benchmarks --help``)."""
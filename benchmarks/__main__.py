@@ -0,0 +1,160 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Run the benchmarks of *fMRIPrep-rodents*, or compare two sets of results.
+
+Usage (from the root of the repository)::
+
+    python -m benchmarks run --size rodent -o results.json
+    python -m benchmarks compare baseline.json results.json
+
+Each benchmark runs in a fresh interpreter, so that imports and the memory
+used by other benchmarks do not bias its measurements: the callable under test
+is first run once to measure the peak of memory (both the increase of the
+resident set size and the peak of memory allocated from Python, including
+NumPy arrays), and then timed ``--repeat`` times.
+
+"""
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+def run(opts):
+    """Run the selected benchmarks and write their results."""
+    import multiprocessing as mp
+    import numpy as np
+    import nibabel as nb
+    import pandas as pd
+    import fprodents
+    from .data import SIZES
+    from .suite import BENCHMARKS, measure, prepare
+
+    shape = tuple(opts.shape or SIZES[opts.size])
+    data_dir = opts.data_dir or Path(tempfile.gettempdir()) / "fprodents-benchmarks"
+    names = [n for n in BENCHMARKS if not opts.k or any(k in n for k in opts.k)]
+
+    print(f"Generating inputs of shape {shape} in <{data_dir}>.", file=sys.stderr)
+    prepare(data_dir, shape)
+
+    ctx = mp.get_context("spawn")
+    results = []
+    for name in names:
+        queue = ctx.Queue()
+        proc = ctx.Process(
+            target=measure, args=(name, shape, str(data_dir), opts.repeat, queue)
+        )
+        proc.start()
+        proc.join()
+        result = queue.get() if proc.exitcode == 0 else None
+        if result is None:
+            print(f"{name}: FAILED (exit code {proc.exitcode})", file=sys.stderr)
+            result = {"error": proc.exitcode}
+        else:
+            print(
+                f"{name}: {result['min']:.3f} s (min of {opts.repeat}), "
+                f"{result['peak_traced_mb']:.1f} MB allocated, "
+                f"+{result['peak_rss_increase_mb']:.1f} MB RSS",
+                file=sys.stderr,
+            )
+        results.append({"name": name, "shape": list(shape), **result})
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "fprodents": fprodents.__version__,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "nibabel": nb.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "repeat": opts.repeat,
+        "results": results,
+    }
+    opts.output.write_text(json.dumps(report, indent=2) + "\n")
+    print(f"Results written to <{opts.output}>.", file=sys.stderr)
+    return 0
+
+
+def compare(opts):
+    """Compare two sets of results, failing if any benchmark regressed."""
+    base, new = (json.loads(Path(f).read_text()) for f in (opts.base, opts.new))
+    base_results = {(r["name"], tuple(r["shape"])): r for r in base["results"]}
+
+    regressions = 0
+    print(f"{'benchmark':<24}{'time':>10}{'memory':>10}")
+    for result in new["results"]:
+        previous = base_results.get((result["name"], tuple(result["shape"])))
+        if previous is None or "error" in previous or "error" in result:
+            continue
+        ratios = (
+            result["min"] / previous["min"],
+            (result["peak_traced_mb"] + 1) / (previous["peak_traced_mb"] + 1),
+        )
+        flag = " *" if max(ratios) > opts.threshold else ""
+        regressions += bool(flag)
+        print(f"{result['name']:<24}{ratios[0]:>9.2f}x{ratios[1]:>9.2f}x{flag}")
+    return int(regressions > 0)
+
+
+def get_parser():
+    """Build the parser of the benchmarks' command line."""
+    from argparse import ArgumentParser, RawTextHelpFormatter
+    from .data import SIZES
+
+    parser = ArgumentParser(
+        prog="python -m benchmarks",
+        description=__doc__,
+        formatter_class=RawTextHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument(
+        "--size", choices=sorted(SIZES), default="rodent", help="problem size"
+    )
+    run_parser.add_argument(
+        "--shape",
+        type=int,
+        nargs=4,
+        metavar=("X", "Y", "Z", "T"),
+        help="shape of the BOLD series (overrides --size)",
+    )
+    run_parser.add_argument(
+        "--repeat", type=int, default=3, help="number of timed runs of each benchmark"
+    )
+    run_parser.add_argument(
+        "-k", action="append", help="only run benchmarks whose name contains this"
+    )
+    run_parser.add_argument(
+        "--data-dir", type=Path, help="directory where synthetic inputs are cached"
+    )
+    run_parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        default=Path("benchmarks.json"),
+        help="file where results are written",
+    )
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("base", type=Path, help="results of the baseline")
+    compare_parser.add_argument("new", type=Path, help="results to compare")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="ratio (new / baseline) of time or memory flagged as a regression",
+    )
+    compare_parser.set_defaults(func=compare)
+    return parser
+
+
+if __name__ == "__main__":
+    opts = get_parser().parse_args()
+    sys.exit(opts.func(opts))
@@ -0,0 +1,148 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Generators of synthetic inputs, mimicking those found within a working directory."""
+from pathlib import Path
+
+import numpy as np
+import nibabel as nb
+import pandas as pd
+
+#: Problem sizes, as the shape of the BOLD series (X, Y, Z, T).
+SIZES = {
+    "small": (32, 32, 16, 100),
+    "rodent": (96, 96, 40, 2000),
+}
+#: Voxel sizes (mm) of the synthetic BOLD series.
+ZOOMS = (0.3, 0.3, 0.5)
+
+
+def _rng(seed=0):
+    return np.random.default_rng(seed)
+
+
+def _affine():
+    return np.diag(ZOOMS + (1.0,))
+
+
+def make_bold(filename, shape, dtype="int16", seed=0, chunk_size=100):
+    """Write a BOLD series of noise around a constant baseline, a chunk of volumes at a time."""
+    from fprodents.utils.images import SeriesWriter
+
+    rng = _rng(seed)
+    header = nb.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_xyzt_units("mm", "sec")
+    header.set_zooms(ZOOMS + (1.0,))
+    with SeriesWriter(filename, shape, _affine(), header=header, dtype=dtype) as writer:
+        for start in range(0, shape[3], chunk_size):
+            nvols = min(chunk_size, shape[3] - start)
+            writer.write(
+                1000 + 20 * rng.standard_normal(shape[:3] + (nvols,), dtype="float32")
+            )
+    return str(filename)
+
+
+def make_mask(filename, shape):
+    """Write a binary mask of an ellipsoid filling the field of view."""
+    grid = np.indices(shape[:3], dtype="float32")
+    center = (np.array(shape[:3], dtype="float32") - 1) / 2
+    dist = sum(((g - c) / c) ** 2 for g, c in zip(grid, center))
+    nb.Nifti1Image((dist < 0.8).astype("uint8"), _affine()).to_filename(str(filename))
+    return str(filename)
+
+
+def make_roi(filename, shape, fraction=0.2, seed=0):
+    """Write a binary ROI covering ``fraction`` of the voxels at random."""
+    roi = (_rng(seed).random(shape[:3]) < fraction).astype("uint8")
+    nb.Nifti1Image(roi, _affine()).to_filename(str(filename))
+    return str(filename)
+
+
+def make_tsv(filename, nvols, columns, seed=0):
+    """Write a confounds file with one row per volume."""
+    rng = _rng(seed)
+    data = pd.DataFrame(
+        rng.standard_normal((nvols, len(columns))), columns=list(columns)
+    )
+    data.to_csv(str(filename), sep="\t", index=False, na_rep="n/a")
+    return str(filename)
+
+
+def make_confounds(out_dir, nvols, n_acompcor=50, n_tcompcor=6, n_cosine=20):
+    """Write the confounds files gathered by ``_gather_confounds``."""
+    out_dir = Path(out_dir)
+    motion = [
+        f"{p}{suffix}"
+        for p in ("trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z")
+        for suffix in ("", "_derivative1", "_power2", "_derivative1_power2")
+    ]
+    return {
+        "signals": make_tsv(
+            out_dir / "signals.tsv", nvols, ["global_signal", "csf", "white_matter"]
+        ),
+        "dvars": make_tsv(out_dir / "dvars.tsv", nvols, ["NonStdDVARS"], seed=1),
+        "std_dvars": make_tsv(out_dir / "std_dvars.tsv", nvols, ["StdDVARS"], seed=2),
+        "fdisp": make_tsv(out_dir / "fd.tsv", nvols, ["FramewiseDisplacement"], seed=3),
+        "tcompcor": make_tsv(
+            out_dir / "tcompcor.tsv",
+            nvols,
+            [f"t_comp_cor_{i:02d}" for i in range(n_tcompcor)],
+            seed=4,
+        ),
+        "acompcor": make_tsv(
+            out_dir / "acompcor.tsv",
+            nvols,
+            [f"a_comp_cor_{i:02d}" for i in range(n_acompcor)],
+            seed=5,
+        ),
+        "cos_basis": make_tsv(
+            out_dir / "cosine.tsv",
+            nvols,
+            [f"cosine{i:02d}" for i in range(n_cosine)],
+            seed=6,
+        ),
+        "motion": make_tsv(out_dir / "motion.tsv", nvols, motion, seed=7),
+    }
+
+
+def make_aroma(out_dir, nvols, ncomps=100, nnoise=40, seed=0):
+    """Write the outputs of ICA-AROMA read by ``_get_ica_confounds``."""
+    rng = _rng(seed)
+    out_dir = Path(out_dir)
+    (out_dir / "melodic.ica").mkdir(parents=True, exist_ok=True)
+
+    np.savetxt(
+        out_dir / "melodic.ica" / "melodic_mix",
+        rng.standard_normal((nvols, ncomps)),
+        fmt="%.7e",
+        delimiter="  ",
+    )
+    noise = np.sort(rng.choice(ncomps, nnoise, replace=False)) + 1
+    (out_dir / "classified_motion_ICs.txt").write_text(",".join(map(str, noise)))
+
+    overview = pd.DataFrame(
+        {
+            "IC": np.arange(1, ncomps + 1),
+            "Motion/noise": np.isin(np.arange(1, ncomps + 1), noise),
+            "maximum RP correlation": rng.random(ncomps),
+            "Edge-fraction": rng.random(ncomps),
+            "High-frequency content": rng.random(ncomps),
+            "CSF-fraction": rng.random(ncomps),
+        }
+    )
+    overview.to_csv(out_dir / "classification_overview.txt", sep="\t", index=False)
+
+    variance = np.sort(rng.random(ncomps))[::-1] * 5
+    (out_dir / "melodic.ica" / "melodic_ICstats").write_text(
+        "\n".join(f"{v:.4f}  {v / 2:.4f}" for v in variance) + "\n"
+    )
+    return str(out_dir)
+
+
+def make_volreg(filename, nvols, seed=0):
+    """Write an AFNI 3dVolreg matrix file (one 3x4 affine per row) of small motions."""
+    rng = _rng(seed)
+    rows = np.tile(np.eye(4)[:3].reshape(-1), (nvols, 1))
+    rows += 1e-3 * rng.standard_normal(rows.shape)
+    np.savetxt(str(filename), rows, fmt="%.6f")
+    return str(filename)
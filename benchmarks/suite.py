@@ -0,0 +1,271 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Benchmarks of the functions run in-process by the BOLD workflows.
+
+Each benchmark is a function taking the synthetic inputs (see :py:func:`prepare`)
+and a scratch directory, and returning a callable that runs the function
+under test once.
+
+"""
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from . import data
+
+#: Number of non-steady-state volumes trimmed and re-prepended.
+SKIP_VOLS = 10
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Register a benchmark under the name of the decorated function."""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def prepare(data_dir, shape):
+    """Generate (or reuse, if already generated) the synthetic inputs for ``shape``."""
+    data_dir = Path(data_dir) / "x".join(str(s) for s in shape)
+    manifest = data_dir / "inputs.json"
+    if manifest.exists():
+        return json.loads(manifest.read_text())
+
+    data_dir.mkdir(parents=True, exist_ok=True)
+    nvols = shape[3]
+    inputs = {
+        "bold": data.make_bold(data_dir / "bold.nii", shape),
+        "bold_cut": data.make_bold(
+            data_dir / "bold_cut.nii", shape[:3] + (nvols - SKIP_VOLS,), seed=1
+        ),
+        "mask": data.make_mask(data_dir / "mask.nii", shape),
+        "roi": data.make_roi(data_dir / "roi.nii", shape),
+        "confounds": data.make_confounds(data_dir, nvols),
+        "aroma_dir": data.make_aroma(data_dir / "aroma", nvols),
+        "volreg": data.make_volreg(data_dir / "volreg.aff12.1D", nvols),
+        "join_file": data.make_tsv(
+            data_dir / "join.tsv", nvols, [f"aroma_motion_{i:02d}" for i in range(40)]
+        ),
+    }
+    manifest.write_text(json.dumps(inputs, indent=2))
+    return inputs
+
+
+def _rss_mb():
+    """Current resident set size (MB) of this process."""
+    with open("/proc/self/statm") as fobj:
+        return int(fobj.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def measure(name, shape, data_dir, repeat, queue):
+    """Run one benchmark (in a child process) and put its results on ``queue``."""
+    import resource
+    import tracemalloc
+
+    inputs = prepare(data_dir, shape)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        func = BENCHMARKS[name](inputs, Path(tmpdir))
+
+        # Memory first, as the peak of the resident set size never decreases
+        rss_start = _rss_mb()
+        tracemalloc.start()
+        func()
+        traced_peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+    queue.put(
+        {
+            "times": times,
+            "min": min(times),
+            "median": sorted(times)[len(times) // 2],
+            "peak_traced_mb": round(traced_peak, 2),
+            "peak_rss_increase_mb": round(max(rss_peak - rss_start, 0.0), 2),
+        }
+    )
+
+
+@benchmark
+def gather_confounds(inputs, tmpdir):
+    from fprodents.interfaces.confounds import _gather_confounds
+
+    return lambda: _gather_confounds(newpath=str(tmpdir), **inputs["confounds"])
+
+
+@benchmark
+def get_ica_confounds(inputs, tmpdir):
+    from fprodents.interfaces.confounds import _get_ica_confounds
+
+    return lambda: _get_ica_confounds(inputs["aroma_dir"], SKIP_VOLS, newpath=str(tmpdir))
+
+
+@benchmark
+def volreg2itk(inputs, tmpdir):
+    from fprodents.interfaces.mc import Volreg2ITK
+
+    return lambda: Volreg2ITK(in_file=inputs["volreg"]).run(cwd=str(tmpdir))
+
+
+@benchmark
+def rigid_hmc(inputs, tmpdir):
+    from fprodents.interfaces.mc import RigidHMC
+
+    return lambda: RigidHMC(
+        in_file=inputs["bold"], ref_file=inputs["mask"], itk_text=False
+    ).run(cwd=str(tmpdir))
+
+
+def _hmc_xforms(inputs, tmpdir):
+    """Convert the synthetic head-motion parameters into per-volume affines."""
+    from fprodents.interfaces.mc import Volreg2ITK
+
+    return Volreg2ITK(in_file=inputs["volreg"]).run(cwd=str(tmpdir)).outputs
+
+
+@benchmark
+def resample_native(inputs, tmpdir):
+    from fprodents.interfaces.resampling import ResampleSeries
+
+    xforms = _hmc_xforms(inputs, tmpdir)
+    return lambda: ResampleSeries(
+        in_file=inputs["bold"],
+        ref_file=inputs["mask"],
+        hmc_xforms=xforms.out_stack,
+        interpolation="LanczosWindowedSinc",
+        compress=False,
+        num_threads=4,
+    ).run(cwd=str(tmpdir))
+
+
+@benchmark
+def resample_ants(inputs, tmpdir):
+    """Counterpart of ``resample_native``: ``antsApplyTransforms`` per volume, then merge."""
+    from shutil import which
+    from niworkflows.interfaces.itk import MultiApplyTransforms
+    from fprodents.interfaces.cache import CachedSplit
+    from fprodents.interfaces.resampling import MergeSeries
+
+    if which("antsApplyTransforms") is None:
+        raise RuntimeError("antsApplyTransforms (ANTs) is not installed")
+
+    xforms = _hmc_xforms(inputs, tmpdir)
+    # The series is split upstream (and shared) within the workflows
+    volumes = CachedSplit(in_file=inputs["bold"]).run(cwd=str(tmpdir)).outputs.out_files
+
+    def _run():
+        resampled = MultiApplyTransforms(
+            input_image=volumes,
+            reference_image=inputs["mask"],
+            transforms=[xforms.out_file],
+            interpolation="LanczosWindowedSinc",
+            float=True,
+            copy_dtype=True,
+            num_threads=4,
+        ).run(cwd=str(tmpdir))
+        return MergeSeries(
+            in_files=resampled.outputs.out_files, compress=False, num_threads=4
+        ).run(cwd=str(tmpdir))
+
+    return _run
+
+
+@benchmark
+def slice_timing(inputs, tmpdir):
+    import nibabel as nb
+    from fprodents.interfaces.stc import SliceTimingCorrection
+
+    nslices = nb.load(inputs["bold"]).shape[2]
+    return lambda: SliceTimingCorrection(
+        in_file=inputs["bold"],
+        slice_timing=[i / nslices for i in range(nslices)],
+        repetition_time=1.0,
+        ignore=SKIP_VOLS,
+        compress=False,
+    ).run(cwd=str(tmpdir))
+
+
+@benchmark
+def t2s_fit(inputs, tmpdir):
+    from fprodents.interfaces.multiecho import FitT2SMap
+
+    # The same series stands for the three echoes (only throughput is measured)
+    return lambda: FitT2SMap(
+        in_files=[inputs["bold"]] * 3,
+        echo_times=[0.013, 0.027, 0.043],
+        compress=False,
+    ).run(cwd=str(tmpdir))
+
+
+@benchmark
+def resample_echoes(inputs, tmpdir):
+    from fprodents.interfaces.resampling import ResampleEchoes
+
+    # The same series stands for the three echoes (under different names)
+    echoes = []
+    for echo in range(1, 4):
+        echoes.append(Path(tmpdir) / f"bold_echo-{echo}.nii")
+        if not echoes[-1].exists():
+            echoes[-1].symlink_to(inputs["bold"])
+    return lambda: ResampleEchoes(
+        in_file=[str(echo) for echo in echoes],
+        ref_file=inputs["mask"],
+        compress=False,
+        num_threads=4,
+    ).run(cwd=str(tmpdir))
+
+
+@benchmark
+def head_series(inputs, tmpdir):
+    from fprodents.utils.images import head_series
+
+    return lambda: head_series(inputs["bold"], 40, str(Path(tmpdir) / "window"))
+
+
+@benchmark
+def project_rois(inputs, tmpdir):
+    from fprodents.interfaces.resampling import ProjectROIs
+
+    return lambda: ProjectROIs(
+        in_files=[inputs["roi"]] * 4,
+        reference_image=inputs["mask"],
+        in_mask=inputs["mask"],
+    ).run(cwd=str(tmpdir))
+
+
+@benchmark
+def remove_volumes(inputs, tmpdir):
+    from fprodents.workflows.bold.confounds import _remove_volumes
+
+    return lambda: _remove_volumes(inputs["bold"], SKIP_VOLS)
+
+
+@benchmark
+def add_volumes(inputs, tmpdir):
+    from fprodents.workflows.bold.confounds import _add_volumes
+
+    return lambda: _add_volumes(inputs["bold"], inputs["bold_cut"], SKIP_VOLS)
+
+
+@benchmark
+def to_join(inputs, tmpdir):
+    from fprodents.workflows.bold.base import _to_join
+
+    return lambda: _to_join(inputs["confounds"]["acompcor"], inputs["join_file"])
+
+
+@benchmark
+def carpet_data(inputs, tmpdir):
+    from fprodents.utils.carpet import carpet_data
+
+    return lambda: carpet_data(inputs["bold"], inputs["mask"], inputs["roi"])
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Calibrate the memory estimates of nodes against measured peaks.
+
+Runs executed with ``--resource-monitor`` leave a profile of every node
+(``<work_dir>/fmriprep_wf/resource_monitor.json``) next to the configuration
+of the run (``<work_dir>/config-<run_uuid>.toml``).
+This command reads both from one or more working directories, recalculates the
+features of the memory model for each BOLD series of the runs, and fits the
+coefficients of each interface to the peaks of memory measured for its nodes.
+
+"""
+import json
+from pathlib import Path
+
+
+def get_parser():
+    """Build the parser of the calibration command."""
+    from argparse import ArgumentParser, RawTextHelpFormatter
+
+    parser = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
+    parser.add_argument(
+        "work_dir",
+        nargs="+",
+        type=Path,
+        help="working directories of runs executed with --resource-monitor",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        default=Path("memory_coefficients.json"),
+        help="file where the calibrated coefficients are written",
+    )
+    parser.add_argument(
+        "--base",
+        type=Path,
+        help="coefficients to update (the package's defaults if not set)",
+    )
+    parser.add_argument(
+        "--min-samples",
+        type=int,
+        default=3,
+        help="minimum number of profiled nodes to calibrate an interface",
+    )
+    return parser
+
+
+def read_profile(filename):
+    """
+    Extract the peak of memory of every node from a resource-monitor profile.
+
+    Returns a list of ``(node fullname, interface name, peak in GB)`` tuples.
+
+    """
+    from ..utils.resources import profile_samples
+
+    return [
+        (name, interface, max(rss))
+        for (name, interface, _), (rss, _) in profile_samples(filename).items()
+    ]
+
+
+def collect_samples(work_dir):
+    """Pair the peaks of memory of the BOLD nodes in a working directory with features."""
+    from .. import config
+    from ..workflows.bold.base import _bold_features, _get_wf_name
+
+    config_files = sorted(
+        Path(work_dir).glob("config-*.toml"), key=lambda f: f.stat().st_mtime
+    )
+    profiles = sorted(Path(work_dir).glob("*/resource_monitor.json"))
+    if not config_files or not profiles:
+        raise FileNotFoundError(
+            f"<{work_dir}> does not contain a run configuration and a resource-monitor "
+            "profile."
+        )
+
+    config.execution._layout = None
+    config.load(config_files[-1])
+    bold_files = config.execution.layout.get(
+        suffix="bold", extension=[".nii", ".nii.gz"], return_type="file"
+    )
+    features = {
+        _get_wf_name(bold_file): _bold_features(bold_file, config.workflow.spaces)[1]
+        for bold_file in bold_files
+    }
+
+    samples = []
+    for profile in profiles:
+        for name, interface, peak in read_profile(profile):
+            wf_name = next((p for p in name.split(".") if p in features), None)
+            if wf_name is not None and peak > 0:
+                samples.append((interface, features[wf_name], peak))
+    return samples
+
+
+def calibrate(samples, coefficients, min_samples=3):
+    """Update the interface coefficients with those fitted to the samples."""
+    from ..utils.resources import fit_coefficients
+
+    by_interface = {}
+    for interface, features, peak in samples:
+        by_interface.setdefault(interface, []).append((features, peak))
+
+    interfaces = dict(coefficients.get("interfaces", {}))
+    for interface, pairs in sorted(by_interface.items()):
+        if len(pairs) < min_samples:
+            continue
+        features, peaks = zip(*pairs)
+        interfaces[interface] = fit_coefficients(features, peaks)
+    return {**coefficients, "interfaces": dict(sorted(interfaces.items()))}
+
+
+def main():
+    """Entry point."""
+    from ..utils.resources import DEFAULT_COEFFICIENTS
+
+    opts = get_parser().parse_args()
+    coefficients = json.loads((opts.base or DEFAULT_COEFFICIENTS).read_text())
+
+    samples = []
+    for work_dir in opts.work_dir:
+        samples += collect_samples(work_dir)
+    if not samples:
+        raise RuntimeError("No profiled nodes of BOLD workflows were found.")
+
+    calibrated = calibrate(samples, coefficients, min_samples=opts.min_samples)
+    opts.output.write_text(json.dumps(calibrated, indent=2) + "\n")
+    for interface, coef in calibrated["interfaces"].items():
+        if "samples" in coef:
+            print(
+                f"{interface}: {coef['intercept']:.3f} + {coef['bold']:.3f} * bold_gb "
+                f"+ {coef['target']:.3f} * target_gb ({coef['samples']} samples)"
+            )
+    print(f"Coefficients written to <{opts.output}>.")
+
+
+if __name__ == "__main__":
+    raise RuntimeError(
+        "fprodents/cli/calibrate.py should not be run directly;\n"
+        "Please use the `fprodents-calibrate-memory` command-line interface."
+    )
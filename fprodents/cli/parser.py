@@ -191,6 +191,69 @@ def _build_parser():
         help="attempt to reduce memory usage (will increase disk usage "
         "in working directory)",
     )
+    g_perfm.add_argument(
+        "--memory-coefficients",
+        action="store",
+        metavar="FILE",
+        type=IsFile,
+        help="JSON file of coefficients estimating the memory of each node, as "
+        "generated by fprodents-calibrate-memory from resource-monitor profiles",
+    )
+    g_perfm.add_argument(
+        "--compression-level",
+        action="store",
+        type=int,
+        choices=range(10),
+        default=1,
+        metavar="{0-9}",
+        help="gzip compression level of NIfTI outputs (compression is parallelized "
+        "with the per-process number of threads)",
+    )
+    g_perfm.add_argument(
+        "--resampling-engine",
+        action="store",
+        choices=["ants", "native"],
+        default="ants",
+        help="engine resampling BOLD series: ANTs (one antsApplyTransforms call per "
+        "volume) or native (single-pass, in-process resampling of the 4D series)",
+    )
+    g_perfm.add_argument(
+        "--stc-engine",
+        action="store",
+        choices=["afni", "native", "fused"],
+        default="afni",
+        help="engine correcting slice-timing: AFNI (3dTshift, writing a corrected "
+        "series), native (in-process, multi-threaded Fourier interpolation, writing "
+        "a corrected series) or fused (within the resampling pass of the native "
+        "engine, with cubic interpolation in time; requires --resampling-engine "
+        "native)",
+    )
+    g_perfm.add_argument(
+        "--t2s-engine",
+        action="store",
+        choices=["tedana", "native"],
+        default="tedana",
+        help="engine fitting the T2* map and optimally combining multi-echo data: "
+        "tedana (t2smap, fitting voxels one by one) or native (in-process, vectorized "
+        "and multi-threaded, not requiring tedana)",
+    )
+    g_perfm.add_argument(
+        "--hmc-engine",
+        action="store",
+        choices=["afni", "native"],
+        default="afni",
+        help="engine estimating head-motion: AFNI (3dVolreg) or native (multi-threaded, "
+        "in-process rigid-body registration, not requiring AFNI)",
+    )
+    g_perfm.add_argument(
+        "--confounds-engine",
+        action="store",
+        choices=["nipype", "fused"],
+        default="nipype",
+        help="engine calculating DVARS, global signals and CompCor: Nipype (one node "
+        "per confound, each reading the BOLD series) or fused (one node reading the "
+        "BOLD series once)",
+    )
     g_perfm.add_argument(
         "--use-plugin",
         "--nipype-plugin-file",
@@ -298,6 +361,17 @@ https://fmriprep-rodents.readthedocs.io/en/%s/spaces.html"""
         type=int,
         help="Number of non steady state volumes.",
     )
+    g_conf.add_argument(
+        "--reference-window",
+        required=False,
+        action="store",
+        default=40,
+        type=int,
+        choices=range(10, 201),
+        metavar="NVOLS",
+        help="Number of leading volumes of each run (between 10 and 200) read to "
+        "detect non steady state volumes and to generate the BOLD reference.",
+    )
     g_conf.add_argument(
         "--random-seed",
         action="store",
@@ -356,6 +430,15 @@ https://fmriprep-rodents.readthedocs.io/en/%s/spaces.html"""
         help="Threshold for flagging a frame as an outlier on the basis of standardised "
         "DVARS",
     )
+    g_confounds.add_argument(
+        "--confounds-encoding",
+        action="store",
+        choices=["dense", "compact"],
+        default="dense",
+        help="encoding of the confounds files: dense (the model expansion and spike "
+        "regressors are written as columns) or compact (they are described in the "
+        "metadata, and expanded on demand when reading the files)",
+    )
 
     #  ANTs options
     g_ants = parser.add_argument_group("Specific options for ANTs registrations")
@@ -459,7 +542,18 @@ https://fmriprep-rodents.readthedocs.io/en/%s/spaces.html"""
         "--resource-monitor",
         action="store_true",
         default=False,
-        help="enable Nipype's resource monitoring to keep track of memory and CPU usage",
+        help="enable Nipype's resource monitoring to keep track of memory and CPU usage "
+        "(a table of the resources used by each node is then written to "
+        "<work_dir>/resource_profile.json, and used to size the nodes of later runs)",
+    )
+    g_other.add_argument(
+        "--resource-profile",
+        action="store",
+        metavar="FILE",
+        type=IsFile,
+        help="table of the resources used by each node in a previous run, overriding "
+        "the memory and CPUs requested by the same nodes "
+        "(default: <work_dir>/resource_profile.json, if it exists)",
     )
     g_other.add_argument(
         "--reports-only",
@@ -112,6 +112,20 @@ def main():
         raise
     else:
         config.loggers.workflow.log(25, "fMRIPrep finished successfully!")
+        if config.nipype.resource_monitor:
+            import json
+            from ..utils.resources import summarize_profile
+
+            # Tabulate the resources used by each node, to size them in later runs
+            profile = config.execution.work_dir / fmriprep_wf.name / "resource_monitor.json"
+            if profile.is_file():
+                resource_table = config.execution.work_dir / "resource_profile.json"
+                resource_table.write_text(
+                    json.dumps(summarize_profile(profile), indent=2) + "\n"
+                )
+                config.loggers.workflow.log(
+                    25, f"Resources used by each node written to {resource_table}."
+                )
         if not config.execution.notrack:
             success_message = "fMRIPrep finished without errors"
             sentry_sdk.add_breadcrumb(message=success_message, level="info")
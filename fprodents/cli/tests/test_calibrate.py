@@ -0,0 +1,42 @@
+"""Test the calibration of memory estimates."""
+import json
+
+from ..calibrate import calibrate, read_profile
+from ...utils.resources import MemoryEstimator
+
+
+def test_calibrate(tmp_path):
+    """Peaks profiled for one interface are never underestimated after calibration."""
+    names, peaks, features = [], [], {}
+    for i, (bold, target) in enumerate(((0.1, 0.2), (0.4, 0.4), (0.8, 1.6), (1.0, 1.0))):
+        wf_name = f"func_preproc_run_{i}_wf"
+        features[wf_name] = {"bold": bold, "target": target}
+        names.append(f"fprodents_wf.{wf_name}.bold_std_trans_wf.bold_to_std_transform")
+        peaks.append(0.3 + 2 * bold + 0.5 * target)
+
+    profile = tmp_path / "resource_monitor.json"
+    profile.write_text(json.dumps({
+        "name": names * 2,
+        "interface": ["MultiResampleSeries"] * 8,
+        "params": [""] * 8,
+        "rss_GiB": [p / 2 for p in peaks] + peaks,
+        "cpus": [1.0] * 8,
+    }))
+
+    samples = [
+        (interface, features[name.split(".")[1]], peak)
+        for name, interface, peak in read_profile(profile)
+    ]
+    assert len(samples) == 4
+
+    coefficients = calibrate(samples, {"roles": {}, "interfaces": {}})
+    estimator = MemoryEstimator(coefficients)
+    for _, feats, peak in samples:
+        assert estimator.estimate("MultiResampleSeries", feats) >= round(peak, 4) - 1e-4
+
+    # Interfaces with too few samples keep their previous coefficients
+    previous = {"intercept": 1.0, "bold": 0.0, "target": 0.0}
+    coefficients = calibrate(
+        samples, {"interfaces": {"MultiResampleSeries": previous}}, min_samples=5
+    )
+    assert coefficients["interfaces"]["MultiResampleSeries"] == previous
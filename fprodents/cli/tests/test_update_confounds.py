@@ -0,0 +1,61 @@
+"""Test the update of spike regressors in existing outputs."""
+import sys
+
+import numpy as np
+import pandas as pd
+from niworkflows.interfaces.confounds import spike_regressors
+
+from .. import update_confounds
+
+
+def test_update_confounds(tmp_path, monkeypatch):
+    """Spike regressors match those calculated from scratch, other columns are kept."""
+    rng = np.random.default_rng(0)
+    base = pd.DataFrame(
+        {
+            "global_signal": rng.standard_normal(50),
+            "std_dvars": np.r_[np.nan, rng.gamma(4, 0.3, 49)],
+            "framewise_displacement": np.r_[np.nan, rng.gamma(2, 0.1, 49)],
+        }
+    )
+    criteria = {"framewise_displacement": (">", 0.5), "std_dvars": (">", 1.5)}
+    outputs = spike_regressors(data=base, criteria=criteria, lags=[0])
+    outputs["aroma_motion_01"] = rng.standard_normal(50)
+
+    func_dir = tmp_path / "fmriprep" / "sub-01" / "func"
+    func_dir.mkdir(parents=True)
+    confounds_file = func_dir / "sub-01_task-rest_desc-confounds_regressors.tsv"
+    outputs.to_csv(confounds_file, sep="\t", index=False, na_rep="n/a")
+    other_file = tmp_path / "fmriprep" / "sub-02_task-rest_desc-confounds_regressors.tsv"
+    outputs.to_csv(other_file, sep="\t", index=False, na_rep="n/a")
+    original = pd.read_csv(confounds_file, sep="\t", dtype=str, keep_default_na=False)
+
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "fprodents-update-confounds",
+            str(tmp_path),
+            "--participant-label",
+            "01",
+            "--fd-spike-threshold",
+            "0.2",
+            "--dvars-spike-threshold",
+            "1.0",
+        ],
+    )
+    update_confounds.main()
+
+    updated = pd.read_csv(confounds_file, sep="\t", na_values="n/a")
+    criteria = {"framewise_displacement": (">", 0.2), "std_dvars": (">", 1.0)}
+    expected = spike_regressors(data=base, criteria=criteria, lags=[0], concatenate=False)
+    spikes = [c for c in updated.columns if c.startswith("motion_outlier")]
+    assert spikes == list(expected.columns)
+    assert np.array_equal(updated[spikes].values, expected.values)
+    assert list(updated.columns) == list(base.columns) + spikes + ["aroma_motion_01"]
+
+    text = pd.read_csv(confounds_file, sep="\t", dtype=str, keep_default_na=False)
+    kept = [c for c in original.columns if not c.startswith("motion_outlier")]
+    assert text[kept].equals(original[kept])
+    # Other participants are not updated
+    assert other_file.read_text() == outputs.to_csv(sep="\t", index=False, na_rep="n/a")
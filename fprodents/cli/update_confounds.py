@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Update the spike regressors of existing confounds files.
+
+The thresholds of framewise displacement and standardized DVARS
+(``--fd-spike-threshold`` and ``--dvars-spike-threshold``) only determine the
+spike regressors (``motion_outlierXX`` columns) of the confounds files.
+This command finds the confounds files written into an output directory,
+recalculates their spike regressors from the framewise displacement and DVARS
+they store, and rewrites them in place, leaving every other column untouched
+(including the expansion of the confounds model, which does not depend on
+the thresholds).
+Compactly encoded confounds files (``--confounds-encoding compact``) keep their
+TSV file, and only the spike regressors described in their metadata JSON file
+are rewritten.
+
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+
+from ..utils.confounds import COMPACT_KEY
+
+#: Patterns of the confounds files (current and legacy BIDS suffixes).
+CONFOUNDS_PATTERNS = (
+    "*_desc-confounds_timeseries.tsv",
+    "*_desc-confounds_regressors.tsv",
+)
+#: Prefix of the spike regressors.
+SPIKES_PREFIX = "motion_outlier"
+#: Prefix of the columns joined after the spike regressors (ICA-AROMA).
+JOINED_PREFIX = "aroma_motion_"
+
+
+def get_parser():
+    """Build the parser of the update command."""
+    from argparse import ArgumentParser, RawTextHelpFormatter
+
+    parser = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
+    parser.add_argument(
+        "output_dir",
+        type=Path,
+        help="output directory of a previous run (searched recursively)",
+    )
+    parser.add_argument(
+        "--participant-label",
+        "--participant_label",
+        nargs="+",
+        help="a space delimited list of participant identifiers or a single "
+        "identifier (the sub- prefix can be removed)",
+    )
+    parser.add_argument(
+        "--fd-spike-threshold",
+        dest="regressors_fd_th",
+        default=0.5,
+        type=float,
+        help="Threshold for flagging a frame as an outlier on the basis of framewise "
+        "displacement",
+    )
+    parser.add_argument(
+        "--dvars-spike-threshold",
+        dest="regressors_dvars_th",
+        default=1.5,
+        type=float,
+        help="Threshold for flagging a frame as an outlier on the basis of standardised "
+        "DVARS",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report the number of spike regressors, without rewriting files",
+    )
+    return parser
+
+
+def find_confounds(output_dir, participant_label=None):
+    """List the confounds files within an output directory."""
+    subjects = (
+        None
+        if not participant_label
+        else {f"sub-{p[4:] if p.startswith('sub-') else p}" for p in participant_label}
+    )
+    return sorted(
+        f
+        for pattern in CONFOUNDS_PATTERNS
+        for f in Path(output_dir).rglob(pattern)
+        if subjects is None or f.name.split("_")[0] in subjects
+    )
+
+
+def update_spikes(in_file, fd_thresh, dvars_thresh):
+    """
+    Recalculate the spike regressors of a confounds file.
+
+    Columns other than the spike regressors are kept verbatim (as text), and
+    the new spike regressors take the place of the old ones.
+
+    >>> import os, tempfile
+    >>> import pandas as pd
+    >>> fname = os.path.join(tempfile.mkdtemp(), "sub-01_desc-confounds_timeseries.tsv")
+    >>> pd.DataFrame({
+    ...     "framewise_displacement": ["n/a", "0.3", "0.9", "0.2"],
+    ...     "std_dvars": ["n/a", "1.0", "1.0", "0.9"],
+    ...     "motion_outlier00": ["0.0", "0.0", "1.0", "0.0"],
+    ...     "aroma_motion_01": ["0.1", "0.2", "0.3", "0.4"],
+    ... }).to_csv(fname, sep="\\t", index=False)
+    >>> updated = update_spikes(fname, fd_thresh=0.25, dvars_thresh=1.5)
+    >>> print(updated.to_csv(sep="\\t", index=False).strip())
+    framewise_displacement	std_dvars	motion_outlier00	motion_outlier01	aroma_motion_01
+    n/a	n/a	0.0	0.0	0.1
+    0.3	1.0	1.0	0.0	0.2
+    0.9	1.0	0.0	1.0	0.3
+    0.2	0.9	0.0	0.0	0.4
+
+    """
+    import pandas as pd
+    from niworkflows.interfaces.confounds import spike_regressors
+    from ..utils.confounds import read_confounds
+
+    text = pd.read_csv(in_file, sep="\t", dtype=str, keep_default_na=False)
+    columns = list(text.columns)
+    old_spikes = [c for c in columns if c.startswith(SPIKES_PREFIX)]
+    joined = [c for c in columns if c.startswith(JOINED_PREFIX)]
+    base = [c for c in columns if c not in old_spikes and c not in joined]
+
+    spikes = spike_regressors(
+        data=read_confounds(in_file)[base],
+        criteria={
+            "framewise_displacement": (">", fd_thresh),
+            "std_dvars": (">", dvars_thresh),
+        },
+        header_prefix=SPIKES_PREFIX,
+        lags=[0],
+        concatenate=False,
+    )
+
+    # New spike regressors go where the old ones were (or after the base columns)
+    position = columns.index(old_spikes[0]) if old_spikes else len(base)
+    before = [c for c in columns[:position] if c not in old_spikes]
+    after = [c for c in columns[position:] if c not in old_spikes]
+    return pd.concat((text[before], spikes, text[after]), axis=1)
+
+
+def update_compact_spikes(in_file, metadata, fd_thresh, dvars_thresh):
+    """
+    Recalculate the spike regressors of a compactly encoded confounds file.
+
+    Returns a copy of ``metadata`` with the spike regressors of its compact
+    encoding (and the list of columns they appear in) updated.
+
+    >>> import os, tempfile
+    >>> import pandas as pd
+    >>> fname = os.path.join(tempfile.mkdtemp(), "sub-01_desc-confounds_timeseries.tsv")
+    >>> pd.DataFrame({
+    ...     "framewise_displacement": ["n/a", "0.3", "0.9", "0.2"],
+    ...     "std_dvars": ["n/a", "1.0", "1.0", "0.9"],
+    ... }).to_csv(fname, sep="\\t", index=False)
+    >>> metadata = {"CompactEncoding": {
+    ...     "Columns": ["framewise_displacement", "std_dvars", "motion_outlier00"],
+    ...     "Formula": "others",
+    ...     "Spikes": {"motion_outlier00": [2]},
+    ... }}
+    >>> encoding = update_compact_spikes(fname, metadata, 0.25, 1.5)["CompactEncoding"]
+    >>> encoding["Columns"]
+    ['framewise_displacement', 'std_dvars', 'motion_outlier00', 'motion_outlier01']
+    >>> encoding["Spikes"]
+    {'motion_outlier00': [1], 'motion_outlier01': [2]}
+
+    """
+    from niworkflows.interfaces.confounds import spike_regressors
+    from ..utils.confounds import read_confounds
+
+    encoding = dict(metadata[COMPACT_KEY])
+    spikes = spike_regressors(
+        data=read_confounds(in_file),
+        criteria={
+            "framewise_displacement": (">", fd_thresh),
+            "std_dvars": (">", dvars_thresh),
+        },
+        header_prefix=SPIKES_PREFIX,
+        lags=[0],
+        concatenate=False,
+    )
+    old_spikes = set(encoding.get("Spikes", {}))
+    columns = [c for c in encoding["Columns"] if c not in old_spikes]
+    encoding["Columns"] = columns + list(spikes.columns)
+    encoding["Spikes"] = {
+        name: np.flatnonzero(spikes[name].to_numpy()).tolist()
+        for name in spikes.columns
+    }
+    return {**metadata, COMPACT_KEY: encoding}
+
+
+def main():
+    """Entry point."""
+    opts = get_parser().parse_args()
+    confounds_files = find_confounds(opts.output_dir, opts.participant_label)
+    if not confounds_files:
+        raise RuntimeError(f"No confounds files were found in <{opts.output_dir}>.")
+
+    for confounds_file in confounds_files:
+        json_file = confounds_file.with_suffix(".json")
+        metadata = json.loads(json_file.read_text()) if json_file.exists() else {}
+        if COMPACT_KEY in metadata:
+            metadata = update_compact_spikes(
+                confounds_file,
+                metadata,
+                opts.regressors_fd_th,
+                opts.regressors_dvars_th,
+            )
+            if not opts.dry_run:
+                json_file.write_text(json.dumps(metadata, indent=2))
+            nspikes = len(metadata[COMPACT_KEY]["Spikes"])
+            print(f"{confounds_file}: {nspikes} spike regressors (compact).")
+            continue
+
+        updated = update_spikes(
+            confounds_file, opts.regressors_fd_th, opts.regressors_dvars_th
+        )
+        nspikes = sum(c.startswith(SPIKES_PREFIX) for c in updated.columns)
+        if not opts.dry_run:
+            # Derivatives are rewritten without the binary sidecar of internal tables
+            updated.to_csv(confounds_file, sep="\t", index=False, na_rep="n/a")
+        print(f"{confounds_file}: {nspikes} spike regressors.")
+
+
+if __name__ == "__main__":
+    raise RuntimeError(
+        "fprodents/cli/update_confounds.py should not be run directly;\n"
+        "Please use the `fprodents-update-confounds` command-line interface."
+    )
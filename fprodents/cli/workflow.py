@@ -12,11 +12,14 @@ a hard-limited memory-scope.
 
 def build_workflow(config_file, retval):
     """Create the Nipype Workflow that supports the whole execution graph."""
+    import json
+    from pathlib import Path
     from niworkflows.utils.bids import collect_participants, check_pipeline_version
     from niworkflows.utils.misc import check_valid_fs_license
     from niworkflows.reports import generate_reports
     from .. import config
     from ..utils.misc import check_deps
+    from ..utils.resources import apply_resource_profile
     from ..workflows.base import init_fmriprep_wf
 
     config.load(config_file)
@@ -80,6 +83,20 @@ def build_workflow(config_file, retval):
 
     retval["workflow"] = init_fmriprep_wf()
 
+    # Size nodes after the resources they used in a previous run
+    resource_profile = config.nipype.resource_profile or (
+        config.execution.work_dir / "resource_profile.json"
+    )
+    if Path(resource_profile).is_file():
+        updated = apply_resource_profile(
+            retval["workflow"],
+            json.loads(Path(resource_profile).read_text()),
+            max_procs=config.nipype.nprocs,
+        )
+        build_log.info(
+            "Resources of %d nodes set from profile <%s>.", updated, resource_profile
+        )
+
     # Check for FS license after building the workflow
     if not check_valid_fs_license():
         build_log.critical(
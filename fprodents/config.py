@@ -289,6 +289,10 @@ class nipype(_Config):
     """Settings for NiPype's execution plugin."""
     resource_monitor = False
     """Enable resource monitor."""
+    resource_profile = None
+    """A table of the resources used by each node in a previous run (see
+    :py:func:`~fprodents.utils.resources.summarize_profile`), overriding the
+    requests of nodes (``<work_dir>/resource_profile.json`` is used if found)."""
     stop_on_first_crash = True
     """Whether the workflow should stop or continue after the first error."""
 
@@ -355,6 +359,9 @@ class execution(_Config):
     """A dictionary of BIDS selection filters."""
     boilerplate_only = False
     """Only generate a boilerplate."""
+    compression_level = 1
+    """Compression level of gzipped NIfTI outputs (compression is run with as many
+    threads as :py:attr:`~nipype.omp_nthreads`)."""
     debug = False
     """Run in sloppy mode (meaning, suboptimal parameters that minimize run-time)."""
     echo_idx = None
@@ -371,6 +378,9 @@ class execution(_Config):
     """Output verbosity."""
     low_mem = None
     """Utilize uncompressed NIfTIs and other tricks to minimize memory allocation."""
+    memory_coefficients = None
+    """A JSON file of coefficients estimating the memory of nodes (see
+    :py:mod:`fprodents.utils.resources`), the package's defaults if ``None``."""
     md_only_boilerplate = False
     """Do not convert boilerplate from MarkDown to LaTex and HTML."""
     notrack = False
@@ -404,6 +414,7 @@ class execution(_Config):
         "fs_subjects_dir",
         "layout",
         "log_dir",
+        "memory_coefficients",
         "output_dir",
         "templateflow_home",
         "work_dir",
@@ -474,6 +485,13 @@ class workflow(_Config):
     bold2t1w_init = "register"
     """Whether to use standard coregistration ('register') or to initialize coregistration from the
     BOLD image-header ('header')."""
+    confounds_encoding = "dense"
+    """Encoding of the confounds files: ``dense`` (model expansion and spike regressors
+    written as columns) or ``compact`` (described in the metadata)."""
+    confounds_engine = "nipype"
+    """Engine calculating DVARS, global signals and CompCor: ``nipype`` (one node
+    per confound, each reading the BOLD series) or ``fused`` (one node reading the
+    BOLD series once)."""
     dummy_scans = None
     """Set a number of initial scans to be considered nonsteady states."""
     fmap_bspline = None
@@ -482,6 +500,9 @@ class workflow(_Config):
     """Remove the mean from fieldmaps."""
     force_syn = None
     """Run *fieldmap-less* susceptibility-derived distortions estimation."""
+    hmc_engine = "afni"
+    """Engine estimating head-motion: ``afni`` (``3dVolreg``) or ``native``
+    (in-process rigid-body registration, without the AFNI dependency)."""
     hires = None
     """Run FreeSurfer ``recon-all`` with the ``-hires`` flag."""
     ignore = None
@@ -492,12 +513,18 @@ class workflow(_Config):
     """Master random seed to initialize the Pseudorandom Number Generator (PRNG)"""
     medial_surface_nan = None
     """Fill medial surface with :abbr:`NaNs (not-a-number)` when sampling."""
+    reference_window = 40
+    """Number of leading volumes of each run read to detect nonsteady states and to
+    generate the BOLD reference."""
     regressors_all_comps = None
     """Return all CompCor components."""
     regressors_dvars_th = None
     """Threshold for DVARS."""
     regressors_fd_th = None
     """Threshold for :abbr:`FD (frame-wise displacement)`."""
+    resampling_engine = "ants"
+    """Engine resampling BOLD series: ``ants`` (one ``antsApplyTransforms`` call per
+    volume) or ``native`` (single-pass, in-process resampling of the 4D series)."""
     skull_strip_fixed_seed = False
     """Fix a seed for skull-stripping."""
     skull_strip_template = "Fischer344"
@@ -508,6 +535,13 @@ class workflow(_Config):
     spaces = None
     """Keeps the :py:class:`~niworkflows.utils.spaces.SpatialReferences`
     instance keeping standard and nonstandard spaces."""
+    stc_engine = "afni"
+    """Engine correcting slice-timing: ``afni`` (``3dTshift``), ``native`` (in-process
+    Fourier interpolation) or ``fused`` (within the single-pass resampling of the
+    native engine, with cubic interpolation in time)."""
+    t2s_engine = "tedana"
+    """Engine fitting the T2* decay of multi-echo data: ``tedana`` (``t2smap``) or
+    ``native`` (in-process, vectorized fit streaming the echoes in chunks)."""
     use_aroma = None
     """Run ICA-:abbr:`AROMA (automatic removal of motion artifacts)`."""
     use_syn_sdc = None
@@ -1,17 +1,102 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
+from pathlib import Path
+
+from nipype.interfaces.base import traits
+
 # Load modules for compatibility
 from niworkflows.interfaces import bids, cifti, freesurfer, images, itk, surf, utility
 
 from .reports import SubjectSummary, FunctionalSummary, AboutSummary
-from .confounds import GatherConfounds, ICAConfounds, FMRISummary
-from .multiecho import T2SMap
+from .confounds import (
+    CarpetData,
+    FusedConfounds,
+    GatherConfounds,
+    ICAConfounds,
+    FMRISummary,
+)
+from .multiecho import FitT2SMap, T2SMap
+
+
+class _DerivativesDataSinkInputSpec(bids._DerivativesDataSinkInputSpec):
+    compresslevel = traits.Range(
+        low=0, high=9, value=1, usedefault=True, nohash=True, desc="gzip compression level"
+    )
+    num_threads = traits.Int(
+        1, usedefault=True, nohash=True, desc="number of compression threads"
+    )
 
 
 class DerivativesDataSink(bids.DerivativesDataSink):
+    """
+    Store derivatives, compressing uncompressed NIfTI inputs with parallel gzip.
+
+    NIfTI inputs to be stored compressed (``compress=True``, or gzipped inputs
+    with ``compress`` unset) are stored uncompressed first, so that copies and
+    header or data-type fixes are written by the parent interface without
+    single-threaded gzip, and then compressed with
+    :py:class:`~fprodents.utils.images.ParallelGzipFile`.
+    The binary sidecars of confounds tables are stored next to them
+    (see :py:func:`~fprodents.utils.confounds.copy_sidecar`).
+
+    """
+
+    input_spec = _DerivativesDataSinkInputSpec
     out_path_base = "fmriprep"
 
+    def _run_interface(self, runtime):
+        from bids.utils import listify
+        from ..utils.confounds import copy_sidecar
+
+        runtime = self._store(runtime)
+        for in_file, out_file in zip(
+            listify(self.inputs.in_file), listify(self._results["out_file"])
+        ):
+            if str(in_file).endswith(".tsv"):
+                copy_sidecar(in_file, out_file)
+        return runtime
+
+    def _store(self, runtime):
+        from bids.utils import listify
+        from ..utils.images import gzip_file
+
+        in_file = listify(self.inputs.in_file)
+        compress = listify(self.inputs.compress) or [None]
+        if len(compress) == 1:
+            compress = compress * len(in_file)
+        deferred = [
+            str(f).endswith(".nii.gz") if comp is None else
+            bool(comp) and str(f).endswith((".nii", ".nii.gz"))
+            for f, comp in zip(in_file, compress)
+        ]
+        if not any(deferred):
+            return super()._run_interface(runtime)
+
+        orig_compress = self.inputs.compress
+        self.inputs.compress = [
+            False if defer else comp for defer, comp in zip(deferred, compress)
+        ]
+        try:
+            runtime = super()._run_interface(runtime)
+        finally:
+            self.inputs.compress = orig_compress
+
+        out_files = listify(self._results["out_file"])
+        for i, defer in enumerate(deferred):
+            if not defer:
+                continue
+            out_files[i] = gzip_file(
+                out_files[i],
+                f"{out_files[i]}.gz",
+                compresslevel=self.inputs.compresslevel,
+                num_threads=self.inputs.num_threads,
+            )
+            Path(out_files[i][:-3]).unlink()
+            self._results["compression"][i] = True
+        self._results["out_file"] = out_files
+        return runtime
+
 
 __all__ = [
     "bids",
@@ -24,6 +109,8 @@ __all__ = [
     "SubjectSummary",
     "FunctionalSummary",
     "AboutSummary",
+    "CarpetData",
+    "FusedConfounds",
     "GatherConfounds",
     "ICAConfounds",
     "FMRISummary",
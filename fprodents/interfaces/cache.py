@@ -0,0 +1,165 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Caches shared by the nodes of a run.
+
+Several sub-workflows need the same intermediate files (e.g., the 3D volumes of
+a BOLD series).
+Instead of regenerating them within each node's directory, the interfaces of
+this module store them in a cache directory (typically within the working
+directory), under a key derived from the input file (see :py:func:`file_key`).
+
+"""
+import hashlib
+import os
+import shutil
+from contextlib import suppress
+from pathlib import Path
+from uuid import uuid4
+
+import numpy as np
+import nibabel as nb
+from nipype import logging
+from nipype.interfaces.base import (
+    traits,
+    TraitedSpec,
+    BaseInterfaceInputSpec,
+    File,
+    OutputMultiObject,
+    SimpleInterface,
+    isdefined,
+)
+
+LOGGER = logging.getLogger("nipype.interface")
+
+
+def file_key(in_file):
+    """
+    Calculate a cache key identifying a file, without reading its data.
+
+    The key is the SHA-256 digest of the file's real path, size and
+    modification time, plus its header if it is an image (so that rewriting a
+    file, even in place, yields a new key).
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile() as f:
+    ...     key = file_key(f.name)
+    ...     _ = f.write(b"fprodents")
+    ...     f.flush()
+    ...     key == file_key(f.name), len(key)
+    (False, 64)
+
+    """
+    stat = os.stat(in_file)
+    digest = hashlib.sha256(
+        f"{os.path.realpath(in_file)}|{stat.st_size}|{stat.st_mtime_ns}".encode()
+    )
+    with suppress(nb.filebasedimages.ImageFileError):
+        digest.update(nb.load(in_file).header.binaryblock)
+    return digest.hexdigest()
+
+
+def cache_entry(cache_dir, key, populate):
+    """
+    Return the path of a cache entry, populating it first if necessary.
+
+    ``populate`` is called with a temporary directory, which is atomically
+    renamed into the cache when it returns.
+    If several processes populate the same entry concurrently, the first one
+    finishing wins and the others discard their copy.
+
+    """
+    cache_dir = Path(cache_dir)
+    entry = cache_dir / key
+    if entry.is_dir():
+        LOGGER.debug("Reusing cached entry <%s>.", entry)
+        return entry
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmpdir = cache_dir / f".{key}.{os.getpid()}.{uuid4().hex[:8]}"
+    tmpdir.mkdir()
+    try:
+        populate(tmpdir)
+        os.rename(tmpdir, entry)
+    except OSError:
+        if not entry.is_dir():
+            raise
+        LOGGER.debug("Cache entry <%s> was populated concurrently.", entry)
+    finally:
+        if tmpdir.exists():
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return entry
+
+
+class CachedSplitInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="the 4D series to split")
+    cache_dir = traits.Directory(
+        desc="directory where split volumes are stored (the node's working "
+        "directory if not set)"
+    )
+
+
+class CachedSplitOutputSpec(TraitedSpec):
+    out_files = OutputMultiObject(File(exists=True), desc="3D volumes")
+
+
+class CachedSplit(SimpleInterface):
+    """
+    Split a 4D series into 3D volumes, reusing volumes already split.
+
+    Volumes are stored in ``<cache_dir>/<key of in_file>/`` (see
+    :py:func:`file_key`), so that all the nodes splitting the same file share
+    a single set of volumes.
+
+    """
+
+    input_spec = CachedSplitInputSpec
+    output_spec = CachedSplitOutputSpec
+
+    def _run_interface(self, runtime):
+        cache_dir = (
+            self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else runtime.cwd
+        )
+        entry = cache_entry(
+            cache_dir,
+            file_key(self.inputs.in_file),
+            lambda path: _split_series(self.inputs.in_file, path),
+        )
+        self._results["out_files"] = [str(f) for f in _list_volumes(entry)]
+        return runtime
+
+
+def _list_volumes(path):
+    """
+    List the volumes split into ``path``, in their order within the series.
+
+    Volume names are padded to four digits only, so they are sorted by index.
+
+    >>> import tempfile
+    >>> tmpdir = Path(tempfile.mkdtemp())
+    >>> for i in (1001, 10000, 9):
+    ...     (tmpdir / f"vol{i:04d}.nii").touch()
+    >>> [f.name for f in _list_volumes(tmpdir)]
+    ['vol0009.nii', 'vol1001.nii', 'vol10000.nii']
+
+    """
+    return sorted(Path(path).glob("vol*.nii"), key=lambda f: int(f.stem[3:]))
+
+
+def _split_series(in_file, out_dir):
+    from ..utils.images import CHUNK_VOLS
+
+    # Keep the file open, so that compressed series are decompressed only once
+    img = nb.load(in_file, keep_file_open=True)
+    hdr = img.header.copy()
+    nvols = img.shape[3] if img.ndim > 3 else 1
+    # Read a chunk of volumes at a time, bounding the memory used
+    for start in range(0, nvols, CHUNK_VOLS):
+        if img.ndim > 3:
+            data = np.asanyarray(img.dataobj[..., start : start + CHUNK_VOLS])
+        else:
+            data = np.asanyarray(img.dataobj)[..., np.newaxis]
+        for i in range(data.shape[3]):
+            img.__class__(data[..., i], img.affine, hdr).to_filename(
+                str(Path(out_dir) / f"vol{start + i:04d}.nii")
+            )
@@ -13,19 +13,38 @@ import os
 import re
 import shutil
 import numpy as np
+import nibabel as nb
 import pandas as pd
 from nipype import logging
 from nipype.utils.filemanip import fname_presuffix
+from niworkflows.interfaces import confounds as nwconfounds, plotting as nwplotting
 from nipype.interfaces.base import (
     traits,
     TraitedSpec,
     BaseInterfaceInputSpec,
     File,
     Directory,
+    InputMultiObject,
     isdefined,
     SimpleInterface,
 )
 
+from ..utils.carpet import (
+    CHUNK_VOLS,
+    MAX_ROWS,
+    MAX_TIMEPOINTS,
+    carpet_data,
+    load_carpet,
+    plot_summary,
+    save_carpet,
+)
+from ..utils.confounds import (
+    COMPACT_KEY,
+    compact_encoding,
+    read_confounds,
+    write_confounds,
+)
+
 LOGGER = logging.getLogger("nipype.interface")
 
 
@@ -148,6 +167,116 @@ class ICAConfounds(SimpleInterface):
         return runtime
 
 
+class ExpandModel(nwconfounds.ExpandModel):
+    """Expand a confounds model, reading and writing binary sidecars of the tables."""
+
+    def _run_interface(self, runtime):
+        if isdefined(self.inputs.output_file):
+            out_file = self.inputs.output_file
+        else:
+            out_file = fname_presuffix(
+                self.inputs.confounds_file,
+                suffix="_expansion.tsv",
+                newpath=runtime.cwd,
+                use_ext=False,
+            )
+
+        _, confounds_data = nwconfounds.parse_formula(
+            model_formula=self.inputs.model_formula,
+            parent_data=read_confounds(self.inputs.confounds_file),
+            unscramble=True,
+        )
+        self._results["confounds_file"] = write_confounds(confounds_data, out_file)
+        return runtime
+
+
+class SpikeRegressors(nwconfounds.SpikeRegressors):
+    """Add spike regressors, reading and writing binary sidecars of the tables."""
+
+    def _run_interface(self, runtime):
+        if isdefined(self.inputs.output_file):
+            out_file = self.inputs.output_file
+        else:
+            out_file = fname_presuffix(
+                self.inputs.confounds_file,
+                suffix="_desc-motion_outliers.tsv",
+                newpath=runtime.cwd,
+                use_ext=False,
+            )
+
+        confounds_data = nwconfounds.spike_regressors(
+            data=read_confounds(self.inputs.confounds_file),
+            criteria={
+                "framewise_displacement": (">", self.inputs.fd_thresh),
+                "std_dvars": (">", self.inputs.dvars_thresh),
+            },
+            header_prefix=self.inputs.header_prefix,
+            lags=self.inputs.lags,
+            minimum_contiguous=self.inputs.minimum_contiguous,
+            concatenate=self.inputs.concatenate,
+            output=self.inputs.output_format,
+        )
+        self._results["confounds_file"] = write_confounds(confounds_data, out_file)
+        return runtime
+
+
+class CompactConfoundsInputSpec(BaseInterfaceInputSpec):
+    confounds_file = File(exists=True, mandatory=True, desc="base confounds table")
+    model_formula = traits.Str(
+        "(dd1(rps + wm + csf + gsr))^^2 + others",
+        usedefault=True,
+        desc="formula expanding the base confounds into the confounds model",
+    )
+    fd_thresh = traits.Float(
+        0.5, usedefault=True, desc="criterion for flagging framewise displacement outliers"
+    )
+    dvars_thresh = traits.Float(
+        1.5, usedefault=True, desc="criterion for flagging DVARS outliers"
+    )
+    header_prefix = traits.Str(
+        "motion_outlier", usedefault=True, desc="prefix of the spike regressors"
+    )
+
+
+class CompactConfoundsOutputSpec(TraitedSpec):
+    confounds_file = File(exists=True, desc="base confounds table (as given)")
+    metadata = traits.Dict(desc="metadata holding the compact encoding of the model")
+
+
+class CompactConfounds(SimpleInterface):
+    """
+    Encode the confounds model and spike regressors compactly, in metadata.
+
+    A replacement for :py:class:`ExpandModel` followed by
+    :py:class:`SpikeRegressors`: instead of writing the expanded model and one
+    dense column per spike regressor, the base table is kept as is, and the
+    model and spikes are described in the metadata
+    (see :py:func:`~fprodents.utils.confounds.compact_encoding`).
+
+    """
+
+    input_spec = CompactConfoundsInputSpec
+    output_spec = CompactConfoundsOutputSpec
+
+    def _run_interface(self, runtime):
+        data = read_confounds(self.inputs.confounds_file)
+        spikes = nwconfounds.spike_regressors(
+            data=data,
+            criteria={
+                "framewise_displacement": (">", self.inputs.fd_thresh),
+                "std_dvars": (">", self.inputs.dvars_thresh),
+            },
+            header_prefix=self.inputs.header_prefix,
+            lags=[0],
+            concatenate=False,
+        )
+        self._results["confounds_file"] = self.inputs.confounds_file
+        self._results["metadata"] = {
+            COMPACT_KEY: compact_encoding(data, self.inputs.model_formula, spikes)
+        }
+        return runtime
+
+
 def _gather_confounds(
     signals=None,
     dvars=None,
@@ -192,15 +321,6 @@ def _gather_confounds(
         s1 = re.sub("(.)([A-Z][a-z]+)", r"\1_\2", name)
         return re.sub("([a-z0-9])([A-Z])", r"\1_\2", s1).lower()
 
-    def _adjust_indices(left_df, right_df):
-        # This forces missing values to appear at the beggining of the DataFrame
-        # instead of the end
-        index_diff = len(left_df.index) - len(right_df.index)
-        if index_diff > 0:
-            right_df.index = range(index_diff, len(right_df.index) + index_diff)
-        elif index_diff < 0:
-            left_df.index = range(-index_diff, len(left_df.index) - index_diff)
-
     all_files = []
     confounds_list = []
     for confound, name in (
@@ -220,23 +340,30 @@ def _gather_confounds(
             if os.path.exists(confound) and os.stat(confound).st_size > 0:
                 all_files.append(confound)
 
-    confounds_data = pd.DataFrame()
-    for file_name in all_files:  # assumes they all have headings already
-        new = pd.read_csv(file_name, sep="\t")
-        for column_name in new.columns:
-            new.rename(
-                columns={column_name: camel_to_snake(less_breakable(column_name))},
-                inplace=True,
-            )
+    tables = [read_confounds(file_name) for file_name in all_files]
+    columns = [
+        camel_to_snake(less_breakable(column_name))
+        for table in tables  # assumes they all have headings already
+        for column_name in table.columns
+    ]
 
-        _adjust_indices(confounds_data, new)
-        confounds_data = pd.concat((confounds_data, new), axis=1)
+    # Assemble all columns at once; shorter tables are aligned with the end of
+    # the longest, so that missing values appear at the beginning
+    nrows = max((len(table) for table in tables), default=0)
+    values = np.full((nrows, len(columns)), np.nan)
+    start = 0
+    for table in tables:
+        values[nrows - len(table) :, start : start + table.shape[1]] = table.to_numpy(
+            dtype="float64"
+        )
+        start += table.shape[1]
+    confounds_data = pd.DataFrame(values, columns=columns)
 
     if newpath is None:
         newpath = os.getcwd()
 
     combined_out = os.path.join(newpath, "confounds.tsv")
-    confounds_data.to_csv(combined_out, sep="\t", index=False, na_rep="n/a")
+    write_confounds(confounds_data, combined_out)
 
     return combined_out, confounds_list
 
@@ -306,20 +433,656 @@ def _get_ica_confounds(ica_out_dir, skip_vols, newpath=None):
 
     # add one to motion_ic_indices to match melodic report.
     aroma_confounds = os.path.join(newpath, "AROMAAggrCompAROMAConfounds.tsv")
-    pd.DataFrame(
-        aggr_confounds.T,
-        columns=["aroma_motion_%02d" % (x + 1) for x in motion_ic_indices],
-    ).to_csv(aroma_confounds, sep="\t", index=None)
+    write_confounds(
+        pd.DataFrame(
+            aggr_confounds.T,
+            columns=["aroma_motion_%02d" % (x + 1) for x in motion_ic_indices],
+        ),
+        aroma_confounds,
+    )
 
     return aroma_confounds, motion_ics_out, melodic_mix_out, aroma_metadata_out
 
 
+class FusedConfoundsInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="BOLD series (4D)")
+    in_mask = File(exists=True, mandatory=True, desc="brain mask of the BOLD series")
+    signal_masks = InputMultiObject(
+        File(exists=True),
+        mandatory=True,
+        desc="masks within which the mean signals are extracted",
+    )
+    class_labels = traits.List(
+        traits.Str, mandatory=True, desc="names of the mean signals, one per mask"
+    )
+    prob_thres = traits.Range(
+        low=0.0,
+        high=1.0,
+        value=0.5,
+        usedefault=True,
+        desc="threshold on the values of the masks of mean signals",
+    )
+    tcompcor_mask = File(
+        exists=True,
+        mandatory=True,
+        desc="mask within which the high-variance voxels of tCompCor are selected",
+    )
+    acompcor_masks = InputMultiObject(
+        File(exists=True), mandatory=True, desc="masks of the aCompCor decompositions"
+    )
+    acompcor_names = traits.List(
+        traits.Str, desc="names of the aCompCor masks (for the metadata)"
+    )
+    percentile_threshold = traits.Range(
+        low=0.0,
+        high=1.0,
+        value=0.02,
+        exclude_low=True,
+        exclude_high=True,
+        usedefault=True,
+        desc="fraction of the most variable voxels selected by tCompCor",
+    )
+    num_components = traits.Either(
+        "all",
+        traits.Range(low=1),
+        xor=["variance_threshold"],
+        desc="number of CompCor components retained",
+    )
+    variance_threshold = traits.Range(
+        low=0.0,
+        high=1.0,
+        exclude_low=True,
+        exclude_high=True,
+        xor=["num_components"],
+        desc="retain the CompCor components necessary to explain this fraction of "
+        "the variance",
+    )
+    high_pass_cutoff = traits.Float(
+        128, usedefault=True, desc="cutoff (in seconds) of the cosine pre-filter"
+    )
+    repetition_time = traits.Float(
+        desc="repetition time (TR) of the series - derived from the header if unset"
+    )
+    ignore_initial_volumes = traits.Range(
+        low=0, usedefault=True, desc="number of non-steady-state volumes"
+    )
+    failure_mode = traits.Enum(
+        "error",
+        "NaN",
+        usedefault=True,
+        desc="raise or return NaN components when a decomposition fails",
+    )
+    remove_zerovariance = traits.Bool(
+        True, usedefault=True, desc="remove voxels with zero variance from DVARS"
+    )
+    variance_tol = traits.Float(
+        1e-7, usedefault=True, desc="maximum variance considered zero by DVARS"
+    )
+    intensity_normalization = traits.Float(
+        1000.0, usedefault=True, desc="scale of the median intensity for DVARS"
+    )
+    chunk_size = traits.Int(
+        64, usedefault=True, nohash=True, desc="number of volumes read at a time"
+    )
+
+
+class FusedConfoundsOutputSpec(TraitedSpec):
+    out_std = File(exists=True, desc="standardized DVARS")
+    out_nstd = File(exists=True, desc="non-standardized DVARS")
+    signals_file = File(exists=True, desc="mean signals within each mask")
+    tcompcor_file = File(exists=True, desc="tCompCor components")
+    tcompcor_metadata = File(exists=True, desc="tCompCor metadata")
+    high_variance_mask = File(exists=True, desc="voxels selected by tCompCor")
+    acompcor_file = File(exists=True, desc="aCompCor components")
+    acompcor_metadata = File(exists=True, desc="aCompCor metadata")
+    pre_filter_file = File(exists=True, desc="cosine basis of the pre-filter")
+    ref_file = File(exists=True, desc="first volume of the series, for reports")
+
+
+class FusedConfounds(SimpleInterface):
+    """
+    Calculate DVARS, mean signals, tCompCor and aCompCor reading the BOLD series once.
+
+    The series is streamed a chunk of volumes at a time, keeping only the voxels
+    within the union of all masks, and the mean signals are accumulated on the
+    fly.
+    Every confound is then calculated from those voxels, exactly as Nipype's
+    ``ComputeDVARS``, ``TCompCor`` and ``ACompCor``, and NiWorkflows'
+    ``SignalExtraction`` calculate them from the full series, and written in
+    the same formats.
+
+    """
+
+    input_spec = FusedConfoundsInputSpec
+    output_spec = FusedConfoundsOutputSpec
+
+    def _run_interface(self, runtime):
+        from nipype.algorithms.confounds import regress_poly, _compute_tSTD
+
+        img = nb.load(self.inputs.in_file, keep_file_open=True)
+        if img.ndim != 4:
+            raise ValueError(
+                f"Input <{self.inputs.in_file}> should be 4-dimensional (shape "
+                f"{img.shape})."
+            )
+
+        brain = np.bool_(nb.load(self.inputs.in_mask).dataobj)
+        signal_masks = [
+            np.asanyarray(nb.load(fname).dataobj) >= self.inputs.prob_thres
+            for fname in self.inputs.signal_masks
+        ]
+        tcc_img = nb.load(self.inputs.tcompcor_mask)
+        tcc_mask = np.asanyarray(tcc_img.dataobj).astype(bool)
+        acc_masks = [
+            np.asanyarray(nb.squeeze_image(nb.load(fname)).dataobj).astype(bool)
+            for fname in self.inputs.acompcor_masks
+        ]
+        if len(signal_masks) != len(self.inputs.class_labels):
+            raise ValueError("Number of masks must match number of labels")
+
+        masks = [brain, tcc_mask] + signal_masks + acc_masks
+        if any(mask.shape != img.shape[:3] for mask in masks):
+            raise ValueError(
+                "Masks do not match the spatial dimensions of the BOLD series "
+                f"{img.shape[:3]}."
+            )
+        union = np.logical_or.reduce(masks)
+        brain, tcc_rows, *rows = [mask[union] for mask in masks]
+        signal_rows, acc_rows = rows[: len(signal_masks)], rows[len(signal_masks) :]
+
+        series, signals, first = _stream_series(
+            img, union, signal_rows, chunk_size=self.inputs.chunk_size
+        )
+
+        # Reportlets only show the first volume
+        header = img.header.copy()
+        header.set_data_dtype("float32")
+        self._results["ref_file"] = os.path.join(runtime.cwd, "ref.nii")
+        img.__class__(first, img.affine, header).to_filename(self._results["ref_file"])
+
+        # Mean signals
+        self._results["signals_file"] = os.path.join(runtime.cwd, "signals.tsv")
+        np.savetxt(
+            self._results["signals_file"],
+            np.vstack((self.inputs.class_labels, signals.astype(str))),
+            fmt="%s",
+            delimiter="\t",
+        )
+
+        # DVARS
+        dvars = _compute_dvars(
+            series if brain.all() else series[brain],
+            remove_zerovariance=self.inputs.remove_zerovariance,
+            variance_tol=self.inputs.variance_tol,
+            intensity_normalization=self.inputs.intensity_normalization,
+        )
+        for key, values in zip(("std", "nstd"), dvars):
+            self._results[f"out_{key}"] = fname_presuffix(
+                self.inputs.in_file,
+                suffix=f"_dvars_{key}.tsv",
+                newpath=runtime.cwd,
+                use_ext=False,
+            )
+            np.savetxt(self._results[f"out_{key}"], values, fmt="%0.6f")
+
+        # CompCor
+        skip_vols = self.inputs.ignore_initial_volumes
+        series = series[:, skip_vols:]
+        if isdefined(self.inputs.variance_threshold):
+            criterion = self.inputs.variance_threshold
+        elif isdefined(self.inputs.num_components):
+            criterion = self.inputs.num_components
+        else:
+            criterion = 6
+            LOGGER.warning(
+                "`num_components` and `variance_threshold` are not defined. "
+                "Setting number of components to 6."
+            )
+        tr = (
+            self.inputs.repetition_time
+            if isdefined(self.inputs.repetition_time)
+            else _repetition_time(img)
+        )
+        kwargs = {
+            "components_criterion": criterion,
+            "repetition_time": tr,
+            "period_cut": self.inputs.high_pass_cutoff,
+            "failure_mode": self.inputs.failure_mode,
+        }
+
+        # tCompCor: select the most variable voxels (after removing quadratic trends)
+        tcc_series = series[tcc_rows]
+        tstd = _compute_tSTD(regress_poly(2, tcc_series)[0], 0, axis=-1)
+        threshold = np.percentile(
+            tstd,
+            np.round(100.0 * (1.0 - self.inputs.percentile_threshold)).astype(int),
+        )
+        high_variance = tstd >= threshold
+        mask_data = np.zeros_like(tcc_mask)
+        mask_data[tcc_mask] = high_variance
+        self._results["high_variance_mask"] = os.path.join(
+            runtime.cwd, "mask_000.nii.gz"
+        )
+        nb.Nifti1Image(mask_data, tcc_img.affine, tcc_img.header).to_filename(
+            self._results["high_variance_mask"]
+        )
+
+        components, basis, metadata = _noise_components(
+            [tcc_series[high_variance]], [0], **kwargs
+        )
+        del tcc_series
+        (
+            self._results["tcompcor_file"],
+            self._results["tcompcor_metadata"],
+        ) = _write_compcor(
+            components, metadata, "t_comp_cor_", skip_vols, runtime.cwd, "tcompcor"
+        )
+        self._results["pre_filter_file"] = _write_pre_filter(
+            basis, skip_vols, img.shape[3], os.path.join(runtime.cwd, "pre_filter.tsv")
+        )
+
+        # aCompCor
+        names = (
+            self.inputs.acompcor_names
+            if isdefined(self.inputs.acompcor_names)
+            else list(range(len(acc_rows)))
+        )
+        components, _, metadata = _noise_components(
+            (series[r] for r in acc_rows), names, **kwargs
+        )
+        (
+            self._results["acompcor_file"],
+            self._results["acompcor_metadata"],
+        ) = _write_compcor(
+            components, metadata, "a_comp_cor_", skip_vols, runtime.cwd, "acompcor"
+        )
+        return runtime
+
+
+def _stream_series(img, mask, rois, chunk_size=64):
+    """
+    Read a 4D series once, keeping the voxels within a mask.
+
+    The mean signal within each ROI (boolean arrays indexing the voxels kept)
+    is calculated in double precision as volumes are read.
+    Returns the time series of the voxels kept (``float32``, one row per voxel),
+    the mean signals (one column per ROI) and the first volume.
+
+    >>> data = np.arange(2 * 2 * 2 * 5, dtype="int16").reshape(2, 2, 2, 5)
+    >>> img = nb.Nifti1Image(data, np.eye(4))
+    >>> mask = data[..., 0] > 20
+    >>> series, signals, first = _stream_series(img, mask, [np.array([1, 0, 1], bool)], 2)
+    >>> series.shape, np.array_equal(series, data[mask])
+    ((3, 5), True)
+    >>> signals[:, 0].tolist()
+    [30.0, 31.0, 32.0, 33.0, 34.0]
+    >>> first.shape
+    (2, 2, 2)
+
+    """
+    nvols = img.shape[3]
+    series = np.zeros((np.count_nonzero(mask), nvols), dtype="float32")
+    signals = np.zeros((nvols, len(rois)))
+    first = None
+    for start in range(0, nvols, chunk_size):
+        stop = min(start + chunk_size, nvols)
+        block = np.asanyarray(img.dataobj[..., start:stop])
+        if first is None:
+            first = block[..., 0].astype("float32")
+        block = block[mask]
+        series[:, start:stop] = block
+        block = block.astype("float64")
+        for j, roi in enumerate(rois):
+            signals[start:stop, j] = block[roi].mean(axis=0)
+    return series, signals, first
+
+
+def _compute_dvars(
+    mfunc, remove_zerovariance=True, variance_tol=1e-7, intensity_normalization=1000
+):
+    """Calculate DVARS (as Nipype's ``compute_dvars``) from in-mask time series."""
+    import warnings
+    from nipype.algorithms.confounds import regress_poly, _AR_est_YW
+
+    if intensity_normalization != 0:
+        mfunc = (mfunc / np.median(mfunc)) * intensity_normalization
+
+    # Robust standard deviation ("lower" interpolation, as FSL)
+    try:
+        func_sd = (
+            np.percentile(mfunc, 75, axis=1, method="lower")
+            - np.percentile(mfunc, 25, axis=1, method="lower")
+        ) / 1.349
+    except TypeError:  # NP < 1.22
+        func_sd = (
+            np.percentile(mfunc, 75, axis=1, interpolation="lower")
+            - np.percentile(mfunc, 25, axis=1, interpolation="lower")
+        ) / 1.349
+
+    if remove_zerovariance:
+        zero_variance_voxels = func_sd > variance_tol
+        mfunc = mfunc[zero_variance_voxels, :]
+        func_sd = func_sd[zero_variance_voxels]
+
+    # Lag-1 autocorrelation, and predicted standard deviation of the differences
+    ar1 = np.apply_along_axis(
+        _AR_est_YW, 1, regress_poly(0, mfunc, remove_mean=True)[0].astype(np.float32), 1
+    )
+    diff_sdhat = np.squeeze(np.sqrt(((1 - ar1) * 2).tolist())) * func_sd
+    diff_sd_mean = diff_sdhat.mean()
+
+    func_diff = np.diff(mfunc, axis=1)
+    dvars_nstd = np.sqrt(np.square(func_diff).mean(axis=0))
+    dvars_stdz = dvars_nstd / diff_sd_mean
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings("error")
+        diff_vx_stdz = np.square(
+            func_diff / np.array([diff_sdhat] * func_diff.shape[-1]).T
+        )
+        dvars_vx_stdz = np.sqrt(diff_vx_stdz.mean(axis=0))
+
+    return dvars_stdz, dvars_nstd, dvars_vx_stdz
+
+
+def _repetition_time(img):
+    """Read the repetition time (in seconds) from the header, as CompCor does."""
+    try:
+        tr = img.header.get_zooms()[3]
+        if img.header.get_xyzt_units()[1] == "msec":
+            tr /= 1000
+    except (AttributeError, IndexError):
+        tr = 0
+    if tr == 0:
+        raise ValueError(
+            "Cannot detect repetition time from image - Set the repetition_time input"
+        )
+    return tr
+
+
+def _noise_components(
+    timecourses,
+    names,
+    components_criterion=0.5,
+    filter_type="cosine",
+    degree=0,
+    repetition_time=None,
+    period_cut=128,
+    failure_mode="error",
+):
+    """
+    Decompose the filtered time series of each mask (as Nipype's CompCor).
+
+    ``timecourses`` yields one array of time series (one row per voxel) per
+    mask, so that only one of them needs to be held in memory at a time.
+    Decompositions are calculated with :py:func:`compcor_svd`.
+
+    """
+    from collections import OrderedDict
+    from itertools import chain
+    from nipype.algorithms.confounds import cosine_filter, regress_poly, _compute_tSTD
+
+    basis = np.array([])
+    if components_criterion == "all":
+        components_criterion = -1
+
+    components = []
+    md_mask, md_sv, md_var, md_cumvar, md_retained = [], [], [], [], []
+    for name, voxel_timecourses in zip(names, timecourses):
+        # Zero-out any bad values
+        voxel_timecourses[np.isnan(np.sum(voxel_timecourses, axis=1)), :] = 0
+        if filter_type == "cosine":
+            if repetition_time is None:
+                raise ValueError("Repetition time must be provided for cosine filter")
+            voxel_timecourses, basis = cosine_filter(
+                voxel_timecourses, repetition_time, period_cut, failure_mode=failure_mode
+            )
+        elif filter_type in ("polynomial", False):
+            voxel_timecourses, basis = regress_poly(
+                degree, voxel_timecourses, failure_mode=failure_mode
+            )
+
+        M = voxel_timecourses.T
+        M = M / _compute_tSTD(M, 1.0)
+        try:
+            u, s = compcor_svd(M, components_criterion)
+        except (np.linalg.LinAlgError, ValueError):
+            if failure_mode == "error":
+                raise
+            s = np.full(M.shape[0], np.nan, dtype=np.float32)
+            u = np.full(
+                (M.shape[0], components_criterion if components_criterion >= 1 else 1),
+                np.nan,
+                dtype=np.float32,
+            )
+
+        variance_explained = (s ** 2) / np.sum(s ** 2)
+        cumulative_variance_explained = np.cumsum(variance_explained)
+        num_components = _num_components(s, components_criterion)
+        if num_components == 0:
+            break
+
+        components.append(u[:, :num_components])
+        md_mask.append([name] * len(s))
+        md_sv.append(s)
+        md_var.append(variance_explained)
+        md_cumvar.append(cumulative_variance_explained)
+        md_retained.append([i < num_components for i in range(len(s))])
+
+    if len(components) > 0:
+        components = np.hstack(components)
+    else:
+        if failure_mode == "error":
+            raise ValueError("No components found")
+        components = np.full((M.shape[0], num_components), np.nan, dtype=np.float32)
+
+    metadata = OrderedDict(
+        [
+            ("mask", list(chain(*md_mask))),
+            ("singular_value", np.hstack(md_sv)),
+            ("variance_explained", np.hstack(md_var)),
+            ("cumulative_variance_explained", np.hstack(md_cumvar)),
+            ("retained", list(chain(*md_retained))),
+        ]
+    )
+    return components, basis, metadata
+
+
+def compcor_svd(M, components_criterion=0.5):
+    """
+    Calculate the leading left-singular vectors and all singular values of ``M``.
+
+    Instead of a full SVD of the (time points × voxels) matrix ``M``, the
+    smallest of its two Gram matrices is eigendecomposed: all eigenvalues (the
+    squared singular values, which CompCor's metadata reports) are calculated,
+    but only the eigenvectors of the components retained by
+    ``components_criterion`` (a number of components, a fraction of the
+    variance, or ``-1``/``"all"``).
+    Should the eigensolver fail, the SVD is calculated with LAPACK's ``gesvd``
+    driver (slower, but more robust than the default ``gesdd``).
+    The sign of each vector is fixed so that its largest entry is positive.
+
+    >>> rng = np.random.default_rng(0)
+    >>> M = rng.standard_normal((50, 200)) @ np.diag(np.linspace(2, 1, 200))
+    >>> u, s = compcor_svd(M, 3)
+    >>> u.shape, s.shape
+    ((50, 3), (50,))
+    >>> u_full, s_full, _ = np.linalg.svd(M, full_matrices=False)
+    >>> np.allclose(s, s_full), np.allclose(np.abs(u), np.abs(u_full[:, :3]))
+    (True, True)
+    >>> u, s = compcor_svd(M.T, 0.5)  # more time points than voxels
+    >>> np.allclose(s, s_full), np.allclose(np.abs(u), np.abs(u_full[:, :15].T @ M).T / s[:15])
+    (True, True)
+
+    """
+    from scipy import linalg
+
+    if min(M.shape) == 0:
+        raise ValueError(f"Cannot decompose an empty matrix (shape {M.shape}).")
+    if components_criterion == "all":
+        components_criterion = -1
+
+    ntime, nvox = M.shape
+    try:
+        gram = M @ M.T if ntime <= nvox else M.T @ M
+        s = np.sqrt(np.clip(linalg.eigvalsh(gram)[::-1], 0, None))
+        num_components = min(_num_components(s, components_criterion), len(s))
+        if num_components == 0:
+            return np.zeros((ntime, 0)), s
+        _, vectors = linalg.eigh(
+            gram, subset_by_index=[len(s) - num_components, len(s) - 1]
+        )
+        u = vectors[:, ::-1]
+        if ntime > nvox:
+            u = (M @ u) / s[:num_components]
+    except (linalg.LinAlgError, np.linalg.LinAlgError):
+        u, s, _ = linalg.svd(M, full_matrices=False, lapack_driver="gesvd")
+        u = u[:, : _num_components(s, components_criterion)]
+
+    return u * np.sign(u[np.abs(u).argmax(axis=0), np.arange(u.shape[1])]), s
+
+
+def _num_components(s, components_criterion):
+    """Number of components retained by CompCor given the singular values."""
+    if 0 < components_criterion < 1:
+        variance_explained = (s ** 2) / np.sum(s ** 2)
+        return int(np.searchsorted(np.cumsum(variance_explained), components_criterion) + 1)
+    if components_criterion == -1:
+        return len(s)
+    return int(components_criterion)
+
+
+def _write_compcor(components, metadata, header_prefix, skip_vols, newpath, prefix):
+    """Write CompCor components and their metadata in the formats of Nipype's CompCor."""
+    if skip_vols:
+        padded = np.zeros(
+            (skip_vols + components.shape[0], components.shape[1]),
+            dtype=components.dtype,
+        )
+        padded[skip_vols:] = components
+        components = padded
+
+    components_file = os.path.join(newpath, f"{prefix}.tsv")
+    header = [f"{header_prefix}{i:02d}" for i in range(components.shape[1])]
+    np.savetxt(
+        components_file,
+        components,
+        fmt="%.10f",
+        delimiter="\t",
+        header="\t".join(header),
+        comments="",
+    )
+
+    metadata_file = os.path.join(newpath, f"{prefix}_metadata.tsv")
+    names = np.empty(len(metadata["mask"]), dtype="object_")
+    retained = np.where(metadata["retained"])
+    not_retained = np.where(np.logical_not(metadata["retained"]))
+    names[retained] = header
+    names[not_retained] = [f"dropped{i}" for i in range(len(not_retained[0]))]
+    with open(metadata_file, "w") as f:
+        f.write("\t".join(["component"] + list(metadata.keys())) + "\n")
+        for i in zip(names, *metadata.values()):
+            f.write(
+                "{0[0]}\t{0[1]}\t{0[2]:.10f}\t"
+                "{0[3]:.10f}\t{0[4]:.10f}\t{0[5]}\n".format(i)
+            )
+    return components_file, metadata_file
+
+
+def _write_pre_filter(basis, skip_vols, nrows, out_file):
+    """Write the cosine basis (and the non-steady-state outliers) of CompCor."""
+    ncols = basis.shape[1] if basis.size > 0 else 0
+    header = [f"Cosine{i:02d}" for i in range(ncols)]
+    if skip_vols:
+        padded = np.zeros((nrows, ncols + skip_vols), dtype=basis.dtype)
+        if basis.size > 0:
+            padded[skip_vols:, :ncols] = basis
+        padded[:skip_vols, -skip_vols:] = np.eye(skip_vols)
+        header.extend([f"NonSteadyStateOutlier{i:02d}" for i in range(skip_vols)])
+        basis = padded
+    np.savetxt(
+        out_file, basis, fmt="%.10f", delimiter="\t", header="\t".join(header), comments=""
+    )
+    return out_file
+
+
+class CarpetDataInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="input BOLD time-series (4D file)")
+    in_mask = File(exists=True, desc="3D brain mask")
+    in_segm = File(exists=True, desc="resampled segmentation")
+    max_rows = traits.Int(
+        MAX_ROWS, usedefault=True, desc="maximum number of voxels (rows) kept"
+    )
+    max_timepoints = traits.Int(
+        MAX_TIMEPOINTS,
+        usedefault=True,
+        desc="maximum number of time points (columns) kept",
+    )
+    detrend = traits.Bool(
+        True, usedefault=True, desc="detrend and standardize the voxel time courses"
+    )
+    chunk_size = traits.Int(
+        CHUNK_VOLS, usedefault=True, nohash=True, desc="number of volumes read at once"
+    )
+
+
+class CarpetDataOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="the carpet data (a NumPy .npz archive)")
+
+
+class CarpetData(SimpleInterface):
+    """
+    Extract the data of a carpet plot, streaming the BOLD series once.
+
+    See :py:func:`~fprodents.utils.carpet.carpet_data`.
+
+    """
+
+    input_spec = CarpetDataInputSpec
+    output_spec = CarpetDataOutputSpec
+
+    def _run_interface(self, runtime):
+        self._results["out_file"] = fname_presuffix(
+            self.inputs.in_file,
+            suffix="_carpet.npz",
+            use_ext=False,
+            newpath=runtime.cwd,
+        )
+        carpet = carpet_data(
+            self.inputs.in_file,
+            in_mask=self.inputs.in_mask if isdefined(self.inputs.in_mask) else None,
+            in_segm=self.inputs.in_segm if isdefined(self.inputs.in_segm) else None,
+            max_rows=self.inputs.max_rows,
+            max_timepoints=self.inputs.max_timepoints,
+            detrend=self.inputs.detrend,
+            chunk_size=self.inputs.chunk_size,
+        )
+        save_carpet(carpet, self._results["out_file"])
+        return runtime
+
+
 class FMRISummaryInputSpec(BaseInterfaceInputSpec):
     in_func = File(
         exists=True,
         mandatory=True,
+        xor=["in_carpet"],
         desc="input BOLD time-series (4D file) or dense timeseries CIFTI",
     )
+    in_carpet = File(
+        exists=True,
+        mandatory=True,
+        xor=["in_func"],
+        desc="carpet data extracted by CarpetData (instead of in_func)",
+    )
+    raster = traits.Bool(
+        False,
+        usedefault=True,
+        desc="rasterize the plotted data (embedded as PNG into the SVG) when "
+        "plotting from in_carpet",
+    )
+    label_names = traits.Dict(
+        traits.Int, traits.Str, desc="names of the labels of the carpet data"
+    )
     in_mask = File(exists=True, desc="3D brain mask")
     in_segm = File(exists=True, desc="resampled segmentation")
     confounds_file = File(exists=True, desc="BIDS' _confounds.tsv file")
@@ -345,7 +1108,10 @@ class FMRISummaryOutputSpec(TraitedSpec):
 
 class FMRISummary(SimpleInterface):
     """
-    Copy the x-form matrices from `hdr_file` to `out_file`.
+    Plot confounds time series above the carpet plot of a BOLD series.
+
+    The carpet is rendered from the data cached by :py:class:`CarpetData`
+    (``in_carpet``), or else from the full series (``in_func``).
     """
 
     input_spec = FMRISummaryInputSpec
@@ -355,20 +1121,15 @@ class FMRISummary(SimpleInterface):
         from niworkflows.viz.plots import fMRIPlot
 
         self._results["out_file"] = fname_presuffix(
-            self.inputs.in_func,
+            self.inputs.in_carpet
+            if isdefined(self.inputs.in_carpet)
+            else self.inputs.in_func,
             suffix="_fmriplot.svg",
             use_ext=False,
             newpath=runtime.cwd,
         )
 
-        dataframe = pd.read_csv(
-            self.inputs.confounds_file,
-            sep="\t",
-            index_col=None,
-            dtype="float32",
-            na_filter=True,
-            na_values="n/a",
-        )
+        dataframe = read_confounds(self.inputs.confounds_file).astype("float32")
 
         headers = []
         units = {}
@@ -398,6 +1159,22 @@ class FMRISummary(SimpleInterface):
 
         data.columns = colnames
 
+        if isdefined(self.inputs.in_carpet):
+            fig = plot_summary(
+                load_carpet(self.inputs.in_carpet),
+                confounds=data,
+                units=units,
+                tr=self.inputs.tr,
+                label_names=(
+                    self.inputs.label_names
+                    if isdefined(self.inputs.label_names)
+                    else None
+                ),
+                raster=self.inputs.raster,
+            )
+            fig.savefig(self._results["out_file"], bbox_inches="tight")
+            return runtime
+
         fig = fMRIPlot(
             self.inputs.in_func,
             mask_file=self.inputs.in_mask if isdefined(self.inputs.in_mask) else None,
@@ -408,3 +1185,104 @@ class FMRISummary(SimpleInterface):
         ).plot()
         fig.savefig(self._results["out_file"], bbox_inches="tight")
         return runtime
+
+
+class ConfoundsCorrelationPlot(nwplotting.ConfoundsCorrelationPlot):
+    """Plot the correlation among confound regressors, reading binary sidecars."""
+
+    def _run_interface(self, runtime):
+        if self.inputs.out_file is None:
+            self._results["out_file"] = fname_presuffix(
+                self.inputs.confounds_file,
+                suffix="_confoundCorrelation.svg",
+                use_ext=False,
+                newpath=runtime.cwd,
+            )
+        else:
+            self._results["out_file"] = self.inputs.out_file
+        _confounds_correlation_plot(
+            read_confounds(self.inputs.confounds_file),
+            self._results["out_file"],
+            columns=self.inputs.columns if isdefined(self.inputs.columns) else None,
+            max_dim=self.inputs.max_dim,
+            reference=self.inputs.reference_column,
+            ignore_initial_volumes=self.inputs.ignore_initial_volumes,
+        )
+        return runtime
+
+
+def _confounds_correlation_plot(
+    confounds_data,
+    output_file,
+    columns=None,
+    max_dim=20,
+    reference="global_signal",
+    ignore_initial_volumes=0,
+):
+    """
+    Plot the correlations among confounds, and their magnitude with ``reference``.
+
+    Same as :py:func:`niworkflows.viz.plots.confounds_correlation_plot`, but for a
+    table already read.
+
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib import gridspec as mgs
+    import seaborn as sns
+
+    if columns:
+        columns = dict.fromkeys(columns)  # Drop duplicates
+        columns[reference] = None  # Make sure the reference is included
+        confounds_data = confounds_data[list(columns)]
+
+    confounds_data = confounds_data.loc[
+        ignore_initial_volumes:,
+        np.logical_not(np.isclose(confounds_data.var(skipna=True), 0)),
+    ]
+    corr = confounds_data.corr()
+
+    gscorr = corr.copy()
+    gscorr["index"] = gscorr.index
+    gscorr[reference] = np.abs(gscorr[reference])
+    gs_descending = gscorr.sort_values(by=reference, ascending=False)["index"]
+    gs_descending = gs_descending[: min(corr.shape[0], max_dim)]
+    features = [p for p in corr.columns if p in gs_descending]
+    corr = corr.loc[features, features]
+    corr = corr.mask(np.eye(len(features), dtype=bool), 0)
+
+    plt.figure(figsize=(15, 5))
+    gs = mgs.GridSpec(1, 21)
+    ax0 = plt.subplot(gs[0, :10])
+    ax1 = plt.subplot(gs[0, 11:])
+
+    sns.heatmap(corr, linewidths=0.5, cmap="coolwarm", center=0, square=True, ax=ax0)
+    ax0.tick_params(axis="both", which="both", width=0)
+    for label in ax0.xaxis.get_majorticklabels() + ax0.yaxis.get_majorticklabels():
+        label.set_fontsize("small")
+
+    sns.barplot(
+        data=gscorr,
+        x="index",
+        y=reference,
+        ax=ax1,
+        order=gs_descending,
+        palette="Reds_d",
+        saturation=0.5,
+    )
+    ax1.set_xlabel("Confound time series")
+    ax1.set_ylabel("Magnitude of correlation with {}".format(reference))
+    ax1.tick_params(axis="x", which="both", width=0)
+    ax1.tick_params(axis="y", which="both", width=5, length=5)
+    for label in ax1.xaxis.get_majorticklabels():
+        label.set_fontsize("small")
+        label.set_rotation("vertical")
+    for label in ax1.yaxis.get_majorticklabels():
+        label.set_fontsize("small")
+    for side in ["top", "right", "left"]:
+        ax1.spines[side].set_color("none")
+        ax1.spines[side].set_visible(False)
+
+    figure = plt.gcf()
+    figure.savefig(output_file, bbox_inches="tight")
+    plt.close(figure)
+    return output_file
@@ -1,3 +1,16 @@
+"""
+Head-motion correction interfaces.
+
+Besides the conversion of AFNI's ``3dVolreg`` outputs (:py:class:`Volreg2ITK`),
+this module implements a rigid-body motion estimation in-process
+(:py:class:`RigidHMC`): each volume is aligned to the reference by least squares
+(as ``3dVolreg`` does), with Gauss-Newton iterations linearized on the gradients
+of the reference (which are calculated only once), from coarse to fine
+resolution levels.
+Volumes are registered in parallel by a pool of threads.
+
+"""
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from nipype.utils.filemanip import fname_presuffix
@@ -6,57 +19,285 @@ from nipype.interfaces.base import (
     TraitedSpec,
     SimpleInterface,
     File,
+    traits,
 )
 import numpy as np
+import nibabel as nb
+
+#: Subsampling factors (in voxels) of the resolution levels, from coarse to fine.
+LEVELS = (4, 2, 1)
+#: Maximum number of Gauss-Newton iterations per resolution level.
+MAX_ITER = 20
+#: Convergence criterion: largest update of the translations (mm) and rotations (rad).
+TOLERANCE = 1e-4
 
 
 class Volreg2ITKInputSpec(BaseInterfaceInputSpec):
     in_file = File(
         exists=True, mandatory=True, desc="mat file generated by AFNI's 3dVolreg"
     )
+    itk_text = traits.Bool(
+        True, usedefault=True, desc="also export the affines as an ITK text file"
+    )
 
 
 class Volreg2ITKOutputSpec(TraitedSpec):
     out_file = File(desc="the output ITKTransform file")
+    out_stack = File(desc="the affines as a binary transform stack")
 
 
 class Volreg2ITK(SimpleInterface):
 
     """
-    Convert an AFNI's mat file into an ITK Transform file.
+    Convert an AFNI's mat file into a binary transform stack (and an ITK Transform file).
+
+    AFNI's matrices are defined in LPS coordinates, and therefore map directly
+    onto the parameters of ITK's affines.
+    See :py:func:`~fprodents.utils.transforms.save_xfm_stack` for the format of
+    the stack.
     """
 
     input_spec = Volreg2ITKInputSpec
     output_spec = Volreg2ITKOutputSpec
 
     def _run_interface(self, runtime):
+        from ..utils.transforms import RAS2LPS, itk_affines, save_xfm_stack
+
         # Load AFNI mat entries and reshape appropriately
-        orig_afni_mat = np.loadtxt(self.inputs.in_file)
-        afni_affines = [mat.reshape(3, 4, order="C") for mat in orig_afni_mat]
+        afni_affines = np.loadtxt(self.inputs.in_file, ndmin=2).reshape(-1, 3, 4)
+        lps = np.tile(np.eye(4), (afni_affines.shape[0], 1, 1))
+        lps[:, :3] = afni_affines
+        ras = RAS2LPS @ lps @ RAS2LPS
 
-        out_file = Path(
+        self._results["out_stack"] = save_xfm_stack(
+            ras,
             fname_presuffix(
                 self.inputs.in_file,
                 use_ext=False,
-                suffix="_mc4d_itk.txt",
+                suffix="_mc4d.npy",
                 newpath=runtime.cwd,
-            )
+            ),
         )
 
-        fixed_params = "FixedParameters: 0 0 0"  # Center of rotation does not change
-        lines = ["#Insight Transform File V1.0"]
-        for i, affine in enumerate(afni_affines):
-            lines.append("#Transform %d" % i)
-            lines.append("Transform: AffineTransform_double_3_3")
+        if self.inputs.itk_text:
+            out_file = Path(
+                fname_presuffix(
+                    self.inputs.in_file,
+                    use_ext=False,
+                    suffix="_mc4d_itk.txt",
+                    newpath=runtime.cwd,
+                )
+            )
+            out_file.write_text(itk_affines(ras))
+            self._results["out_file"] = str(out_file)
+        return runtime
+
+
+class RigidHMCInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="BOLD series (4D)")
+    ref_file = File(
+        exists=True, mandatory=True, desc="reference to which volumes are aligned"
+    )
+    in_mask = File(exists=True, desc="mask of the voxels of the reference to match")
+    levels = traits.List(
+        traits.Int,
+        list(LEVELS),
+        usedefault=True,
+        minlen=1,
+        desc="subsampling factors of the resolution levels, from coarse to fine",
+    )
+    itk_text = traits.Bool(
+        True, usedefault=True, desc="also export the affines as an ITK text file"
+    )
+    num_threads = traits.Int(1, usedefault=True, nohash=True, desc="number of threads")
+
 
-            ants_affine_2d = np.hstack(
-                (affine[:3, :3].reshape(1, -1), affine[:3, 3].reshape(1, -1))
+class RigidHMCOutputSpec(TraitedSpec):
+    out_file = File(desc="the output ITKTransform file")
+    out_stack = File(desc="the affines as a binary transform stack")
+    movpar_file = File(
+        desc="motion parameters in SPM format (X, Y, Z in mm, Rx, Ry, Rz in rad)"
+    )
+
+
+class RigidHMC(SimpleInterface):
+    """
+    Estimate head-motion with a rigid-body registration of every volume, in-process.
+
+    An alternative to ``3dVolreg`` followed by :py:class:`Volreg2ITK` and
+    :py:class:`~niworkflows.interfaces.confounds.NormalizeMotionParams`, writing
+    the same outputs (see :py:func:`estimate_motion`).
+    Rotations are reported about the center of the reference.
+    """
+
+    input_spec = RigidHMCInputSpec
+    output_spec = RigidHMCOutputSpec
+
+    def _run_interface(self, runtime):
+        from nipype.interfaces.base import isdefined
+        from ..utils.transforms import itk_affines, save_xfm_stack
+
+        mask = None
+        if isdefined(self.inputs.in_mask):
+            mask = np.asanyarray(nb.load(self.inputs.in_mask).dataobj) > 0
+        params, ras = estimate_motion(
+            nb.load(self.inputs.in_file),
+            nb.load(self.inputs.ref_file),
+            mask=mask,
+            levels=self.inputs.levels,
+            num_threads=self.inputs.num_threads,
+        )
+
+        def _out(suffix):
+            return fname_presuffix(
+                self.inputs.in_file, use_ext=False, suffix=suffix, newpath=runtime.cwd
             )
-            params = ants_affine_2d.reshape(-1).astype("float64")
-            params_list = ["%g" % i for i in params.tolist()]
-            lines.append("Parameters: %s" % " ".join(params_list))
-            lines.append(fixed_params)
 
-        out_file.write_text("\n".join(lines))
-        self._results["out_file"] = str(out_file)
+        self._results["out_stack"] = save_xfm_stack(ras, _out("_mc4d.npy"))
+        self._results["movpar_file"] = _out("_motion_params.txt")
+        np.savetxt(self._results["movpar_file"], params)
+        if self.inputs.itk_text:
+            out_file = Path(_out("_mc4d_itk.txt"))
+            out_file.write_text(itk_affines(ras))
+            self._results["out_file"] = str(out_file)
         return runtime
+
+
+def rigid_matrix(params, center):
+    """
+    Build the RAS affine of rigid-body parameters, rotating about ``center``.
+
+    ``params`` are the translations (mm) and the rotations (rad) about the
+    X, Y and Z axes (applied in that order).
+
+    >>> rigid_matrix([1.0, 0.0, 0.0, 0.0, 0.0, 0.0], [10.0, 0.0, 0.0])[:3, 3].tolist()
+    [1.0, 0.0, 0.0]
+    >>> matrix = rigid_matrix([0.0, 0.0, 0.0, 0.0, 0.0, np.pi / 2], [10.0, 0.0, 0.0])
+    >>> (matrix @ [10.0, 0.0, 0.0, 1.0]).round(6).tolist()
+    [10.0, 0.0, 0.0, 1.0]
+    >>> (matrix @ [11.0, 0.0, 0.0, 1.0]).round(6).tolist()
+    [10.0, 1.0, 0.0, 1.0]
+
+    """
+    from scipy.spatial.transform import Rotation
+
+    params = np.asanyarray(params, dtype="float64")
+    center = np.asanyarray(center, dtype="float64")
+    matrix = np.eye(4)
+    matrix[:3, :3] = Rotation.from_euler("xyz", params[3:]).as_matrix()
+    matrix[:3, 3] = center + params[:3] - matrix[:3, :3] @ center
+    return matrix
+
+
+def estimate_motion(img, ref_img, mask=None, levels=LEVELS, num_threads=1):
+    """
+    Align every volume of a series to a reference with rigid-body transforms.
+
+    Returns the motion parameters (N by 6, see :py:func:`rigid_matrix`) and the
+    corresponding (N, 4, 4) affines mapping RAS coordinates of the reference onto
+    each volume (the convention of ITK transforms, after conversion from LPS).
+
+    >>> from scipy import ndimage as ndi
+    >>> rng = np.random.default_rng(0)
+    >>> ref = ndi.gaussian_filter(rng.standard_normal((24, 24, 16)), 2.0) + 1.0
+    >>> affine = np.diag([0.5, 0.5, 0.8, 1.0])
+    >>> motion = rigid_matrix([0.3, -0.2, 0.1, 0.02, 0.0, -0.03], [5.75, 5.75, 6.0])
+    >>> vox = np.linalg.inv(affine) @ motion @ affine
+    >>> moved = ndi.affine_transform(ref, vox, order=3, mode="nearest")
+    >>> img = nb.Nifti1Image(np.stack((ref, moved), axis=-1), affine)
+    >>> params, matrices = estimate_motion(img, nb.Nifti1Image(ref, affine))
+    >>> bool(np.abs(params[0]).max() < 1e-6)
+    True
+    >>> bool(np.abs(matrices[1] @ motion - np.eye(4)).max() < 5e-3)
+    True
+
+    """
+    ref_data = np.asanyarray(ref_img.dataobj, dtype="float32")
+    center = nb.affines.apply_affine(
+        ref_img.affine, (np.array(ref_data.shape) - 1) / 2.0
+    )
+    targets = [
+        _prepare_level(ref_data, ref_img.affine, center, factor, mask=mask)
+        for factor in levels
+    ]
+    to_vox = np.linalg.inv(img.affine)
+    nvols = img.shape[3] if img.ndim > 3 else 1
+
+    def _register(data):
+        params = np.zeros(7)  # The last parameter scales intensities
+        for target in targets:
+            params = _register_level(data, target, to_vox, center, params)
+        return params[:6]
+
+    # Read volumes sequentially (compressed inputs are decompressed only once)
+    # in blocks that bound the memory held in flight.
+    block = max(num_threads, 1) * 4
+    params = np.zeros((nvols, 6))
+    with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as pool:
+        for start in range(0, nvols, block):
+            stop = min(start + block, nvols)
+            if img.ndim > 3:
+                data = np.asanyarray(img.dataobj[..., start:stop], dtype="float32")
+            else:
+                data = np.asanyarray(img.dataobj, dtype="float32")[..., np.newaxis]
+            params[start:stop] = list(
+                pool.map(_register, [data[..., i] for i in range(stop - start)])
+            )
+
+    matrices = np.stack([rigid_matrix(p, center) for p in params])
+    return params, matrices
+
+
+def _prepare_level(ref_data, affine, center, factor, mask=None):
+    """Sample the (smoothed) reference and the Jacobian of the residuals once."""
+    from scipy import ndimage as ndi
+
+    sigma = factor / 2.0 if factor > 1 else 0.0
+    smoothed = ndi.gaussian_filter(ref_data, sigma) if sigma else ref_data
+
+    # Voxels (subsampled) within the mask or above 10% of the robust maximum
+    grid = np.zeros(ref_data.shape, dtype=bool)
+    grid[tuple(slice(factor // 2, None, factor) for _ in range(3))] = True
+    if mask is None:
+        mask = smoothed > 0.1 * np.percentile(smoothed, 98)
+    ijk = np.argwhere(grid & mask)
+
+    # Gradients of the reference in RAS (the chain rule through the voxel axes)
+    gradients = np.stack(np.gradient(smoothed), axis=-1)[tuple(ijk.T)]
+    gradients = gradients @ np.linalg.inv(affine[:3, :3])
+    points = nb.affines.apply_affine(affine, ijk)
+
+    # Derivatives of the residuals w.r.t. translations, rotations and scaling
+    values = smoothed[tuple(ijk.T)].astype("float64")
+    jacobian = np.hstack(
+        (gradients, np.cross(points - center, gradients), -values[:, np.newaxis])
+    )
+    return {
+        "sigma": sigma,
+        "points": points,
+        "values": values,
+        "jacobian": jacobian,
+    }
+
+
+def _register_level(data, target, to_vox, center, params):
+    """Run Gauss-Newton iterations at one resolution level."""
+    from scipy import ndimage as ndi
+
+    params = params.copy()
+    if target["sigma"]:
+        data = ndi.gaussian_filter(data, target["sigma"])
+    for _ in range(MAX_ITER):
+        vox = to_vox @ rigid_matrix(params[:6], center)
+        ijk = target["points"] @ vox[:3, :3].T + vox[:3, 3]
+        sampled = ndi.map_coordinates(
+            data, ijk.T, order=1, mode="constant", cval=np.nan
+        )
+        valid = ~np.isnan(sampled)
+        jacobian = target["jacobian"][valid]
+        residuals = sampled[valid] - (1.0 + params[6]) * target["values"][valid]
+        update = -np.linalg.lstsq(jacobian, residuals, rcond=None)[0]
+        params += update
+        if np.abs(update[:6]).max() < TOLERANCE:
+            break
+    return params
@@ -8,6 +8,14 @@ Multi-echo EPI
 
 For using multi-echo EPI data.
 
+Besides the wrapper of *tedana*'s ``t2smap``, the T2* decay may be fitted in-process
+(:py:class:`FitT2SMap`).
+Fitting the decay to all samples of a voxel (every echo at every time point) is
+equivalent to fitting it to the temporal mean of each echo (its logarithm for the
+log-linear fit), so the echoes are streamed once to accumulate those means, fitted for
+all voxels at once, and streamed again to write the optimal combination, holding only a
+chunk of volumes in memory.
+
 Change directory to provide relative paths for doctests
 >>> import os
 >>> filepath = os.path.dirname( os.path.realpath( __file__ ) )
@@ -17,17 +25,30 @@ Change directory to provide relative paths for doctests
 """
 import os
 
+import numpy as np
+import nibabel as nb
 from nipype import logging
 from nipype.interfaces.base import (
     traits,
     TraitedSpec,
+    BaseInterfaceInputSpec,
     File,
     CommandLine,
     CommandLineInputSpec,
+    SimpleInterface,
 )
 
+from ..utils.images import CHUNK_VOLS, SeriesWriter
+
 LOGGER = logging.getLogger("nipype.interface")
 
+#: Number of voxels refined at once by the monoexponential fit.
+BLOCK_SIZE = 2 ** 14
+#: Maximum number of iterations of the monoexponential fit.
+MAX_ITER = 50
+#: Relative change of the residual sum of squares stopping the monoexponential fit.
+TOLERANCE = 1e-6
+
 
 class T2SMapInputSpec(CommandLineInputSpec):
     in_files = traits.List(
@@ -103,3 +124,323 @@ sub-01_run-01_echo-3_bold.nii.gz -e 13.0 27.0 43.0 --fittype curvefit'
         outputs["s0_map"] = os.path.join(out_dir, "S0map.nii.gz")
         outputs["optimal_comb"] = os.path.join(out_dir, "desc-optcom_bold.nii.gz")
         return outputs
+
+
+class FitT2SMapInputSpec(BaseInterfaceInputSpec):
+    in_files = traits.List(
+        File(exists=True), mandatory=True, minlen=3, desc="multi-echo BOLD EPIs"
+    )
+    echo_times = traits.List(
+        traits.Float, mandatory=True, minlen=3, desc="echo times (s)"
+    )
+    fittype = traits.Enum(
+        "curvefit",
+        "loglin",
+        usedefault=True,
+        desc=(
+            '"loglin" fits a linear model to the log of the data, "curvefit" '
+            "refines it with a monoexponential model fit to the raw data"
+        ),
+    )
+    block_size = traits.Int(
+        BLOCK_SIZE, usedefault=True, nohash=True, desc="voxels refined at once"
+    )
+    compress = traits.Bool(True, usedefault=True, desc="write compressed NIfTIs")
+    num_threads = traits.Int(1, usedefault=True, nohash=True, desc="number of threads")
+
+
+class FitT2SMap(SimpleInterface):
+    """
+    Estimate an adaptive T2* map and optimally combine ME-EPI, in-process.
+
+    Follows the ``t2smap`` workflow of *tedana*: an adaptive mask counts the echoes
+    with reliable signal in each voxel, only those are fitted (at least two) and
+    combined, and the T2* map (in s) and S0 map are limited to the voxels with at
+    least two reliable echoes, the former also to ten times its 99.5th percentile.
+    Outputs have the names of those of :py:class:`T2SMap`.
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> rng = np.random.default_rng(1234)
+    >>> tes = [0.013, 0.027, 0.043]
+    >>> t2s = rng.uniform(20, 60, size=(4, 4, 3))
+    >>> s0 = rng.uniform(500, 1500, size=(4, 4, 3, 1))
+    >>> signal = s0 * (1 + 0.02 * rng.standard_normal((4, 4, 3, 10)))
+    >>> for i, te in enumerate(tes):
+    ...     decay = np.exp(-te * 1000 / t2s)[..., np.newaxis]
+    ...     fname = os.path.join(tmpdir, f"echo-{i + 1}.nii.gz")
+    ...     nb.Nifti1Image(signal * decay, np.eye(4)).to_filename(fname)
+    >>> fit = FitT2SMap(
+    ...     in_files=[os.path.join(tmpdir, f"echo-{i + 1}.nii.gz") for i in range(3)],
+    ...     echo_times=tes,
+    ... ).run(cwd=tmpdir)
+    >>> os.path.basename(fit.outputs.optimal_comb)
+    'desc-optcom_bold.nii.gz'
+    >>> t2star_map = nb.load(fit.outputs.t2star_map).get_fdata()
+    >>> bool(np.allclose(t2star_map, t2s / 1000, rtol=1e-4))
+    True
+    >>> nb.load(fit.outputs.optimal_comb).shape
+    (4, 4, 3, 10)
+
+    """
+
+    input_spec = FitT2SMapInputSpec
+    output_spec = T2SMapOutputSpec
+
+    def _run_interface(self, runtime):
+        if len(self.inputs.in_files) != len(self.inputs.echo_times):
+            raise ValueError(
+                f"Number of echoes ({len(self.inputs.in_files)}) does not match the "
+                f"number of echo times ({len(self.inputs.echo_times)})."
+            )
+
+        imgs = [nb.load(fname, keep_file_open=True) for fname in self.inputs.in_files]
+        shape = imgs[0].shape
+        if len(shape) != 4 or any(img.shape != shape for img in imgs[1:]):
+            raise ValueError("Echoes must be 4D series of the same shape.")
+
+        tes = 1000 * np.array(self.inputs.echo_times, dtype="float64")
+        means, log_means = echo_means(imgs)
+        masksum = adaptive_mask(means)
+        t2s, s0, t2s_full = fit_decay(
+            tes,
+            means,
+            log_means,
+            masksum,
+            fittype=self.inputs.fittype,
+            block_size=self.inputs.block_size,
+            num_threads=self.inputs.num_threads,
+        )
+        weights = optcom_weights(tes, t2s_full, masksum)
+
+        ext = ".nii.gz" if self.inputs.compress else ".nii"
+        header = imgs[0].header.copy()
+        header.set_data_dtype("float32")
+        for key, fname, data in (
+            ("t2star_map", "T2starmap", t2s / 1000),
+            ("s0_map", "S0map", s0),
+        ):
+            self._results[key] = os.path.join(runtime.cwd, fname + ext)
+            nb.Nifti1Image(
+                data.reshape(shape[:3]).astype("float32"), imgs[0].affine, header
+            ).to_filename(self._results[key])
+
+        self._results["optimal_comb"] = os.path.join(
+            runtime.cwd, "desc-optcom_bold" + ext
+        )
+        with SeriesWriter(
+            self._results["optimal_comb"],
+            shape,
+            imgs[0].affine,
+            header,
+            dtype="float32",
+            num_threads=self.inputs.num_threads,
+        ) as writer:
+            for start in range(0, shape[3], CHUNK_VOLS):
+                chunk = np.zeros(shape[:3] + (min(CHUNK_VOLS, shape[3] - start),))
+                for img, echo_weights in zip(imgs, weights.T):
+                    data = np.asanyarray(img.dataobj[..., start : start + CHUNK_VOLS])
+                    chunk += echo_weights.reshape(shape[:3] + (1,)) * data
+                writer.write(chunk)
+        return runtime
+
+
+def echo_means(imgs):
+    """
+    Calculate the temporal means of the signal and of its logarithm, for each echo.
+
+    Echoes are read :py:data:`~fprodents.utils.images.CHUNK_VOLS` volumes at a time.
+    The logarithm is taken of ``|signal| + 1``, as in *tedana*.
+    Both returned arrays are shaped (voxels, echoes).
+
+    >>> data = np.ones((2, 1, 1, 3))
+    >>> data[1] = np.e - 1
+    >>> means, log_means = echo_means([nb.Nifti1Image(data, np.eye(4))] * 2)
+    >>> means.shape, log_means[:, 0].round(6).tolist()
+    ((2, 2), [0.693147, 1.0])
+
+    """
+    nvols = imgs[0].shape[3]
+    means = np.zeros((np.prod(imgs[0].shape[:3]), len(imgs)))
+    log_means = np.zeros_like(means)
+    for i, img in enumerate(imgs):
+        for start in range(0, nvols, CHUNK_VOLS):
+            data = np.asanyarray(img.dataobj[..., start : start + CHUNK_VOLS])
+            data = data.reshape((means.shape[0], -1))
+            means[:, i] += data.sum(axis=1)
+            log_means[:, i] += np.log(np.abs(data) + 1).sum(axis=1)
+    return means / nvols, log_means / nvols
+
+
+def adaptive_mask(means):
+    """
+    Count the echoes with reliable signal in every voxel.
+
+    As in *tedana*, the signal of each echo is reliable where its mean exceeds a
+    third of that echo's mean in the voxel at the 33rd percentile of the (nonzero)
+    means of the first echo.
+
+    >>> means = np.array([[0.0, 0.0], [90.0, 20.0], [100.0, 50.0], [300.0, 5.0]])
+    >>> adaptive_mask(means).tolist()
+    [0, 2, 2, 1]
+
+    """
+    first = means[:, 0]
+    nonzero = first[first != 0]
+    if nonzero.size == 0:
+        return np.zeros(means.shape[0], dtype=int)
+    perc = np.percentile(nonzero, 33, method="higher")
+    thresholds = means[first == perc] / 3
+    # Keep the voxel with the highest signal if several are at the percentile
+    thresholds = thresholds[thresholds.sum(axis=1).argmax()]
+    return (np.abs(means) > thresholds).sum(axis=1)
+
+
+def fit_decay(
+    echo_times,
+    means,
+    log_means,
+    masksum,
+    fittype="curvefit",
+    block_size=BLOCK_SIZE,
+    num_threads=1,
+):
+    """
+    Fit the monoexponential decay of the signal with the echo time in every voxel.
+
+    Voxels are fitted with their first ``masksum`` echoes (at least two), with a
+    log-linear regression, optionally refined by a nonlinear least-squares fit
+    (:py:func:`_refine_block`) over blocks of ``block_size`` voxels, spread across
+    ``num_threads`` threads.
+    Voxels outside of the mask get zeros.
+    As *tedana*, returns "limited" T2* and S0 maps, which are also zero in voxels
+    with a single reliable echo and where T2* is limited to ten times its 99.5th
+    percentile, and the uncapped ("full") T2* map, which the optimal combination is
+    weighted by.
+
+    >>> tes = np.array([10.0, 20.0, 30.0])
+    >>> means = 1000 * np.exp(-tes / [[25.0], [40.0], [60.0]])
+    >>> t2s, s0, t2s_full = fit_decay(
+    ...     tes, means, np.log(means + 1), np.array([3, 2, 1])
+    ... )
+    >>> t2s.round(3).tolist(), s0.round(3).tolist(), t2s_full.round(3).tolist()
+    ([25.0, 40.0, 0.0], [1000.0, 1000.0, 0.0], [25.0, 40.0, 60.0])
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    nechoes = np.clip(masksum, 2, len(echo_times))
+    nechoes[masksum == 0] = 0
+    t2s = np.zeros(masksum.shape)
+    s0 = np.zeros(masksum.shape)
+    for n in range(2, len(echo_times) + 1):
+        voxels = nechoes == n
+        design = np.column_stack((np.ones(n), -echo_times[:n]))
+        intercept, rate = np.linalg.pinv(design) @ log_means[voxels, :n].T
+        with np.errstate(divide="ignore", over="ignore"):
+            t2s[voxels] = 1 / rate
+            s0[voxels] = np.exp(intercept)
+    t2s[np.isinf(t2s)] = 500.0
+    t2s[t2s <= 0] = 1.0
+    s0[np.isnan(s0)] = 0.0
+
+    if fittype == "curvefit":
+        indices = np.flatnonzero(nechoes)
+        blocks = [
+            indices[start : start + block_size]
+            for start in range(0, indices.size, block_size)
+        ]
+
+        def _fit(block):
+            t2s[block], s0[block] = _refine_block(
+                echo_times, means[block], nechoes[block], t2s[block], s0[block]
+            )
+
+        with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as pool:
+            list(pool.map(_fit, blocks))
+
+    t2s[nechoes == 0] = 0.0
+    t2s_full = t2s.copy()
+    limited = masksum > 1
+    t2s[~limited] = 0.0
+    s0[~limited] = 0.0
+    s0[s0 < 0] = 0.0
+    if t2s.size:
+        cap = np.percentile(t2s, 99.5, method="lower")
+        t2s[t2s > 10 * cap] = cap
+    return t2s, s0, t2s_full
+
+
+def _refine_block(echo_times, means, nechoes, t2s, s0):
+    """
+    Fit ``S0 * exp(-TE / T2*)`` to the mean signals of a block of voxels.
+
+    All voxels are updated at once with Levenberg-Marquardt steps (solving their
+    2x2 normal equations in closed form), starting from the log-linear estimates.
+    The sum of squares over all time points differs from that of the temporal means
+    by a constant, so both fits share their solution.
+    Voxels where the fit does not converge keep their initial estimates.
+
+    """
+    weights = np.arange(len(echo_times)) < nechoes[:, np.newaxis]
+    rate = 1 / t2s
+    amplitude = s0.copy()
+    damping = np.full(rate.shape, 1e-3)
+
+    def _residuals(amplitude, rate):
+        decay = np.exp(-np.outer(rate, echo_times))
+        residuals = weights * (means - amplitude[:, np.newaxis] * decay)
+        return decay, residuals, (residuals ** 2).sum(axis=1)
+
+    decay, residuals, cost = _residuals(amplitude, rate)
+    for _ in range(MAX_ITER):
+        jac_s0 = weights * decay
+        jac_rate = -amplitude[:, np.newaxis] * echo_times * jac_s0
+        a11 = (jac_s0 ** 2).sum(axis=1)
+        a12 = (jac_s0 * jac_rate).sum(axis=1)
+        a22 = (jac_rate ** 2).sum(axis=1)
+        b1 = (jac_s0 * residuals).sum(axis=1)
+        b2 = (jac_rate * residuals).sum(axis=1)
+        a11d = a11 * (1 + damping)
+        a22d = a22 * (1 + damping)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            det = a11d * a22d - a12 ** 2
+            new_amplitude = amplitude + (a22d * b1 - a12 * b2) / det
+            # T2* is bounded below by 0.1 ms, as in tedana
+            new_rate = np.clip(rate + (a11d * b2 - a12 * b1) / det, 1e-6, 10.0)
+        new_decay, new_residuals, new_cost = _residuals(new_amplitude, new_rate)
+
+        better = np.isfinite(new_cost) & (new_cost < cost)
+        converged = better & (cost - new_cost <= TOLERANCE * cost)
+        amplitude[better] = new_amplitude[better]
+        rate[better] = new_rate[better]
+        decay[better] = new_decay[better]
+        residuals[better] = new_residuals[better]
+        cost[better] = new_cost[better]
+        damping = np.where(better, damping / 10, damping * 10)
+        if converged.all() or (damping > 1e10).all():
+            break
+
+    return 1 / rate, amplitude
+
+
+def optcom_weights(echo_times, t2s, masksum):
+    """
+    Calculate the weights of each echo in the optimal combination of every voxel.
+
+    Echoes are weighted by ``TE * exp(-TE / T2*)`` [Posse1999]_, normalized to
+    sum up to one over the first ``masksum`` echoes of the voxel (the reliable ones).
+    As in *tedana*, voxels with a single reliable echo combine the first two.
+
+    >>> weights = optcom_weights(np.array([10.0, 20.0]), np.array([20.0, 20.0, 0.0]),
+    ...                          np.array([2, 1, 0]))
+    >>> weights.round(3).tolist()
+    [[0.45, 0.55], [0.45, 0.55], [0.0, 0.0]]
+
+    """
+    nechoes = np.where(masksum > 0, np.maximum(masksum, 2), 0)
+    with np.errstate(divide="ignore"):
+        weights = echo_times * np.exp(-echo_times / t2s[:, np.newaxis])
+    weights[np.arange(len(echo_times)) >= nechoes[:, np.newaxis]] = 0.0
+    total = weights.sum(axis=1, keepdims=True)
+    return np.divide(weights, total, out=np.zeros_like(weights), where=total > 0)
@@ -6,60 +6,91 @@ Temporary patches
 -----------------
 
 """
-
-from random import randint
-from time import sleep
-
-from numpy.linalg.linalg import LinAlgError
+import numpy as np
+import nibabel as nb
 from nipype.algorithms import confounds as nac
 from nipype.interfaces.base import traits
 from nipype.interfaces.fsl.preprocess import FAST, FASTInputSpec
 
 
-class RobustACompCor(nac.ACompCor):
+def compute_noise_components(
+    imgseries,
+    mask_images,
+    components_criterion=0.5,
+    filter_type=False,
+    degree=0,
+    period_cut=128,
+    repetition_time=None,
+    failure_mode="error",
+    mask_names=None,
+):
     """
-    Runs aCompCor several times if it suddenly fails with
-    https://github.com/nipreps/fmriprep/issues/776
+    A drop-in replacement of :py:func:`nipype.algorithms.confounds.compute_noise_components`.
+
+    Only the retained components are calculated (see
+    :py:func:`~fprodents.interfaces.confounds.compcor_svd`).
 
     """
+    from .confounds import _noise_components
+
+    masks = [
+        np.asanyarray(nb.squeeze_image(img).dataobj).astype(bool) for img in mask_images
+    ]
+    for mask in masks:
+        if imgseries.shape[:3] != mask.shape:
+            raise ValueError(
+                "Inputs for CompCor, timeseries and mask, do not have "
+                "matching spatial dimensions ({} and {}, respectively)".format(
+                    imgseries.shape[:3], mask.shape
+                )
+            )
+
+    return _noise_components(
+        (imgseries[mask, :] for mask in masks),
+        mask_names or range(len(masks)),
+        components_criterion=components_criterion,
+        filter_type=filter_type,
+        degree=degree,
+        repetition_time=repetition_time,
+        period_cut=period_cut,
+        failure_mode=failure_mode,
+    )
 
-    def _run_interface(self, runtime):
-        failures = 0
-        while True:
-            try:
-                runtime = super(RobustACompCor, self)._run_interface(runtime)
-                break
-            except LinAlgError:
-                failures += 1
-                if failures > 10:
-                    raise
-                start = (failures - 1) * 10
-                sleep(randint(start + 4, start + 10))
 
-        return runtime
+class _TruncatedCompCorMixin:
+    """
+    Run Nipype's CompCor with :py:func:`compute_noise_components`.
 
+    Nipype looks the decomposition up in its module at call time, so it is
+    swapped only while the interface runs (nodes run one interface per process).
+    Decompositions failing with the default solver are recalculated
+    with a more stable LAPACK driver, instead of retrying the whole interface.
 
-class RobustTCompCor(nac.TCompCor):
     """
-    Runs tCompCor several times if it suddenly fails with
-    https://github.com/nipreps/fmriprep/issues/940
 
+    def _run_interface(self, runtime):
+        original = nac.compute_noise_components
+        nac.compute_noise_components = compute_noise_components
+        try:
+            return super()._run_interface(runtime)
+        finally:
+            nac.compute_noise_components = original
+
+
+class RobustACompCor(_TruncatedCompCorMixin, nac.ACompCor):
     """
+    aCompCor calculating only the retained components, robust to
+    https://github.com/nipreps/fmriprep/issues/776
 
-    def _run_interface(self, runtime):
-        failures = 0
-        while True:
-            try:
-                runtime = super(RobustTCompCor, self)._run_interface(runtime)
-                break
-            except LinAlgError:
-                failures += 1
-                if failures > 10:
-                    raise
-                start = (failures - 1) * 10
-                sleep(randint(start + 4, start + 10))
+    """
 
-        return runtime
+
+class RobustTCompCor(_TruncatedCompCorMixin, nac.TCompCor):
+    """
+    tCompCor calculating only the retained components, robust to
+    https://github.com/nipreps/fmriprep/issues/940
+
+    """
 
 
 class _FixTraitFASTInputSpec(FASTInputSpec):
@@ -0,0 +1,994 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Resampling of BOLD time series in a single process.
+
+The interfaces in this module read the 4D BOLD series once, map the output grid
+through the fixed (coregistration/normalization) transforms once, and then
+interpolate every volume after composing its head-motion affine.
+This replaces the *split* -> ``antsApplyTransforms`` (one call per volume) ->
+*merge* pattern of the original workflows.
+Slice-timing correction can be fused into the same pass: each volume is first
+interpolated in time, slice by slice, from its neighbors (see
+:py:func:`slice_timing_weights`), and then in space.
+The echoes of multi-echo runs share their head-motion affines and grids, so they
+are resampled together (:py:class:`ResampleEchoes`), calculating the coordinates
+and interpolation weights of each volume once for all echoes.
+
+"""
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
+
+import numpy as np
+import nibabel as nb
+from nipype import logging
+from nipype.utils.filemanip import fname_presuffix
+from nipype.interfaces.base import (
+    traits,
+    TraitedSpec,
+    BaseInterfaceInputSpec,
+    File,
+    InputMultiObject,
+    SimpleInterface,
+    isdefined,
+)
+
+from ..utils.images import SeriesWriter, is_scaled
+from ..utils.transforms import load_transform
+
+LOGGER = logging.getLogger("nipype.interface")
+
+#: Number of output voxels interpolated at once by each thread (the Lanczos kernel
+#: gathers 6³ neighbors of each, so larger chunks mostly add cache misses).
+CHUNK_SIZE = 2 ** 12
+#: Radius of the Lanczos kernel, matching ANTs' ``LanczosWindowedSinc``.
+LANCZOS_RADIUS = 3
+#: Radius (in volumes) of the window of the slice-timing interpolation.
+STC_RADIUS = 2
+
+
+class ResampleSeriesInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="the 4D BOLD series to resample")
+    ref_file = File(
+        exists=True, mandatory=True, desc="an image defining the output sampling grid"
+    )
+    transforms = InputMultiObject(
+        File(exists=True),
+        desc="fixed transforms (in ANTs order) applied before head-motion correction",
+    )
+    hmc_xforms = InputMultiObject(
+        File(exists=True),
+        desc="ITK file(s) or binary transform stack(s) with one affine per volume "
+        "(or a single affine for all volumes) aligning each volume to the reference",
+    )
+    interpolation = traits.Enum(
+        "LanczosWindowedSinc",
+        "Linear",
+        "NearestNeighbor",
+        "BSpline",
+        usedefault=True,
+        desc="interpolation kernel",
+    )
+    float = traits.Bool(True, usedefault=True, desc="calculate in single precision")
+    copy_dtype = traits.Bool(
+        True, usedefault=True, desc="write the output with the input's data type"
+    )
+    header_source = File(
+        exists=True, desc="a NIfTI file from which the time-axis metadata are copied"
+    )
+    compress = traits.Bool(True, usedefault=True, desc="write a compressed NIfTI")
+    compresslevel = traits.Range(
+        low=0, high=9, value=1, usedefault=True, nohash=True, desc="gzip compression level"
+    )
+    num_threads = traits.Int(1, usedefault=True, nohash=True, desc="number of threads")
+    slice_timing = traits.List(
+        traits.Float,
+        desc="acquisition time (s) of each slice, to correct slice-timing before "
+        "resampling",
+    )
+    repetition_time = traits.Float(
+        requires=["slice_timing"], desc="repetition time (s) of the series"
+    )
+    slice_encoding_direction = traits.Enum(
+        "k",
+        "k-",
+        "i",
+        "i-",
+        "j",
+        "j-",
+        usedefault=True,
+        desc="direction of the slices listed by slice_timing",
+    )
+    stc_ignore = traits.Int(
+        0,
+        usedefault=True,
+        desc="initial volumes (non-steady states) left out of slice-timing correction",
+    )
+
+
+class ResampleSeriesOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="the resampled 4D series")
+
+
+class ResampleSeries(SimpleInterface):
+    """
+    Resample a 4D BOLD series in a single pass.
+
+    The semantics of the ``transforms`` and ``hmc_xforms`` inputs follow
+    those of :py:class:`~niworkflows.interfaces.itk.MultiApplyTransforms`, where
+    the head-motion correction affines are always the last item of the chain.
+
+    """
+
+    input_spec = ResampleSeriesInputSpec
+    output_spec = ResampleSeriesOutputSpec
+
+    def _run_interface(self, runtime):
+        ext = ".nii.gz" if self.inputs.compress else ".nii"
+        self._results["out_file"] = fname_presuffix(
+            self.inputs.in_file,
+            suffix="_resampled" + ext,
+            newpath=runtime.cwd,
+            use_ext=False,
+        )
+        _resample_targets(
+            self.inputs,
+            [self.inputs.in_file],
+            [self.inputs.ref_file],
+            [self.inputs.transforms if isdefined(self.inputs.transforms) else []],
+            [self.inputs.hmc_xforms if isdefined(self.inputs.hmc_xforms) else None],
+            [[self._results["out_file"]]],
+        )
+        return runtime
+
+
+class ResampleEchoesInputSpec(ResampleSeriesInputSpec):
+    in_file = traits.List(
+        File(exists=True),
+        mandatory=True,
+        minlen=1,
+        desc="the echoes (4D series with the same grid and number of volumes) to "
+        "resample",
+    )
+
+
+class ResampleEchoesOutputSpec(TraitedSpec):
+    out_files = traits.List(File(exists=True), desc="the resampled echoes")
+
+
+class ResampleEchoes(SimpleInterface):
+    """
+    Resample the echoes of a multi-echo BOLD run in a single pass.
+
+    Equivalent to running :py:class:`ResampleSeries` on each echo, with the
+    same transforms: every volume is read for all echoes, and its coordinates and
+    interpolation weights are calculated once and applied to all of them.
+
+    >>> import os, tempfile
+    >>> os.chdir(tempfile.mkdtemp())
+    >>> rng = np.random.default_rng(0)
+    >>> for echo in (1, 2):
+    ...     data = rng.uniform(size=(6, 6, 6, 3)).astype("float32")
+    ...     nb.Nifti1Image(data, np.eye(4)).to_filename(f"echo-{echo}_bold.nii.gz")
+    >>> nb.Nifti1Image(np.zeros((5, 5, 5)), np.eye(4)).to_filename("ref.nii.gz")
+    >>> echoes = ResampleEchoes(
+    ...     in_file=["echo-1_bold.nii.gz", "echo-2_bold.nii.gz"], ref_file="ref.nii.gz"
+    ... ).run()
+    >>> [os.path.basename(f) for f in echoes.outputs.out_files]
+    ['echo-1_bold_resampled.nii.gz', 'echo-2_bold_resampled.nii.gz']
+    >>> single = ResampleSeries(
+    ...     in_file="echo-2_bold.nii.gz", ref_file="ref.nii.gz", compress=False
+    ... ).run()
+    >>> bool(np.allclose(
+    ...     nb.load(echoes.outputs.out_files[1]).get_fdata(),
+    ...     nb.load(single.outputs.out_file).get_fdata(),
+    ... ))
+    True
+
+    """
+
+    input_spec = ResampleEchoesInputSpec
+    output_spec = ResampleEchoesOutputSpec
+
+    def _run_interface(self, runtime):
+        ext = ".nii.gz" if self.inputs.compress else ".nii"
+        self._results["out_files"] = [
+            fname_presuffix(
+                in_file, suffix="_resampled" + ext, newpath=runtime.cwd, use_ext=False
+            )
+            for in_file in self.inputs.in_file
+        ]
+        if len(set(self._results["out_files"])) != len(self._results["out_files"]):
+            raise ValueError("Echoes must have different file names.")
+        _resample_targets(
+            self.inputs,
+            self.inputs.in_file,
+            [self.inputs.ref_file],
+            [self.inputs.transforms if isdefined(self.inputs.transforms) else []],
+            [self.inputs.hmc_xforms if isdefined(self.inputs.hmc_xforms) else None],
+            [self._results["out_files"]],
+        )
+        return runtime
+
+
+class MultiResampleSeriesInputSpec(ResampleSeriesInputSpec):
+    ref_file = traits.List(
+        File(exists=True),
+        mandatory=True,
+        minlen=1,
+        desc="images defining the sampling grid of each output",
+    )
+    transforms = traits.List(
+        traits.List(File(exists=True)),
+        desc="for each output, fixed transforms (in ANTs order) applied before "
+        "head-motion correction",
+    )
+    hmc_xforms = traits.List(
+        File(exists=True),
+        desc="for each output, an ITK file or a binary transform stack with one "
+        "affine per volume (or a single affine for all volumes) aligning each "
+        "volume to the reference",
+    )
+
+
+class MultiResampleSeriesOutputSpec(TraitedSpec):
+    out_files = traits.List(File(exists=True), desc="the resampled 4D series")
+
+
+class MultiResampleSeries(SimpleInterface):
+    """
+    Resample a 4D BOLD series onto several grids, reading each volume once.
+
+    Each item of ``transforms`` and ``hmc_xforms`` corresponds to the
+    item of ``ref_file`` at the same position, with the semantics of
+    :py:class:`ResampleSeries`.
+
+    """
+
+    input_spec = MultiResampleSeriesInputSpec
+    output_spec = MultiResampleSeriesOutputSpec
+
+    def _run_interface(self, runtime):
+        ntargets = len(self.inputs.ref_file)
+        transforms = (
+            self.inputs.transforms
+            if isdefined(self.inputs.transforms)
+            else [[]] * ntargets
+        )
+        hmc_xforms = (
+            self.inputs.hmc_xforms
+            if isdefined(self.inputs.hmc_xforms)
+            else [None] * ntargets
+        )
+        if len(transforms) != ntargets or len(hmc_xforms) != ntargets:
+            raise ValueError(
+                "Number of reference grids and entries in the transforms lists "
+                "do not match."
+            )
+
+        ext = ".nii.gz" if self.inputs.compress else ".nii"
+        self._results["out_files"] = [
+            fname_presuffix(
+                self.inputs.in_file,
+                suffix=f"_target{i:02d}_resampled{ext}",
+                newpath=runtime.cwd,
+                use_ext=False,
+            )
+            for i in range(ntargets)
+        ]
+        _resample_targets(
+            self.inputs,
+            [self.inputs.in_file],
+            self.inputs.ref_file,
+            transforms,
+            hmc_xforms,
+            [[out_file] for out_file in self._results["out_files"]],
+        )
+        return runtime
+
+
+def _resample_targets(inputs, in_files, ref_files, transforms, hmc_xforms, out_files):
+    """Resample the series in ``in_files`` (one output per target and series)."""
+    imgs = [nb.load(in_file, keep_file_open=True) for in_file in in_files]
+    img = imgs[0]
+    nvols = img.shape[3] if img.ndim > 3 else 1
+    if any(other.shape != img.shape for other in imgs[1:]):
+        raise ValueError("Series resampled together must have the same shape.")
+    refs = [nb.load(f) for f in ref_files]
+
+    targets = []
+    for ref, chain, hmc_files in zip(refs, transforms, hmc_xforms):
+        hmc = (
+            load_hmc_xforms(hmc_files, nvols)
+            if hmc_files
+            else np.tile(np.eye(4), (nvols, 1, 1))
+        )
+        # Compose each head-motion affine with the mapping to voxel indices
+        targets.append(
+            (map_reference(ref, chain), np.linalg.inv(img.affine) @ hmc, ref.shape[:3])
+        )
+
+    dtype = "float32" if inputs.float else "float64"
+    stc = None
+    if isdefined(inputs.slice_timing) and inputs.slice_timing:
+        if not isdefined(inputs.repetition_time):
+            raise ValueError("Slice-timing correction requires the repetition time.")
+        direction = inputs.slice_encoding_direction
+        slice_timing = inputs.slice_timing
+        if direction.endswith("-"):
+            slice_timing = slice_timing[::-1]
+        stc = (
+            "ijk".index(direction[0]),
+            slice_timing_weights(slice_timing, inputs.repetition_time),
+            inputs.stc_ignore,
+        )
+
+    time_source = (
+        nb.load(inputs.header_source) if isdefined(inputs.header_source) else img
+    )
+    with ExitStack() as stack:
+        writers = [
+            [
+                stack.enter_context(
+                    SeriesWriter(
+                        out_file,
+                        (*ref.shape[:3], nvols),
+                        ref.affine,
+                        _series_header(ref, img, time_source),
+                        dtype=(
+                            series.get_data_dtype()
+                            if inputs.copy_dtype and not is_scaled(series)
+                            else dtype
+                        ),
+                        compresslevel=inputs.compresslevel,
+                        num_threads=inputs.num_threads,
+                    )
+                )
+                for series, out_file in zip(imgs, target_files)
+            ]
+            for ref, target_files in zip(refs, out_files)
+        ]
+        resample_series_multi(
+            imgs if len(imgs) > 1 else img,
+            targets,
+            interpolation=inputs.interpolation,
+            dtype=dtype,
+            num_threads=inputs.num_threads,
+            writers=writers if len(imgs) > 1 else [w for w, in writers],
+            stc=stc,
+        )
+
+
+class MergeSeriesInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiObject(
+        File(exists=True), mandatory=True, desc="input list of 3D volumes to merge"
+    )
+    dtype = traits.Enum(
+        "f4",
+        "f8",
+        "u1",
+        "u2",
+        "u4",
+        "i2",
+        "i4",
+        desc="numpy dtype of output image (default: that of the first input)",
+    )
+    header_source = File(
+        exists=True, desc="a NIfTI file from which the time-axis metadata are copied"
+    )
+    compress = traits.Bool(True, usedefault=True, desc="write a compressed NIfTI")
+    compresslevel = traits.Range(
+        low=0, high=9, value=1, usedefault=True, nohash=True, desc="gzip compression level"
+    )
+    num_threads = traits.Int(
+        1, usedefault=True, nohash=True, desc="number of compression threads"
+    )
+
+
+class MergeSeriesOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="the merged 4D series")
+
+
+class MergeSeries(SimpleInterface):
+    """
+    Concatenate 3D volumes into a 4D series, streaming them into the output.
+
+    A drop-in replacement for :py:class:`~niworkflows.interfaces.nilearn.Merge`
+    that only holds one volume in memory at a time.
+    Unless ``dtype`` is set, the output has the data type of the first volume, or
+    ``float32`` if any volume is scaled or stored as floating point (e.g., volumes
+    resampled by ANTs, with their own scaling each).
+
+    """
+
+    input_spec = MergeSeriesInputSpec
+    output_spec = MergeSeriesOutputSpec
+
+    def _run_interface(self, runtime):
+        ext = ".nii.gz" if self.inputs.compress else ".nii"
+        self._results["out_file"] = fname_presuffix(
+            self.inputs.in_files[0],
+            suffix="_merged" + ext,
+            newpath=runtime.cwd,
+            use_ext=False,
+        )
+
+        first = nb.load(self.inputs.in_files[0])
+        hdr = nb.Nifti1Header.from_header(first.header)
+        hdr.set_data_shape((*first.shape[:3], len(self.inputs.in_files)))
+        if isdefined(self.inputs.header_source):
+            src_hdr = nb.load(self.inputs.header_source).header
+            hdr.set_xyzt_units(t=src_hdr.get_xyzt_units()[-1])
+            hdr.set_zooms(list(hdr.get_zooms()[:3]) + [src_hdr.get_zooms()[3]])
+
+        if isdefined(self.inputs.dtype):
+            dtype = np.dtype(self.inputs.dtype)
+        else:
+            dtype = first.get_data_dtype()
+            volumes = [nb.load(in_file) for in_file in self.inputs.in_files]
+            if np.issubdtype(dtype, np.integer) and any(
+                is_scaled(vol) or not np.issubdtype(vol.get_data_dtype(), np.integer)
+                for vol in volumes
+            ):
+                dtype = np.dtype("float32")
+        with SeriesWriter(
+            self._results["out_file"],
+            hdr.get_data_shape(),
+            first.affine,
+            hdr,
+            dtype,
+            compresslevel=self.inputs.compresslevel,
+            num_threads=self.inputs.num_threads,
+        ) as writer:
+            for in_file in self.inputs.in_files:
+                writer.write(np.asanyarray(nb.load(in_file).dataobj))
+        return runtime
+
+
+class ProjectROIsInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiObject(
+        File(exists=True), mandatory=True, desc="binary ROIs to project"
+    )
+    reference_image = File(
+        exists=True, mandatory=True, desc="an image defining the output sampling grid"
+    )
+    transforms = InputMultiObject(
+        File(exists=True),
+        desc="transforms (in ANTs order) mapping the reference onto the ROIs",
+    )
+    in_mask = File(exists=True, desc="a mask (on the reference grid) applied to ROIs")
+
+
+class ProjectROIsOutputSpec(TraitedSpec):
+    out_files = traits.List(File(exists=True), desc="the projected (and masked) ROIs")
+
+
+class ProjectROIs(SimpleInterface):
+    """
+    Project several ROIs onto a reference grid, mapping the grid only once.
+
+    Equivalent to running ``antsApplyTransforms`` with nearest-neighbor
+    interpolation on each ROI, and then zeroing the voxels out of ``in_mask``.
+    Outputs are written as ``uint8`` images with the header of the reference.
+
+    >>> import os, tempfile
+    >>> os.chdir(tempfile.mkdtemp())
+    >>> roi = np.zeros((5, 5, 5), dtype="uint8")
+    >>> roi[1:4, 1:4, 1:4] = 1
+    >>> nb.Nifti1Image(roi, np.eye(4)).to_filename("roi.nii.gz")
+    >>> mask = np.ones((5, 5, 5), dtype="uint8")
+    >>> mask[..., 3:] = 0
+    >>> nb.Nifti1Image(mask, np.eye(4)).to_filename("mask.nii.gz")
+    >>> res = ProjectROIs(
+    ...     in_files=["roi.nii.gz"] * 2,
+    ...     reference_image="mask.nii.gz",
+    ...     in_mask="mask.nii.gz",
+    ... ).run()
+    >>> [os.path.basename(f) for f in res.outputs.out_files]
+    ['roi_roi00_boldmsk.nii.gz', 'roi_roi01_boldmsk.nii.gz']
+    >>> out = nb.load(res.outputs.out_files[0])
+    >>> out.get_data_dtype(), int(np.asanyarray(out.dataobj).sum())
+    (dtype('uint8'), 18)
+
+    """
+
+    input_spec = ProjectROIsInputSpec
+    output_spec = ProjectROIsOutputSpec
+
+    def _run_interface(self, runtime):
+        ref = nb.load(self.inputs.reference_image)
+        coords = map_reference(
+            ref, self.inputs.transforms if isdefined(self.inputs.transforms) else []
+        )
+        mask = None
+        if isdefined(self.inputs.in_mask):
+            mask = np.asanyarray(nb.load(self.inputs.in_mask).dataobj) > 0
+
+        hdr = ref.header.copy()
+        hdr.set_data_dtype("uint8")
+        self._results["out_files"] = []
+        for i, in_file in enumerate(self.inputs.in_files):
+            roi = nb.load(in_file)
+            data = resample_volume(
+                np.asanyarray(roi.dataobj, dtype="float32"),
+                coords,
+                np.linalg.inv(roi.affine),
+                interpolation="NearestNeighbor",
+            ).reshape(ref.shape[:3])
+            data = data.astype("uint8")
+            if mask is not None:
+                data[~mask] = 0
+
+            out_file = fname_presuffix(
+                in_file, suffix=f"_roi{i:02d}_boldmsk", newpath=runtime.cwd
+            )
+            ref.__class__(data, ref.affine, hdr).to_filename(out_file)
+            self._results["out_files"].append(out_file)
+        return runtime
+
+
+class CompileTransformsInputSpec(BaseInterfaceInputSpec):
+    transforms = InputMultiObject(
+        File(exists=True),
+        desc="fixed transforms (in ANTs order) applied before head-motion correction",
+    )
+    hmc_xforms = InputMultiObject(
+        File(exists=True),
+        mandatory=True,
+        desc="ITK file(s) or binary transform stack(s) with one affine per volume "
+        "(or a single affine for all volumes) aligning each volume to the reference",
+    )
+    reference_image = File(
+        exists=True, mandatory=True, desc="an image defining the output sampling grid"
+    )
+    itk_text = traits.Bool(
+        True,
+        usedefault=True,
+        desc="also export the compiled affines as an ITK text file (required by "
+        "ANTs, in ``out_transforms``)",
+    )
+    cache_dir = traits.Directory(
+        desc="directory where compiled chains are stored (the node's working "
+        "directory if not set)"
+    )
+
+
+class CompileTransformsOutputSpec(TraitedSpec):
+    out_transforms = traits.List(
+        File(exists=True),
+        desc="the compiled chain, in ANTs order (if ``itk_text`` is set)",
+    )
+    fixed_transforms = traits.List(
+        File(exists=True),
+        desc="the displacements field of the compiled chain (empty if linear)",
+    )
+    out_xforms = File(
+        exists=True,
+        desc="one affine per volume, composed with the linear part of the chain "
+        "(as a binary transform stack)",
+    )
+
+
+class CompileTransforms(SimpleInterface):
+    """
+    Precompose a chain of transforms into one field plus one affine per volume.
+
+    The affine parts of the chain are composed analytically with each
+    head-motion correction affine, and the nonlinear parts (if any) are
+    sampled once on the output grid, so that resampling each volume
+    does not need to read and compose the full chain again.
+    Compiled chains are cached by their input files (see
+    :py:func:`~fprodents.interfaces.cache.file_key`).
+
+    """
+
+    input_spec = CompileTransformsInputSpec
+    output_spec = CompileTransformsOutputSpec
+
+    def _run_interface(self, runtime):
+        from .cache import cache_entry, file_key
+
+        transforms = (
+            list(self.inputs.transforms) if isdefined(self.inputs.transforms) else []
+        )
+        ref = nb.load(self.inputs.reference_image)
+        key = hashlib.sha256(
+            "|".join(
+                [file_key(f) for f in transforms]
+                + ["hmc-stack"]
+                + [file_key(f) for f in self.inputs.hmc_xforms]
+                + [str(ref.shape[:3]), np.array2string(ref.affine, precision=6)]
+            ).encode()
+        ).hexdigest()
+
+        entry = cache_entry(
+            self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else runtime.cwd,
+            key,
+            lambda path: _compile_chain(
+                transforms, self.inputs.hmc_xforms, ref, path
+            ),
+        )
+
+        fixed = sorted(str(f) for f in entry.glob("fixed_field.nii.gz"))
+        self._results["fixed_transforms"] = fixed
+        self._results["out_xforms"] = str(entry / "xforms.npy")
+        if self.inputs.itk_text:
+            self._results["out_transforms"] = fixed + [_itk_export(entry / "xforms.npy")]
+        return runtime
+
+
+def _compile_chain(transforms, hmc_xforms, reference, out_dir):
+    from ..utils.transforms import compile_chain, itk_displacements, save_xfm_stack
+
+    field, affine = compile_chain(transforms, reference)
+    if field is not None:
+        itk_displacements(field, reference).to_filename(
+            str(Path(out_dir) / "fixed_field.nii.gz")
+        )
+    hmc = load_hmc_xforms(hmc_xforms, None)
+    save_xfm_stack(hmc @ affine, Path(out_dir) / "xforms.npy")
+
+
+def _itk_export(stack_file):
+    """Export a transform stack as an ITK text file next to it (once)."""
+    from uuid import uuid4
+    from ..utils.transforms import itk_affines, load_xfm_stack
+
+    out_file = Path(stack_file).with_suffix(".txt")
+    if not out_file.exists():
+        tmp_file = out_file.with_name(f".{out_file.name}.{uuid4().hex[:8]}")
+        tmp_file.write_text(itk_affines(load_xfm_stack(stack_file)))
+        os.replace(tmp_file, out_file)
+    return str(out_file)
+
+
+def load_hmc_xforms(in_files, nvols):
+    """
+    Read head-motion correction affines into an (N, 4, 4) array of RAS matrices.
+
+    Files may be ITK transform files or binary transform stacks
+    (see :py:func:`~fprodents.utils.transforms.save_xfm_stack`).
+    A single affine is broadcast to all volumes, mirroring
+    :py:class:`~niworkflows.interfaces.itk.MultiApplyTransforms`
+    (unless ``nvols`` is ``None``, in which case affines are returned as read).
+
+    """
+    import nitransforms as nt
+    from ..utils.transforms import is_xfm_stack, load_xfm_stack
+
+    if isinstance(in_files, (str, bytes)):
+        in_files = [in_files]
+
+    matrices = np.vstack(
+        [
+            load_xfm_stack(f)
+            if is_xfm_stack(f)
+            else np.asanyarray(nt.linear.load(str(f), fmt="itk").matrix).reshape(
+                -1, 4, 4
+            )
+            for f in in_files
+        ]
+    )
+    if nvols is None:
+        return matrices
+    if matrices.shape[0] == 1:
+        return np.tile(matrices[0], (nvols, 1, 1))
+    if matrices.shape[0] != nvols:
+        raise ValueError(
+            f"Number of head-motion affines ({matrices.shape[0]}) and "
+            f"volumes ({nvols}) do not match."
+        )
+    return matrices
+
+
+def map_reference(ref, transforms, chunk_size=2 ** 20):
+    """
+    Map the voxels of the reference grid through the fixed transforms chain.
+
+    Returns an (N, 3) array of RAS coordinates in the space where
+    head-motion correction affines are defined.
+
+    """
+    shape = ref.shape[:3]
+    xforms = [load_transform(f) for f in transforms]
+    ijk = np.moveaxis(np.indices(shape, dtype="float32"), 0, -1).reshape(-1, 3)
+    coords = np.empty_like(ijk)
+    for start in range(0, ijk.shape[0], chunk_size):
+        points = nb.affines.apply_affine(ref.affine, ijk[start : start + chunk_size])
+        for xfm in xforms:
+            points = np.asanyarray(xfm.map(points)).reshape(-1, 3)
+        coords[start : start + chunk_size] = points
+    return coords
+
+
+def resample_series(
+    img,
+    coords,
+    vox_xforms,
+    out_shape,
+    interpolation="LanczosWindowedSinc",
+    dtype="float32",
+    num_threads=1,
+):
+    """Interpolate every volume of ``img`` at the mapped coordinates."""
+    return resample_series_multi(
+        img,
+        [(coords, vox_xforms, out_shape)],
+        interpolation=interpolation,
+        dtype=dtype,
+        num_threads=num_threads,
+    )[0]
+
+
+def resample_series_multi(
+    img,
+    targets,
+    interpolation="LanczosWindowedSinc",
+    dtype="float32",
+    num_threads=1,
+    writers=None,
+    stc=None,
+):
+    """
+    Interpolate every volume of ``img`` into several targets, reading it once.
+
+    Each target is a ``(coords, vox_xforms, out_shape)`` tuple, as taken by
+    :py:func:`resample_series`.
+    ``img`` may also be a list of series with the same grid and number of volumes
+    (e.g., echoes), resampled together (see :py:func:`resample_volume`), in which
+    case one list of outputs (or writers) per target holds one item per series.
+    If ``writers`` (one :py:class:`~fprodents.utils.images.SeriesWriter` per
+    target) are given, resampled volumes are streamed into them block by block
+    and nothing is returned.
+    If ``stc`` is given, as a ``(slice_axis, weights, ignore)`` tuple (see
+    :py:func:`slice_timing_weights`), volumes are corrected for slice-timing
+    before their spatial interpolation, except the first ``ignore`` ones.
+
+    """
+    batch = isinstance(img, (list, tuple))
+    imgs = img if batch else [img]
+    if writers is not None and not batch:
+        writers = [[writer] for writer in writers]
+
+    nvols = targets[0][1].shape[0]
+    outs = None
+    if writers is None:
+        outs = [
+            [np.zeros((*out_shape, nvols), dtype=dtype) for _ in imgs]
+            for _, _, out_shape in targets
+        ]
+
+    # Read volumes sequentially (compressed inputs are decompressed only once)
+    # in blocks that bound the memory held in flight.
+    block = max(num_threads, 1) * 4
+    buffers = [
+        np.zeros((*out_shape, len(imgs), block), dtype=dtype)
+        for _, _, out_shape in targets
+    ]
+
+    def _resample_vol(args):
+        data, index = args
+        if stc is not None:
+            data = _shift_slices(*data, index, nvols, *stc)
+        # Neighbors are gathered by their flat index within the volume
+        data = np.ascontiguousarray(data)
+        if interpolation == "BSpline":
+            data = _spline_filter(data)
+        for buffer, (coords, vox_xforms, out_shape) in zip(buffers, targets):
+            buffer[..., index % block] = resample_volume(
+                data,
+                coords,
+                vox_xforms[index],
+                interpolation=interpolation,
+                prefilter=False,
+            ).reshape((*out_shape, len(imgs)))
+
+    def _read(first, last):
+        # Series are stacked along the fourth axis (the volumes move to the fifth)
+        return np.stack(
+            [
+                np.asanyarray(series.dataobj[..., first:last], dtype=dtype)
+                for series in imgs
+            ],
+            axis=3,
+        )
+
+    with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as pool:
+        for start in range(0, nvols, block):
+            stop = min(start + block, nvols)
+            if stc is None:
+                data = _read(start, stop)
+                args = [(data[..., i - start], i) for i in range(start, stop)]
+            else:
+                # Read the neighbors of the block, to interpolate in time
+                first = max(start - STC_RADIUS, 0)
+                data = _read(first, stop + STC_RADIUS)
+                args = [((data, first), i) for i in range(start, stop)]
+            list(pool.map(_resample_vol, args))
+            for i, buffer in enumerate(buffers):
+                for j in range(len(imgs)):
+                    if writers is None:
+                        outs[i][j][..., start:stop] = buffer[..., j, : stop - start]
+                    else:
+                        writers[i][j].write(buffer[..., j, : stop - start])
+    if outs is not None and not batch:
+        outs = [target_outs[0] for target_outs in outs]
+    return outs
+
+
+def slice_timing_weights(slice_timing, repetition_time, tzero=None):
+    """
+    Calculate the weights interpolating each slice at the reference time of volumes.
+
+    Each slice is interpolated at ``tzero`` (by default, the average of the
+    slice times, as ``3dTshift`` does) with a cubic Lagrange polynomial through
+    four of its samples in time.
+    The weights are returned as an array of ``2 * STC_RADIUS + 1`` rows (the
+    offsets of the volumes, from ``-STC_RADIUS``) by as many columns as slices.
+
+    >>> weights = slice_timing_weights([0.0, 0.5, 1.0, 1.5], 2.0, tzero=0.5)
+    >>> weights[:, 1].tolist()  # Acquired at tzero
+    [0.0, 0.0, 1.0, 0.0, 0.0]
+    >>> weights[:, 3].tolist()  # Half-way between the previous and the current volume
+    [-0.0625, 0.5625, 0.5625, -0.0625, 0.0]
+    >>> weights.sum(axis=0).tolist()
+    [1.0, 1.0, 1.0, 1.0]
+
+    """
+    from .stc import slice_shifts
+
+    # Position (in volumes, relative to the volume) of the reference time of each slice
+    shifts = slice_shifts(slice_timing, repetition_time, tzero=tzero)
+    base = np.floor(shifts).astype(int)
+    frac = shifts - base
+
+    weights = np.zeros((2 * STC_RADIUS + 1, shifts.size))
+    columns = np.arange(shifts.size)
+    nodes = (-1, 0, 1, 2)
+    for node in nodes:
+        lagrange = np.ones_like(frac)
+        for other in nodes:
+            if other != node:
+                lagrange *= (frac - other) / (node - other)
+        weights[base + node + STC_RADIUS, columns] += lagrange
+    return weights
+
+
+def _shift_slices(data, first, index, nvols, axis, weights, ignore):
+    """Interpolate volume ``index`` in time, slice by slice, from a block of volumes."""
+    if index < ignore:
+        return data[..., index - first]
+
+    shape = [1] * (data.ndim - 1)
+    shape[axis] = -1
+    out = np.zeros(data.shape[:-1], dtype=data.dtype)
+    for offset, slice_weights in zip(range(-STC_RADIUS, STC_RADIUS + 1), weights):
+        if not slice_weights.any():
+            continue
+        neighbor = min(max(index + offset, ignore), nvols - 1)
+        out += slice_weights.reshape(shape).astype(data.dtype) * data[..., neighbor - first]
+    return out
+
+
+def resample_volume(
+    data, coords, vox_xform, interpolation="LanczosWindowedSinc", prefilter=True
+):
+    """
+    Sample a 3D array at the given RAS coordinates.
+
+    ``vox_xform`` maps RAS coordinates into voxel indices of ``data``.
+    Samples falling outside the field of view are set to zero.
+    With ``prefilter=False``, B-Spline interpolation assumes ``data`` holds
+    spline coefficients already.
+    Several volumes on the same grid may be stacked along a fourth axis of
+    ``data``, and are sampled at once (one column each).
+
+    >>> data = np.arange(27, dtype="float32").reshape(3, 3, 3)
+    >>> coords = np.array([[1.0, 1.0, 1.0], [0.0, 2.0, 1.0], [9.0, 0.0, 0.0]])
+    >>> resample_volume(data, coords, np.eye(4)).round(4).tolist()
+    [13.0, 7.0, 0.0]
+    >>> resample_volume(data, coords, np.eye(4), interpolation="Linear").tolist()
+    [13.0, 7.0, 0.0]
+    >>> stacked = np.stack((data, 2 * data), axis=-1)
+    >>> resample_volume(stacked, coords, np.eye(4)).round(4).tolist()
+    [[13.0, 26.0], [7.0, 14.0], [0.0, 0.0]]
+
+    """
+    from scipy import ndimage as ndi
+
+    if interpolation == "BSpline" and prefilter:
+        data = _spline_filter(data)
+
+    out = np.zeros((coords.shape[0], *data.shape[3:]), dtype=data.dtype)
+    # Bound the samples gathered at once, whatever the number of stacked volumes
+    chunk_size = max(CHUNK_SIZE // int(np.prod(data.shape[3:], dtype=int)), 1)
+    for start in range(0, coords.shape[0], chunk_size):
+        ijk = (
+            coords[start : start + chunk_size] @ vox_xform[:3, :3].T.astype(coords.dtype)
+            + vox_xform[:3, 3].astype(coords.dtype)
+        ).T
+        if interpolation == "LanczosWindowedSinc":
+            out[start : start + chunk_size] = _lanczos_sample(data, ijk)
+            continue
+
+        order = {"NearestNeighbor": 0, "Linear": 1, "BSpline": 3}[interpolation]
+        values = out[start : start + chunk_size].reshape(ijk.shape[1], -1)
+        for i, volume in enumerate(data.reshape((*data.shape[:3], -1)).T):
+            values[:, i] = ndi.map_coordinates(
+                volume.T, ijk, order=order, mode="nearest", prefilter=False
+            )
+        values[~_inside(ijk, data.shape)] = 0
+    return out
+
+
+def _spline_filter(data):
+    """Calculate the cubic B-Spline coefficients of each 3D volume of ``data``."""
+    from scipy import ndimage as ndi
+
+    if data.ndim == 3:
+        return ndi.spline_filter(data, order=3, mode="nearest", output=data.dtype)
+    return np.stack(
+        [_spline_filter(data[..., i]) for i in range(data.shape[-1])], axis=-1
+    )
+
+
+def _inside(ijk, shape):
+    """Flag continuous indices within the image buffer (as ITK does)."""
+    return np.all(
+        (ijk >= -0.5) & (ijk <= np.array(shape[:3])[:, np.newaxis] - 0.5), axis=0
+    )
+
+
+def _lanczos_sample(data, ijk, radius=LANCZOS_RADIUS):
+    """
+    Windowed-sinc interpolation with a Lanczos window.
+
+    Follows ITK's ``WindowedSincInterpolateImageFunction`` with zero-flux
+    Neumann boundary conditions, except that the separable weights are
+    normalized to sum up to one (avoiding a small loss of DC gain).
+
+    """
+    offsets = np.arange(1 - radius, radius + 1)
+    base = np.floor(ijk).astype(int)
+    weights = []
+    indices = []
+    for axis in range(3):
+        idx = base[axis][np.newaxis, :] + offsets[:, np.newaxis]
+        dist = ijk[axis][np.newaxis, :] - idx
+        kernel = np.sinc(dist) * np.sinc(dist / radius)
+        weights.append((kernel / kernel.sum(axis=0)).astype(data.dtype))
+        indices.append(np.clip(idx, 0, data.shape[axis] - 1))
+
+    # Gather neighbors by their flat index, once for all stacked volumes
+    flat = (
+        indices[0][:, np.newaxis, np.newaxis, :] * data.shape[1]
+        + indices[1][np.newaxis, :, np.newaxis, :]
+    ) * data.shape[2] + indices[2][np.newaxis, np.newaxis, :, :]
+    samples = np.take(data.reshape((np.prod(data.shape[:3]), -1)), flat, axis=0)
+    if data.ndim == 3:
+        samples = samples[..., 0]
+    values = np.einsum(
+        "ip,jp,kp,ijkp...->p...",
+        weights[0],
+        weights[1],
+        weights[2],
+        samples,
+        optimize=True,
+    )
+    values[~_inside(ijk, data.shape)] = 0
+    return values
+
+
+def _series_header(ref, img, time_source):
+    """Generate the header of a 4D series on the grid of ``ref``."""
+    hdr = nb.Nifti1Header.from_header(ref.header)
+    nvols = img.shape[3] if img.ndim > 3 else 1
+    hdr.set_data_shape((*ref.shape[:3], nvols))
+    src_hdr = time_source.header
+    tr = src_hdr.get_zooms()[3] if len(src_hdr.get_zooms()) > 3 else 1.0
+    hdr.set_zooms((*ref.header.get_zooms()[:3], tr))
+    hdr.set_xyzt_units(*src_hdr.get_xyzt_units())
+    return hdr
@@ -0,0 +1,204 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Slice-timing correction in a single process.
+
+Every slice is shifted in time to a common reference (by default, the average of
+the slice times, as ``3dTshift`` does), with a Fourier (i.e., periodic sinc)
+interpolation of the time series of its voxels, after removing their linear trend
+and extending them symmetrically (which avoids the ringing of the discontinuity
+between their ends).
+Slices are processed in chunks, as vectorized FFTs spread across threads, and
+the output is written with the header of the input in one step (replacing the
+``3dTshift`` -> ``CopyXForm`` pair of rewrites).
+
+"""
+import numpy as np
+import nibabel as nb
+from nipype.utils.filemanip import fname_presuffix
+from nipype.interfaces.base import (
+    traits,
+    TraitedSpec,
+    BaseInterfaceInputSpec,
+    File,
+    SimpleInterface,
+)
+
+from ..utils.images import SeriesWriter, is_scaled
+
+#: Number of slices shifted at once.
+CHUNK_SLICES = 4
+#: Number of volumes written at once.
+CHUNK_VOLS = 64
+
+
+class SliceTimingCorrectionInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="the 4D BOLD series to correct")
+    slice_timing = traits.List(
+        traits.Float, mandatory=True, minlen=1, desc="acquisition time (s) of each slice"
+    )
+    repetition_time = traits.Float(mandatory=True, desc="repetition time (s)")
+    slice_encoding_direction = traits.Enum(
+        "k",
+        "k-",
+        "i",
+        "i-",
+        "j",
+        "j-",
+        usedefault=True,
+        desc="direction of the slices listed by slice_timing",
+    )
+    tzero = traits.Float(
+        desc="time (s) every slice is aligned to (default: average of slice times)"
+    )
+    ignore = traits.Int(
+        0,
+        usedefault=True,
+        desc="initial volumes (non-steady states) left out of the correction",
+    )
+    compress = traits.Bool(True, usedefault=True, desc="write a compressed NIfTI")
+    compresslevel = traits.Range(
+        low=0, high=9, value=1, usedefault=True, nohash=True, desc="gzip compression level"
+    )
+    num_threads = traits.Int(1, usedefault=True, nohash=True, desc="number of threads")
+
+
+class SliceTimingCorrectionOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="the slice-timing corrected series")
+
+
+class SliceTimingCorrection(SimpleInterface):
+    """
+    Correct slice-timing with Fourier interpolation, in-process.
+
+    The output keeps the header (orientation, data type and time units) of
+    the input.
+    Series stored with scaling factors are written as floating point.
+
+    """
+
+    input_spec = SliceTimingCorrectionInputSpec
+    output_spec = SliceTimingCorrectionOutputSpec
+
+    def _run_interface(self, runtime):
+        from nipype.interfaces.base import isdefined
+
+        img = nb.load(self.inputs.in_file)
+        if img.ndim != 4:
+            raise ValueError(f"<{self.inputs.in_file}> is not a 4D series.")
+
+        direction = self.inputs.slice_encoding_direction
+        axis = "ijk".index(direction[0])
+        slice_timing = self.inputs.slice_timing
+        if direction.endswith("-"):
+            slice_timing = slice_timing[::-1]
+        if len(slice_timing) != img.shape[axis]:
+            raise ValueError(
+                f"Number of slice times ({len(slice_timing)}) does not match the "
+                f"number of slices ({img.shape[axis]})."
+            )
+
+        shifts = slice_shifts(
+            slice_timing,
+            self.inputs.repetition_time,
+            tzero=self.inputs.tzero if isdefined(self.inputs.tzero) else None,
+        )
+        data = np.asanyarray(img.dataobj, dtype="float32")
+        shift_slices(
+            data,
+            shifts,
+            axis=axis,
+            ignore=self.inputs.ignore,
+            num_threads=self.inputs.num_threads,
+        )
+
+        ext = ".nii.gz" if self.inputs.compress else ".nii"
+        self._results["out_file"] = fname_presuffix(
+            self.inputs.in_file, suffix="_tshift" + ext, newpath=runtime.cwd, use_ext=False
+        )
+        with SeriesWriter(
+            self._results["out_file"],
+            img.shape,
+            img.affine,
+            img.header,
+            dtype="float32" if is_scaled(img) else img.get_data_dtype(),
+            compresslevel=self.inputs.compresslevel,
+            num_threads=self.inputs.num_threads,
+        ) as writer:
+            for start in range(0, img.shape[3], CHUNK_VOLS):
+                writer.write(data[..., start : start + CHUNK_VOLS])
+        return runtime
+
+
+def slice_shifts(slice_timing, repetition_time, tzero=None):
+    """
+    Calculate the time shift (in volumes) aligning each slice to ``tzero``.
+
+    Slice ``z`` of volume ``n``, acquired at ``n * TR + slice_timing[z]``, is
+    interpolated at ``n * TR + tzero``, i.e., at sample ``n + shifts[z]``
+    of its own time series.
+
+    >>> slice_shifts([0.0, 0.5, 1.0, 1.5], 2.0).tolist()
+    [0.375, 0.125, -0.125, -0.375]
+    >>> slice_shifts([0.0, 0.5, 1.0, 1.5], 2.0, tzero=0.0).tolist()
+    [0.0, -0.25, -0.5, -0.75]
+
+    """
+    slice_timing = np.asanyarray(slice_timing, dtype="float64")
+    if tzero is None:
+        tzero = slice_timing.mean()
+    return (tzero - slice_timing) / repetition_time
+
+
+def shift_slices(data, shifts, axis=2, ignore=0, num_threads=1):
+    """
+    Shift the time series of every slice of a 4D array, in place.
+
+    The volumes after the first ``ignore`` ones are detrended (linearly), shifted
+    with a Fourier interpolation of their mirror-symmetric extension, and the trend
+    is added back at the shifted times.
+
+    >>> t = np.arange(32)
+    >>> data = np.zeros((1, 1, 2, 32), dtype="float32")
+    >>> data[..., 0, :] = np.sin(2 * np.pi * t / 16) + 0.1 * t
+    >>> data[..., 1, :] = np.sin(2 * np.pi * (t + 0.5) / 16) + 0.1 * (t + 0.5)
+    >>> _ = shift_slices(data, [0.5, 0.0])
+    >>> error = np.abs(data[0, 0, 0] - data[0, 0, 1])
+    >>> bool(error[2:-2].max() < 0.01)  # Away from the ends of the series
+    True
+
+    """
+    from scipy import fft
+
+    shifts = np.asanyarray(shifts, dtype="float64")
+    series = np.moveaxis(data, axis, 2)[..., ignore:]
+    ntimes = series.shape[-1]
+    if ntimes < 2:
+        return data
+
+    times = np.arange(ntimes, dtype="float64")
+    times -= times.mean()
+    # Series are mirrored into a periodic sequence, continuous at both ends
+    nfft = 2 * ntimes
+    freqs = fft.rfftfreq(nfft)
+    for start in range(0, series.shape[2], CHUNK_SLICES):
+        chunk = series[:, :, start : start + CHUNK_SLICES].astype("float64")
+        chunk_shifts = shifts[start : start + CHUNK_SLICES, np.newaxis]
+
+        # Remove the linear trend (the periodic interpolation would smear its ramp)
+        mean = chunk.mean(axis=-1, keepdims=True)
+        slope = (chunk @ times / (times @ times))[..., np.newaxis]
+        chunk -= mean + slope * times
+
+        phases = np.exp(2j * np.pi * freqs * chunk_shifts)
+        # The Nyquist component of real series can only be scaled
+        phases[:, -1] = np.cos(np.pi * chunk_shifts[:, 0])
+        spectrum = fft.rfft(
+            np.concatenate((chunk, chunk[..., ::-1]), axis=-1), axis=-1, workers=num_threads
+        )
+        chunk = fft.irfft(spectrum * phases, n=nfft, axis=-1, workers=num_threads)
+        chunk = chunk[..., :ntimes]
+
+        chunk += mean + slope * (times + chunk_shifts)
+        series[:, :, start : start + CHUNK_SLICES] = chunk
+    return data
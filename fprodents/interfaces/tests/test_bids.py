@@ -0,0 +1,63 @@
+""" Testing module for fprodents.interfaces.DerivativesDataSink """
+from pathlib import Path
+
+import nibabel as nb
+import numpy as np
+import pandas as pd
+
+from .. import DerivativesDataSink
+from ...utils.confounds import read_confounds, sidecar_path, write_confounds
+
+
+def test_datasink_confounds_sidecar(tmp_path):
+    data = pd.DataFrame({"csf": [0.5, np.nan], "motion_outlier00": [1, 0]})
+    in_file = write_confounds(data, str(tmp_path / "confounds.tsv"))
+    source_file = tmp_path / "sub-01" / "func" / "sub-01_task-rest_bold.nii.gz"
+
+    result = DerivativesDataSink(
+        base_directory=str(tmp_path / "out"),
+        source_file=str(source_file),
+        in_file=in_file,
+        desc="confounds",
+        suffix="regressors",
+    ).run(cwd=str(tmp_path))
+
+    out_file = Path(result.outputs.out_file)
+    assert sidecar_path(out_file).is_file()
+    assert sidecar_path(out_file).stat().st_mtime >= out_file.stat().st_mtime
+    assert read_confounds(out_file).equals(data)
+
+
+def test_datasink_compressed_fixes(tmp_path, monkeypatch):
+    from ...utils import images
+
+    calls = []
+    gzip_file = images.gzip_file
+
+    def _gzip_file(*args, **kwargs):
+        calls.append(kwargs)
+        return gzip_file(*args, **kwargs)
+
+    monkeypatch.setattr(images, "gzip_file", _gzip_file)
+
+    data = np.arange(24, dtype="int16").reshape((2, 3, 4))
+    in_file = str(tmp_path / "bold.nii.gz")
+    nb.Nifti1Image(data, np.eye(4)).to_filename(in_file)  # header codes need fixing
+    source_file = tmp_path / "sub-01" / "func" / "sub-01_task-rest_bold.nii.gz"
+
+    result = DerivativesDataSink(
+        base_directory=str(tmp_path / "out"),
+        source_file=str(source_file),
+        in_file=in_file,
+        desc="preproc",
+        num_threads=2,
+    ).run(cwd=str(tmp_path))
+
+    assert result.outputs.fixed_hdr
+    assert result.outputs.compression
+    assert [kwargs["num_threads"] for kwargs in calls] == [2]
+    out_file = Path(result.outputs.out_file)
+    assert out_file.name.endswith(".nii.gz") and not Path(str(out_file)[:-3]).exists()
+    out_img = nb.load(out_file)
+    assert out_img.header.get_xyzt_units() == ("mm", "sec")
+    assert np.array_equal(np.asanyarray(out_img.dataobj), data)
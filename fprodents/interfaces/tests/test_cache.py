@@ -0,0 +1,32 @@
+""" Testing module for fprodents.interfaces.cache """
+import os
+
+import nibabel as nb
+import numpy as np
+
+from ..cache import CachedSplit, file_key
+
+
+def test_cached_split(tmp_path):
+    data = np.arange(2 * 3 * 4 * 70, dtype="int16").reshape((2, 3, 4, 70))
+    in_file = str(tmp_path / "bold.nii.gz")
+    nb.Nifti1Image(data, np.eye(4)).to_filename(in_file)
+
+    cache_dir = tmp_path / "cache"
+    out_files = CachedSplit(in_file=in_file, cache_dir=str(cache_dir)).run(
+        cwd=str(tmp_path)
+    ).outputs.out_files
+    assert len(out_files) == 70
+    for i in (0, 63, 64, 69):
+        assert np.array_equal(np.asanyarray(nb.load(out_files[i]).dataobj), data[..., i])
+
+    # The volumes are reused, until the series is rewritten
+    key = file_key(in_file)
+    assert [p.name for p in cache_dir.iterdir()] == [key]
+    nb.Nifti1Image(data[..., :5], np.eye(4)).to_filename(in_file)
+    os.utime(in_file, ns=(0, 0))
+    assert file_key(in_file) != key
+    out_files = CachedSplit(in_file=in_file, cache_dir=str(cache_dir)).run(
+        cwd=str(tmp_path)
+    ).outputs.out_files
+    assert len(out_files) == 5
@@ -0,0 +1,45 @@
+""" Testing module for fprodents.interfaces.resampling """
+import numpy as np
+import nibabel as nb
+
+from ..resampling import MergeSeries, ResampleSeries
+
+
+def _scaled_img(data):
+    # NiBabel scales floats into int16 (slope ~4.6e-5 for values in [0, 1.5])
+    img = nb.Nifti1Image(data, np.eye(4))
+    img.set_data_dtype("int16")
+    return img
+
+
+def test_resample_series_scaled(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.uniform(0, 1.5, size=(6, 6, 6, 4))
+    in_file = tmp_path / "bold.nii.gz"
+    _scaled_img(data).to_filename(str(in_file))
+    assert nb.load(str(in_file)).dataobj.slope < 1e-4
+
+    result = ResampleSeries(
+        in_file=str(in_file), ref_file=str(in_file), interpolation="Linear"
+    ).run(cwd=str(tmp_path))
+
+    out = nb.load(result.outputs.out_file)
+    assert out.get_data_dtype() == np.dtype("float32")
+    assert np.allclose(out.get_fdata(), nb.load(str(in_file)).get_fdata(), atol=1e-4)
+
+
+def test_merge_series_scaled(tmp_path):
+    rng = np.random.default_rng(0)
+    in_files = []
+    for i in range(3):
+        in_files.append(str(tmp_path / f"vol{i:04d}.nii.gz"))
+        _scaled_img(rng.uniform(0, 1.5 * (i + 1), size=(6, 6, 6))).to_filename(
+            in_files[-1]
+        )
+
+    result = MergeSeries(in_files=in_files).run(cwd=str(tmp_path))
+
+    expected = np.stack([nb.load(f).get_fdata() for f in in_files], axis=-1)
+    out = nb.load(result.outputs.out_file)
+    assert out.get_data_dtype() == np.dtype("float32")
+    assert np.allclose(out.get_fdata(), expected, atol=1e-6)
@@ -26,6 +26,7 @@ def init_bold_reference_wf(
     multiecho=False,
     name="bold_reference_wf",
     gen_report=False,
+    window=40,
 ):
     """
     Build a workflow that generates reference BOLD images for a series.
@@ -61,6 +62,9 @@ def init_bold_reference_wf(
         Name of workflow (default: ``bold_reference_wf``)
     gen_report : :obj:`bool`
         Whether a mask report node should be appended in the end
+    window : :obj:`int`
+        Number of leading volumes of the series read to detect nonsteady states
+        and to calculate the reference (between 10 and 200, default: 40)
     Inputs
     ------
     bold_file : str
@@ -135,7 +139,14 @@ methodology of *fMRIPrep*.
         iterfield=["in_file"],
     )
 
-    get_dummy = pe.Node(NonsteadyStatesDetector(), name="get_dummy")
+    # Only the leading volumes are read (and decompressed) to generate the reference
+    bold_window = pe.Node(
+        niu.Function(function=_head_series, output_names=["out_file"]),
+        name="bold_window",
+        mem_gb=DEFAULT_MEMORY_MIN_GB,
+    )
+    bold_window.inputs.nvols = window
+    get_dummy = pe.Node(NonsteadyStatesDetector(n_volumes=window), name="get_dummy")
     gen_avg = pe.Node(RobustAverage(), name="gen_avg", mem_gb=1)
 
     calc_dummy_scans = pe.Node(
@@ -154,7 +165,8 @@ methodology of *fMRIPrep*.
     # fmt: off
     workflow.connect([
         (inputnode, val_bold, [(("bold_file", listify), "in_file")]),
-        (inputnode, get_dummy, [(("bold_file", pop_file), "in_file")]),
+        (val_bold, bold_window, [(("out_file", pop_file), "in_file")]),  # first echo
+        (bold_window, get_dummy, [("out_file", "in_file")]),
         (inputnode, calc_dummy_scans, [("dummy_scans", "dummy_scans")]),
         (val_bold, bold_1st, [(("out_file", listify), "inlist")]),
         (get_dummy, calc_dummy_scans, [("n_dummy", "algo_dummy_scans")]),
@@ -203,7 +215,7 @@ methodology of *fMRIPrep*.
     if not sbref_files:
         # fmt: off
         workflow.connect([
-            (val_bold, gen_avg, [(("out_file", pop_file), "in_file")]),  # pop first echo of ME-EPI
+            (bold_window, gen_avg, [("out_file", "in_file")]),
             (get_dummy, gen_avg, [("t_mask", "t_mask")]),
         ])
         # fmt: on
@@ -252,3 +264,52 @@ by aligning and averaging{' the first echo of' * multiecho}
         # fmt: on
 
     return workflow
+
+
+def apply_reference_window(workflow, window=40):
+    """
+    Make *NiWorkflows*' ``init_epi_reference_wf`` read only the leading volumes of runs.
+
+    Nonsteady states are detected, and runs are averaged, on the first ``window``
+    volumes (between 10 and 200) of each validated run, instead of the full series.
+    The workflow is edited in place and returned.
+
+    """
+    validate_nii = workflow.get_node("validate_nii")
+    select_volumes = workflow.get_node("select_volumes")
+    per_run_avgs = workflow.get_node("per_run_avgs")
+
+    run_window = pe.MapNode(
+        niu.Function(function=_head_series, output_names=["out_file"]),
+        name="run_window",
+        iterfield=["in_file"],
+        mem_gb=DEFAULT_MEMORY_MIN_GB,
+    )
+    run_window.inputs.nvols = window
+
+    workflow.disconnect(validate_nii, "out_file", per_run_avgs, "in_file")
+    # fmt: off
+    workflow.connect([
+        (validate_nii, run_window, [("out_file", "in_file")]),
+        (run_window, per_run_avgs, [("out_file", "in_file")]),
+    ])
+    # fmt: on
+    if select_volumes is not None:
+        select_volumes.inputs.n_volumes = window
+        workflow.disconnect(validate_nii, "out_file", select_volumes, "in_file")
+        workflow.connect(run_window, "out_file", select_volumes, "in_file")
+    return workflow
+
+
+def _head_series(in_file, nvols):
+    """Extract the first nvols volumes of a 4D NIfTI-1 series (other images pass)."""
+    import os
+    import nibabel as nb
+    from nipype.utils.filemanip import split_filename
+    from fprodents.utils.images import head_series
+
+    img = nb.load(in_file)
+    if not isinstance(img, nb.Nifti1Image) or img.ndim != 4:
+        return in_file
+    _, base, _ = split_filename(in_file)
+    return head_series(in_file, nvols, os.path.join(os.getcwd(), base))
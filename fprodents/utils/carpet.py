@@ -0,0 +1,250 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Data and rendering of *carpet* plots.
+
+The data of carpet plots are extracted from the BOLD series in one streaming
+pass (:py:func:`carpet_data`), keeping a subsample of voxels of each label of
+the segmentation and, after detrending and standardizing them, a decimated set
+of time points.
+The resulting matrix is small (at most ``max_rows`` by ``max_timepoints``),
+and is cached as a NumPy ``.npz`` archive from which plots are rendered
+(:py:func:`plot_summary`) without loading the BOLD series again.
+
+"""
+import numpy as np
+import nibabel as nb
+
+#: Maximum number of voxels (rows) kept in carpet plots.
+MAX_ROWS = 800
+#: Maximum number of time points (columns) kept in carpet plots.
+MAX_TIMEPOINTS = 1200
+#: Number of volumes read at once.
+CHUNK_VOLS = 64
+
+
+def carpet_data(
+    in_file,
+    in_mask=None,
+    in_segm=None,
+    max_rows=MAX_ROWS,
+    max_timepoints=MAX_TIMEPOINTS,
+    detrend=True,
+    chunk_size=CHUNK_VOLS,
+):
+    """
+    Extract the matrix of a carpet plot, streaming the BOLD series once.
+
+    Voxels within the mask (and with a nonzero label, if a segmentation is given)
+    are subsampled with the same stride for all labels, so that at most
+    ``max_rows`` are kept.
+    Their time courses are (optionally) detrended and standardized, and then
+    decimated to at most ``max_timepoints`` time points.
+
+    Returns a dictionary with the matrix (``data``, rows by time points), the label
+    of each row (``labels``), the indices of the kept time points (``timepoints``),
+    and the number of volumes of the series (``nvols``).
+
+    >>> import os, tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), "bold.nii.gz")
+    >>> rng = np.random.default_rng(0)
+    >>> nb.Nifti1Image(
+    ...     rng.standard_normal((10, 10, 10, 30)).astype("float32"), np.eye(4)
+    ... ).to_filename(fname)
+    >>> carpet = carpet_data(fname, max_rows=100, max_timepoints=10, chunk_size=7)
+    >>> carpet["data"].shape, carpet["timepoints"].tolist()
+    ((100, 10), [0, 3, 6, 9, 12, 15, 18, 21, 24, 27])
+    >>> int(carpet["nvols"]), np.unique(carpet["labels"]).tolist()
+    (30, [1])
+
+    """
+    img = nb.load(in_file, keep_file_open=True)
+    nvols = img.shape[3]
+
+    mask = np.ones(img.shape[:3], dtype=bool)
+    if in_mask is not None:
+        mask = np.asanyarray(nb.load(in_mask).dataobj) > 0
+    labels = mask.astype("int16")
+    if in_segm is not None:
+        labels = np.asanyarray(nb.load(in_segm).dataobj).astype("int16")
+        labels[~mask] = 0
+
+    # Subsample voxels with a common stride, keeping them grouped by label
+    coords = np.nonzero(labels)
+    order = np.argsort(labels[coords], kind="stable")
+    stride = -(-order.size // max_rows) if order.size else 1
+    keep = np.concatenate(
+        [
+            order[labels[coords][order] == label][::stride]
+            for label in np.unique(labels[coords])
+        ]
+        or [np.zeros(0, dtype=int)]
+    )
+    coords = tuple(c[keep] for c in coords)
+
+    series = np.zeros((keep.size, nvols), dtype="float32")
+    for start in range(0, nvols, chunk_size):
+        chunk = img.dataobj[..., start : start + chunk_size]
+        series[:, start : start + chunk_size] = np.asanyarray(chunk)[coords]
+
+    if detrend:
+        series = _detrend(series)
+
+    tstep = max(-(-nvols // max_timepoints), 1)
+    return {
+        "data": np.ascontiguousarray(series[:, ::tstep]),
+        "labels": labels[coords],
+        "timepoints": np.arange(0, nvols, tstep),
+        "nvols": nvols,
+    }
+
+
+def save_carpet(carpet, out_file):
+    """Write carpet data (as returned by :py:func:`carpet_data`) into a ``.npz`` file."""
+    np.savez(out_file, **carpet)
+    return str(out_file)
+
+
+def load_carpet(in_file):
+    """Read carpet data written by :py:func:`save_carpet`."""
+    with np.load(in_file) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+def plot_summary(
+    carpet,
+    confounds=None,
+    units=None,
+    tr=None,
+    label_names=None,
+    raster=False,
+    figure=None,
+):
+    """
+    Plot confounds time series above the carpet plot of cached carpet data.
+
+    With ``raster=True``, the plotted data (but not the text) are rasterized
+    when saving into vector formats (e.g., embedded as PNG images into SVG files).
+
+    """
+    from matplotlib import pyplot as plt
+    from matplotlib import gridspec as mgs
+    import seaborn as sns
+    from niworkflows.viz.plots import confoundplot
+
+    sns.set_style("whitegrid")
+    sns.set_context("paper", font_scale=0.8)
+    if figure is None:
+        figure = plt.gcf()
+
+    units = units or {}
+    label_names = label_names or {}
+    columns = list(confounds.columns) if confounds is not None else []
+    nrows = 1 + len(columns)
+    grid = mgs.GridSpec(
+        nrows, 1, wspace=0.0, hspace=0.05, height_ratios=[1] * (nrows - 1) + [5]
+    )
+
+    palette = sns.color_palette("husl", len(columns))
+    for i, name in enumerate(columns):
+        confoundplot(
+            confounds[name].values.squeeze().tolist(),
+            grid[i],
+            tr=tr,
+            color=palette[i],
+            name=name,
+            units=units.get(name),
+        )
+
+    _plot_carpet(carpet, grid[-1], tr=tr, label_names=label_names)
+    if raster:
+        # Images, lines and patches are drawn below this order, text and axes above
+        for ax in figure.axes:
+            ax.set_rasterization_zorder(2.5)
+    return figure
+
+
+def _plot_carpet(carpet, subplot, tr=None, label_names=None):
+    from matplotlib import pyplot as plt
+    from matplotlib import gridspec as mgs
+    from matplotlib.patches import Patch
+
+    data, labels = carpet["data"], carpet["labels"]
+    segments = [(label, labels == label) for label in np.unique(labels)]
+    if not segments:
+        segments = [(0, np.zeros(0, dtype=bool))]
+    vminmax = np.percentile(data, (2, 98)) if data.size else (0, 1)
+    colors = plt.get_cmap("tab10").colors
+
+    gs = mgs.GridSpecFromSubplotSpec(
+        len(segments),
+        1,
+        subplot_spec=subplot,
+        hspace=0.05,
+        height_ratios=[max(int(rows.sum()), 1) for _, rows in segments],
+    )
+    timepoints = carpet["timepoints"]
+    for i, (label, rows) in enumerate(segments):
+        ax = plt.subplot(gs[i])
+        ax.imshow(
+            data[rows],
+            interpolation="nearest",
+            aspect="auto",
+            cmap="gray",
+            vmin=vminmax[0],
+            vmax=vminmax[1],
+        )
+        for side in ("top", "right"):
+            ax.spines[side].set_visible(False)
+        ax.spines["left"].set_linewidth(3)
+        ax.spines["left"].set_color(colors[i % len(colors)])
+        ax.spines["left"].set_position(("outward", 2))
+        ax.set_yticks([])
+        ax.grid(False)
+
+        if i < len(segments) - 1:
+            ax.set_xticks([])
+            ax.spines["bottom"].set_visible(False)
+            continue
+
+        xticks = np.linspace(0, data.shape[1] - 1, num=7) if data.shape[1] else []
+        volumes = np.interp(xticks, np.arange(timepoints.size), timepoints)
+        ax.set_xticks(xticks)
+        if tr is None:
+            ax.set_xlabel("time-points (index)")
+            ax.set_xticklabels([f"{int(v)}" for v in volumes])
+        else:
+            ax.set_xlabel("time (mm:ss)")
+            ax.set_xticklabels(
+                [f"{int(t // 60):02d}:{int(round(t % 60)):02d}" for t in tr * volumes]
+            )
+        ax.spines["bottom"].set_position(("outward", 5))
+        ax.spines["bottom"].set_color("k")
+
+    if len(segments) > 1:
+        ax.legend(
+            handles=[
+                Patch(
+                    color=colors[i % len(colors)],
+                    label=label_names.get(int(label), f"label {label}"),
+                )
+                for i, (label, _) in enumerate(segments)
+            ],
+            loc="upper center",
+            bbox_to_anchor=(0.5, -0.4),
+            ncol=min(len(segments), 5),
+            frameon=False,
+        )
+    return gs
+
+
+def _detrend(series):
+    """Remove the linear trend of each row and scale it to unit variance."""
+    time = np.linspace(-1, 1, series.shape[1], dtype=series.dtype)
+    series = series - series.mean(axis=1, keepdims=True)
+    if time.size > 1:
+        slope = series @ time / (time @ time)
+        series -= slope[:, np.newaxis] * time
+    std = series.std(axis=1, keepdims=True)
+    std[std < np.finfo(series.dtype).eps] = 1.0
+    return series / std
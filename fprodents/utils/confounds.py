@@ -0,0 +1,281 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Reading and writing confounds tables.
+
+Confounds tables are written as BIDS-compliant TSV files, next to which a
+columnar binary sidecar is written: a NumPy ``.npz`` archive with the same
+name, storing each column as a typed array (missing values as NaN) and the
+column names in order.
+Internal consumers read tables with :py:func:`read_confounds`, which loads
+the sidecar and only parses the TSV when the sidecar is missing (e.g., tables
+written by other tools) or older than the TSV.
+Sidecars are stored in the derivatives next to their tables
+(see :py:func:`copy_sidecar`).
+
+Confounds files may also be written with a *compact encoding*: the TSV file
+only holds the base confounds, and the metadata JSON file describes (under the
+:py:data:`COMPACT_KEY` key) the expansion of the confounds model as a formula
+over the base columns, and each spike regressor as the list of indices of its
+flagged volumes (see :py:func:`compact_encoding`).
+Such files are read with :py:func:`load_confounds`, which expands the requested
+columns on demand.
+
+"""
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+#: Extension of the binary sidecars.
+SIDECAR_EXT = ".npz"
+#: Rows formatted at a time when writing TSV files (bounds the memory of formatting).
+TSV_CHUNK_SIZE = 200
+#: Key of the compact encoding within the metadata of confounds files.
+COMPACT_KEY = "CompactEncoding"
+
+
+def sidecar_path(tsv_file):
+    """
+    Path of the binary sidecar of a confounds table.
+
+    >>> str(sidecar_path("/out/sub-01_desc-confounds_timeseries.tsv"))
+    '/out/sub-01_desc-confounds_timeseries.npz'
+
+    """
+    return Path(tsv_file).with_suffix(SIDECAR_EXT)
+
+
+def write_confounds(data, out_file):
+    """
+    Write a confounds table as a TSV file and its binary sidecar.
+
+    >>> import os, tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), "confounds.tsv")
+    >>> data = pd.DataFrame({"csf": [0.5, np.nan], "motion_outlier00": [1, 0]})
+    >>> _ = write_confounds(data, fname)
+    >>> print(open(fname).read().strip())
+    csf	motion_outlier00
+    0.5	1
+    n/a	0
+    >>> read_confounds(fname).dtypes.tolist()
+    [dtype('float64'), dtype('int64')]
+
+    """
+    data.to_csv(
+        str(out_file), sep="\t", index=False, na_rep="n/a", chunksize=TSV_CHUNK_SIZE
+    )
+    _write_sidecar(data, out_file)
+    return str(out_file)
+
+
+def copy_sidecar(in_file, out_file):
+    """
+    Copy the binary sidecar of a confounds table next to a copy of the table.
+
+    The sidecar is only copied if it is up to date, and after the table, so that
+    it is not older than the copy of the table.
+    Returns the path of the copy, or ``None`` if nothing was copied.
+
+    >>> import os, tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> fname = write_confounds(
+    ...     pd.DataFrame({"a": [0.1, 0.2]}), os.path.join(tmpdir, "confounds.tsv")
+    ... )
+    >>> out_file = os.path.join(tmpdir, "sub-01_desc-confounds_timeseries.tsv")
+    >>> _ = shutil.copyfile(fname, out_file)
+    >>> os.path.basename(copy_sidecar(fname, out_file))
+    'sub-01_desc-confounds_timeseries.npz'
+    >>> _has_sidecar(out_file)
+    True
+
+    """
+    if not _has_sidecar(in_file):
+        return None
+    return str(shutil.copyfile(sidecar_path(in_file), sidecar_path(out_file)))
+
+
+def join_confounds(in_file, join_file, out_file):
+    """
+    Join the columns of two confounds tables with the same number of rows.
+
+    The TSV files are joined line by line (without parsing them), and the
+    sidecar is joined from those of the inputs (if both have an up-to-date one).
+
+    >>> import os, tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> left, right, joined = (os.path.join(tmpdir, f"{n}.tsv") for n in "lrj")
+    >>> _ = write_confounds(pd.DataFrame({"a": [0.1, 0.2]}), left)
+    >>> _ = write_confounds(pd.DataFrame({"b": [1.5, np.nan]}), right)
+    >>> print(open(join_confounds(left, right, joined)).read().strip())
+    a	b
+    0.1	1.5
+    0.2	n/a
+    >>> read_confounds(joined).columns.tolist()
+    ['a', 'b']
+
+    """
+    with open(in_file) as fobj:
+        data = fobj.read().splitlines()
+    with open(join_file) as fobj:
+        join = fobj.read().splitlines()
+    if len(data) != len(join):
+        raise ValueError("Number of rows in datasets do not match")
+
+    Path(out_file).write_text("".join(f"{d}\t{j}\n" for d, j in zip(data, join)))
+    sidecar_path(out_file).unlink(missing_ok=True)
+    if _has_sidecar(in_file) and _has_sidecar(join_file):
+        _write_sidecar(
+            pd.concat((read_confounds(in_file), read_confounds(join_file)), axis=1),
+            out_file,
+        )
+    return str(out_file)
+
+
+def read_confounds(in_file):
+    """
+    Read a confounds table, from its binary sidecar if available and up to date.
+
+    >>> import os, tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), "confounds.tsv")
+    >>> _ = write_confounds(pd.DataFrame({"a": [0.1, 0.2], "b": [np.nan, 1.0]}), fname)
+    >>> read_confounds(fname)
+         a    b
+    0  0.1  NaN
+    1  0.2  1.0
+    >>> os.remove(sidecar_path(fname))
+    >>> read_confounds(fname)
+         a    b
+    0  0.1  NaN
+    1  0.2  1.0
+
+    """
+    if _has_sidecar(in_file):
+        with np.load(sidecar_path(in_file)) as npz:
+            columns = npz["columns"].tolist()
+            data = pd.DataFrame({i: npz[f"c{i:04d}"] for i in range(len(columns))})
+        data.columns = columns
+        return data
+    return pd.read_csv(in_file, sep="\t", na_values="n/a")
+
+
+def compact_encoding(data, model_formula, spikes):
+    """
+    Describe the expansion of a confounds model and its spike regressors compactly.
+
+    ``spikes`` is a table of (binary) spike regressors, with as many rows
+    as ``data``.
+    The encoding lists the names of all the columns of the dense table (in
+    order), the formula expanding ``data`` into its model (as taken by
+    :py:func:`niworkflows.interfaces.confounds.parse_formula`), and the
+    indices of the volumes flagged by each spike regressor.
+
+    >>> data = pd.DataFrame({"csf": [1.0, 2.0, 4.0], "std_dvars": [np.nan, 1.0, 2.0]})
+    >>> spikes = pd.DataFrame({"motion_outlier00": [0.0, 0.0, 1.0]})
+    >>> encoding = compact_encoding(data, "dd1(csf) + others", spikes)
+    >>> encoding["Columns"]
+    ['csf', 'csf_derivative1', 'std_dvars', 'motion_outlier00']
+    >>> encoding["Spikes"]
+    {'motion_outlier00': [2]}
+
+    """
+    columns = list(_expand_model(data, model_formula).columns)
+    return {
+        "Columns": columns + list(spikes.columns),
+        "Formula": model_formula,
+        "Spikes": {
+            name: np.flatnonzero(spikes[name].to_numpy()).tolist()
+            for name in spikes.columns
+        },
+    }
+
+
+def expand_confounds(data, encoding, columns=None):
+    """
+    Expand the columns of a compactly encoded confounds table.
+
+    Only the requested ``columns`` (by default, all of them, in the order of
+    the dense table, followed by those of ``data`` not covered by the encoding)
+    are calculated, and the model is only expanded if any of them requires it.
+
+    >>> data = pd.DataFrame({"csf": [1.0, 2.0, 4.0], "std_dvars": [np.nan, 1.0, 2.0]})
+    >>> encoding = {
+    ...     "Columns": ["csf", "csf_derivative1", "std_dvars", "motion_outlier00"],
+    ...     "Formula": "dd1(csf) + others",
+    ...     "Spikes": {"motion_outlier00": [2]},
+    ... }
+    >>> expand_confounds(data, encoding)
+       csf  csf_derivative1  std_dvars  motion_outlier00
+    0  1.0              NaN        NaN               0.0
+    1  2.0              1.0        1.0               0.0
+    2  4.0              2.0        2.0               1.0
+    >>> expand_confounds(data, encoding, columns=["motion_outlier00", "csf"])
+       motion_outlier00  csf
+    0               0.0  1.0
+    1               0.0  2.0
+    2               1.0  4.0
+
+    """
+    spikes = encoding.get("Spikes", {})
+    if columns is None:
+        columns = list(encoding["Columns"])
+        columns += [c for c in data.columns if c not in columns]
+
+    expanded = data
+    if any(c not in data.columns and c not in spikes for c in columns):
+        expanded = _expand_model(data, encoding["Formula"])
+        expanded = pd.concat(
+            (expanded, data[[c for c in data.columns if c not in expanded.columns]]),
+            axis=1,
+        )
+
+    out = {}
+    for name in columns:
+        if name in spikes:
+            values = np.zeros(len(data))
+            values[spikes[name]] = 1.0
+            out[name] = values
+        else:
+            out[name] = expanded[name].to_numpy()
+    return pd.DataFrame(out, columns=columns)
+
+
+def load_confounds(in_file, columns=None):
+    """
+    Read a confounds file, expanding its compact encoding (if any) on demand.
+
+    The metadata are read from the JSON file next to ``in_file``.
+    Densely written confounds files are returned as read.
+
+    """
+    data = read_confounds(in_file)
+    json_file = Path(in_file).with_suffix(".json")
+    metadata = json.loads(json_file.read_text()) if json_file.exists() else {}
+    if COMPACT_KEY not in metadata:
+        return data if columns is None else data[list(columns)]
+    return expand_confounds(data, metadata[COMPACT_KEY], columns=columns)
+
+
+def _expand_model(data, model_formula):
+    from niworkflows.interfaces.confounds import parse_formula
+
+    return parse_formula(
+        model_formula=model_formula, parent_data=data, unscramble=True
+    )[1]
+
+
+def _has_sidecar(in_file):
+    sidecar = sidecar_path(in_file)
+    return sidecar.exists() and sidecar.stat().st_mtime >= Path(in_file).stat().st_mtime
+
+
+def _write_sidecar(data, out_file):
+    columns = {}
+    for i in range(data.shape[1]):
+        values = data.iloc[:, i].to_numpy()
+        columns[f"c{i:04d}"] = values.astype(str) if values.dtype == object else values
+    np.savez(
+        sidecar_path(out_file), columns=np.array(data.columns, dtype=str), **columns
+    )
@@ -0,0 +1,532 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Image I/O utilities."""
+import gzip
+import os
+import shutil
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nb
+
+#: Offset of the data block in single-file NIfTI-1 images without extensions.
+VOX_OFFSET = 352
+#: Size of the uncompressed blocks deflated independently by each thread.
+GZIP_BLOCK_SIZE = 2 ** 20
+#: Size of the window of preceding data used to prime the compression of a block.
+GZIP_DICT_SIZE = 2 ** 15
+#: Number of volumes read at once when streaming series.
+CHUNK_VOLS = 64
+
+
+class ParallelGzipFile:
+    """
+    A write-only, block-parallel gzip file.
+
+    Data are split into blocks that are deflated concurrently (priming each
+    block with the tail of the previous one, as *pigz* does), and then
+    written in order as one single-member gzip stream, which any standard
+    gzip reader (including Python's :py:mod:`gzip` and NiBabel) can read.
+
+    >>> import gzip, os, tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), "data.gz")
+    >>> payload = bytes(range(256)) * 40000
+    >>> with ParallelGzipFile(fname, num_threads=4) as fobj:
+    ...     _ = fobj.write(payload[:1000])
+    ...     _ = fobj.write(payload[1000:])
+    >>> gzip.open(fname).read() == payload
+    True
+
+    """
+
+    def __init__(self, filename, mode="wb", compresslevel=1, num_threads=1):
+        if mode not in ("w", "wb"):
+            raise ValueError(f"Unsupported mode <{mode}>: only writing is possible.")
+        self.name = str(filename)
+        self.compresslevel = compresslevel
+        self._fobj = open(self.name, "wb")
+        self._pool = (
+            ThreadPoolExecutor(max_workers=num_threads) if num_threads > 1 else None
+        )
+        self._max_pending = 2 * max(num_threads, 1)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._zdict = b""
+        self._crc = 0
+        self._size = 0
+        # Member header: no flags, modification time, unknown OS
+        self._fobj.write(
+            b"\x1f\x8b\x08\x00" + struct.pack("<I", int(time.time())) + b"\x00\xff"
+        )
+
+    def write(self, data):
+        """Compress and write ``data``."""
+        data = memoryview(data).cast("B")
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= GZIP_BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:GZIP_BLOCK_SIZE]), last=False)
+            del self._buffer[:GZIP_BLOCK_SIZE]
+        return len(data)
+
+    def close(self):
+        """Flush all pending blocks and write the gzip trailer."""
+        if self._fobj is None:
+            return
+        self._submit(bytes(self._buffer), last=True)
+        self._buffer = bytearray()
+        while self._pending:
+            self._fobj.write(self._pending.popleft().result())
+        self._fobj.write(struct.pack("<II", self._crc, self._size & 0xFFFFFFFF))
+        self._fobj.close()
+        self._fobj = None
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def _submit(self, block, last):
+        args = (block, self._zdict, self.compresslevel, last)
+        self._zdict = block[-GZIP_DICT_SIZE:]
+        if self._pool is None:
+            self._fobj.write(_deflate(*args))
+            return
+
+        self._pending.append(self._pool.submit(_deflate, *args))
+        while len(self._pending) > self._max_pending or (
+            self._pending and self._pending[0].done()
+        ):
+            self._fobj.write(self._pending.popleft().result())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _deflate(block, zdict, level, last):
+    """Deflate one block into a raw stream ending at a byte boundary."""
+    kwargs = {"zdict": zdict} if zdict else {}
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, **kwargs)
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+
+
+def gzip_file(in_file, out_file, compresslevel=1, num_threads=1):
+    """Compress a file with :py:class:`ParallelGzipFile`."""
+    with open(in_file, "rb") as fin, ParallelGzipFile(
+        out_file, compresslevel=compresslevel, num_threads=num_threads
+    ) as fout:
+        shutil.copyfileobj(fin, fout, GZIP_BLOCK_SIZE)
+    return out_file
+
+
+class SeriesWriter:
+    """
+    Write a 4D NIfTI-1 series in chunks of volumes.
+
+    The header is written first, and then volumes are appended to the data
+    block as they are passed, so that only one chunk is held in memory at any
+    time.
+    Files ending in ``.gz`` are compressed on the fly, using ``num_threads``
+    threads (see :py:class:`ParallelGzipFile`).
+
+    Floating-point data written into integer types are rounded and clipped
+    to the range of the type (no scaling is applied, as the range of the full
+    series is not known in advance): callers write ``float32`` instead when the
+    source data are scaled (see :py:func:`is_scaled`).
+
+    >>> import os, tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), "series.nii.gz")
+    >>> data = np.arange(2 * 3 * 4 * 5, dtype="float32").reshape(2, 3, 4, 5)
+    >>> with SeriesWriter(fname, data.shape, np.eye(4), dtype="int16") as writer:
+    ...     writer.write(data[..., :2])
+    ...     writer.write(data[..., 2:])
+    >>> img = nb.load(fname)
+    >>> img.get_data_dtype().name, np.array_equal(img.get_fdata(), data)
+    ('int16', True)
+
+    """
+
+    def __init__(
+        self,
+        filename,
+        shape,
+        affine,
+        header=None,
+        dtype=None,
+        compresslevel=1,
+        num_threads=1,
+    ):
+        shape = tuple(shape) + (1,) * (4 - len(shape))
+        if dtype is None:
+            dtype = header.get_data_dtype() if header is not None else "float32"
+
+        # Let NiBabel fill in the header from a memory-less placeholder array
+        placeholder = nb.Nifti1Image(
+            np.broadcast_to(np.zeros((), dtype=dtype), shape),
+            affine,
+            nb.Nifti1Header.from_header(header) if header is not None else None,
+        )
+        placeholder.update_header()
+        self.header = placeholder.header
+        self.header.set_data_dtype(dtype)
+        self.header.set_slope_inter(1.0, 0.0)
+        # Extensions are not carried over, the data block starts right after the header
+        del self.header.extensions[:]
+        self.header["vox_offset"] = VOX_OFFSET
+
+        self.shape = shape
+        self.dtype = self.header.get_data_dtype()
+        self.filename = str(filename)
+        self._written = 0
+        self._fobj = (
+            ParallelGzipFile(
+                self.filename, compresslevel=compresslevel, num_threads=num_threads
+            )
+            if self.filename.endswith(".gz")
+            else open(self.filename, "wb")
+        )
+        self.header.write_to(self._fobj)
+
+    def write(self, block):
+        """Append a block of volumes (a 3D volume or a 4D array) to the series."""
+        block = np.asanyarray(block)
+        if block.ndim == 3:
+            block = block[..., np.newaxis]
+        if block.shape[:3] != self.shape[:3]:
+            raise ValueError(
+                f"Shape of the block {block.shape[:3]} does not match that of the "
+                f"series {self.shape[:3]}."
+            )
+        if self._written + block.shape[3] > self.shape[3]:
+            raise ValueError("Attempted to write more volumes than declared.")
+
+        # The transpose of a Fortran-ordered array exposes its bytes without a copy
+        self._fobj.write(np.asfortranarray(_cast(block, self.dtype)).T)
+        self._written += block.shape[3]
+
+    def close(self):
+        """Finalize the file, checking all declared volumes were written."""
+        if self._fobj is None:
+            return
+        self._fobj.close()
+        self._fobj = None
+        if self._written != self.shape[3]:
+            raise RuntimeError(
+                f"Only {self._written} out of {self.shape[3]} volumes were written "
+                f"to <{self.filename}>."
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self._fobj is not None:
+            self._fobj.close()
+            self._fobj = None
+            return
+        self.close()
+
+
+def _cast(data, dtype):
+    """Cast data into the output type, rounding and clipping into integer ranges."""
+    if data.dtype == dtype:
+        return data
+    if np.issubdtype(dtype, np.integer) and not np.issubdtype(data.dtype, np.integer):
+        info = np.iinfo(dtype)
+        data = np.clip(np.rint(data), info.min, info.max)
+    return data.astype(dtype)
+
+
+def is_scaled(img):
+    """
+    Check whether the data of an image are scaled (``scl_slope``/``scl_inter``).
+
+    NiBabel moves the scaling of loaded images from their header to their
+    array proxy, so the latter is checked.
+
+    >>> import os, tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), "scaled.nii")
+    >>> img = nb.Nifti1Image(np.linspace(0, 1.5, 8).reshape(2, 2, 2), np.eye(4))
+    >>> img.set_data_dtype("int16")
+    >>> img.to_filename(fname)
+    >>> is_scaled(img), is_scaled(nb.load(fname))
+    (False, True)
+
+    """
+    slope = getattr(img.dataobj, "slope", 1.0)
+    inter = getattr(img.dataobj, "inter", 0.0)
+    return slope != 1.0 or inter != 0.0
+
+
+def trim_series(in_file, skip_vols, out_base):
+    """
+    Drop the first ``skip_vols`` volumes of a 4D NIfTI-1 series, without rewriting it.
+
+    Uncompressed series are trimmed in O(header): the output is a NIfTI-1 pair
+    (``<out_base>.hdr``/``<out_base>.img``), whose image file is a hard link
+    to the input (or a copy of it, across file systems, see :py:func:`_link_data`)
+    and whose header skips the data of the dropped volumes (through
+    ``vox_offset``) and declares the remaining ones.
+    Compressed series, and those whose remaining data do not start at an offset
+    ``vox_offset`` can hold (see :py:func:`_viewable`), are copied into
+    ``<out_base>.nii`` instead, copying the bytes of the remaining volumes
+    (without decoding or recompressing them).
+    Data types and scaling are preserved in both cases.
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> data = np.arange(2 * 3 * 4 * 5, dtype="int16").reshape(2, 3, 4, 5)
+    >>> for ext in (".nii", ".nii.gz"):
+    ...     fname = os.path.join(tmpdir, f"series{ext}")
+    ...     nb.Nifti1Image(data, np.eye(4)).to_filename(fname)
+    ...     out = trim_series(fname, 2, os.path.join(tmpdir, f"cut{len(ext)}"))
+    ...     img = nb.load(out)
+    ...     print(os.path.basename(out), np.array_equal(img.dataobj, data[..., 2:]))
+    cut4.hdr True
+    cut7.nii True
+    >>> odd = np.arange(3 * 3 * 3 * 4, dtype="int16").reshape(3, 3, 3, 4)
+    >>> nb.Nifti1Image(odd, np.eye(4)).to_filename(os.path.join(tmpdir, "odd.nii"))
+    >>> out = trim_series(os.path.join(tmpdir, "odd.nii"), 1, os.path.join(tmpdir, "cut"))
+    >>> os.path.basename(out), np.array_equal(nb.load(out).dataobj, odd[..., 1:])
+    ('cut.nii', True)
+
+    """
+    img = _load_series(in_file)
+    hdr = img.header
+    nvols = img.shape[3] - skip_vols
+    offset = img.dataobj.offset + skip_vols * _volume_nbytes(hdr)
+    compressed = str(in_file).endswith(".gz")
+    if not compressed and _viewable(offset):
+        return _write_view(in_file, hdr, nvols, offset, out_base)
+
+    out_file = f"{out_base}.nii"
+    opener = gzip.open if compressed else open
+    with opener(in_file, "rb") as fin, open(out_file, "wb") as fout:
+        _single_header(hdr, nvols).write_to(fout)
+        fin.seek(offset)
+        shutil.copyfileobj(fin, fout, GZIP_BLOCK_SIZE)
+    return out_file
+
+
+def split_series(in_file, nchunks, out_base):
+    """
+    Split a 4D NIfTI-1 series into consecutive chunks of volumes, without rewriting it.
+
+    As with :py:func:`trim_series`, chunks of uncompressed series are NIfTI-1
+    pairs viewing the data of the input (where ``vox_offset`` can hold the start
+    of their data), and compressed series are decompressed once, copying the
+    bytes of each chunk into ``<out_base>_chunkXX.nii``.
+    Chunks differ in at most one volume, and there are at most as many as
+    volumes.
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> data = np.arange(2 * 3 * 4 * 5, dtype="int16").reshape(2, 3, 4, 5)
+    >>> for ext in (".nii", ".nii.gz"):
+    ...     fname = os.path.join(tmpdir, f"series{ext}")
+    ...     nb.Nifti1Image(data, np.eye(4)).to_filename(fname)
+    ...     chunks = split_series(fname, 3, os.path.join(tmpdir, f"split{len(ext)}"))
+    ...     parts = [np.asanyarray(nb.load(f).dataobj) for f in chunks]
+    ...     print(
+    ...         [os.path.basename(f) for f in chunks],
+    ...         [p.shape[3] for p in parts],
+    ...         np.array_equal(np.concatenate(parts, axis=3), data),
+    ...     )
+    ['split4_chunk00.hdr', 'split4_chunk01.hdr', 'split4_chunk02.hdr'] [2, 1, 2] True
+    ['split7_chunk00.nii', 'split7_chunk01.nii', 'split7_chunk02.nii'] [2, 1, 2] True
+
+    """
+    img = _load_series(in_file)
+    hdr = img.header
+    nvols = img.shape[3]
+    bounds = np.linspace(0, nvols, min(max(nchunks, 1), nvols) + 1).round().astype(int)
+    vol_nbytes = _volume_nbytes(hdr)
+
+    out_files = []
+    compressed = str(in_file).endswith(".gz")
+    opener = gzip.open if compressed else open
+    with opener(in_file, "rb") as fin:
+        for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+            offset = img.dataobj.offset + start * vol_nbytes
+            if not compressed and _viewable(offset):
+                out_files.append(
+                    _write_view(
+                        in_file, hdr, stop - start, offset, f"{out_base}_chunk{i:02d}"
+                    )
+                )
+                continue
+
+            # Offsets only grow, so compressed streams are decompressed once
+            fin.seek(offset)
+            out_file = f"{out_base}_chunk{i:02d}.nii"
+            with open(out_file, "wb") as fout:
+                _single_header(hdr, stop - start).write_to(fout)
+                _copy_bytes(fin, fout, (stop - start) * vol_nbytes)
+            out_files.append(out_file)
+    return out_files
+
+
+def head_series(in_file, nvols, out_base):
+    """
+    Extract the first ``nvols`` volumes of a 4D NIfTI-1 series into ``<out_base>.nii``.
+
+    Only the header and the bytes of the leading volumes are read: compressed
+    series are decompressed up to the end of the window, and the rest of the
+    file is never touched.
+    The bytes are copied without decoding them, so data types and scaling are
+    preserved.
+    Series shorter than ``nvols`` are copied whole.
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> data = np.arange(2 * 3 * 4 * 5, dtype="int16").reshape(2, 3, 4, 5)
+    >>> for ext in (".nii", ".nii.gz"):
+    ...     fname = os.path.join(tmpdir, f"series{ext}")
+    ...     nb.Nifti1Image(data, np.eye(4)).to_filename(fname)
+    ...     out = head_series(fname, 3, os.path.join(tmpdir, f"head{len(ext)}"))
+    ...     img = nb.load(out)
+    ...     print(os.path.basename(out), np.array_equal(img.dataobj, data[..., :3]))
+    head4.nii True
+    head7.nii True
+
+    """
+    img = _load_series(in_file)
+    hdr = img.header
+    nvols = min(nvols, img.shape[3])
+    opener = gzip.open if str(in_file).endswith(".gz") else open
+    out_file = f"{out_base}.nii"
+    with opener(in_file, "rb") as fin, open(out_file, "wb") as fout:
+        _single_header(hdr, nvols).write_to(fout)
+        fin.seek(img.dataobj.offset)
+        _copy_bytes(fin, fout, nvols * _volume_nbytes(hdr))
+    return out_file
+
+
+def prepend_volumes(in_file, series_file, nvols, out_file, compresslevel=1):
+    """
+    Write the first ``nvols`` volumes of ``in_file`` followed by ``series_file``.
+
+    Only the prepended volumes are read from ``in_file``, and ``series_file``
+    is streamed into the output :py:data:`CHUNK_VOLS` volumes at a time.
+    The output has the header of ``in_file``, and the data type holding the
+    values of both inputs.
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> data = np.arange(2 * 3 * 4 * 5, dtype="int16").reshape(2, 3, 4, 5)
+    >>> nb.Nifti1Image(data, np.eye(4)).to_filename(os.path.join(tmpdir, "a.nii.gz"))
+    >>> nb.Nifti1Image(data[..., 2:] / 2, np.eye(4)).to_filename(
+    ...     os.path.join(tmpdir, "b.nii.gz")
+    ... )
+    >>> out = prepend_volumes(
+    ...     os.path.join(tmpdir, "a.nii.gz"),
+    ...     os.path.join(tmpdir, "b.nii.gz"),
+    ...     2,
+    ...     os.path.join(tmpdir, "c.nii.gz"),
+    ... )
+    >>> img = nb.load(out)
+    >>> img.shape, img.get_data_dtype().name
+    ((2, 3, 4, 5), 'float64')
+    >>> np.array_equal(img.dataobj[..., 2:], data[..., 2:] / 2)
+    True
+
+    """
+    img = nb.load(in_file)
+    series = nb.load(series_file, keep_file_open=True)
+    dtype = np.promote_types(
+        np.asanyarray(img.dataobj[..., :1]).dtype,
+        np.asanyarray(series.dataobj[..., :1]).dtype,
+    )
+    total = nvols + series.shape[3]
+    with SeriesWriter(
+        out_file,
+        (*img.shape[:3], total),
+        img.affine,
+        img.header,
+        dtype=dtype,
+        compresslevel=compresslevel,
+    ) as writer:
+        writer.write(np.asanyarray(img.dataobj[..., :nvols]))
+        for start in range(0, series.shape[3], CHUNK_VOLS):
+            writer.write(np.asanyarray(series.dataobj[..., start : start + CHUNK_VOLS]))
+    return str(out_file)
+
+
+def _load_series(in_file):
+    img = nb.load(in_file)
+    if not isinstance(img, nb.Nifti1Image) or img.ndim != 4:
+        raise ValueError(f"<{in_file}> is not a 4D, single-file NIfTI-1 series.")
+    return img
+
+
+def _viewable(offset):
+    """
+    Check whether a NIfTI-1 view can start its data at ``offset``.
+
+    ``vox_offset`` is stored as a 32-bit float (which holds integers exactly only
+    up to 2 ** 24, and even ones up to 2 ** 25, etc.), and NiBabel expects it to be
+    a multiple of 16.
+
+    >>> _viewable(352), _viewable(406), _viewable(34719552), _viewable(34719562)
+    (True, False, True, False)
+
+    """
+    return offset % 16 == 0 and float(np.float32(offset)) == offset
+
+
+def _write_view(in_file, hdr, nvols, offset, out_base):
+    """Write a NIfTI-1 pair viewing ``nvols`` volumes of ``in_file`` from ``offset``."""
+    view = nb.nifti1.Nifti1PairHeader.from_header(hdr)
+    del view.extensions[:]
+    view.set_data_shape((*hdr.get_data_shape()[:3], nvols))
+    view.set_data_offset(offset)
+    out_file = f"{out_base}.hdr"
+    with open(out_file, "wb") as fobj:
+        view.write_to(fobj)
+    _link_data(in_file, f"{out_base}.img")
+    return out_file
+
+
+def _single_header(hdr, nvols):
+    out_hdr = nb.Nifti1Header.from_header(hdr)
+    del out_hdr.extensions[:]
+    out_hdr.set_data_shape((*hdr.get_data_shape()[:3], nvols))
+    out_hdr.set_data_offset(VOX_OFFSET)
+    return out_hdr
+
+
+def _copy_bytes(fin, fout, nbytes):
+    while nbytes > 0:
+        block = fin.read(min(nbytes, GZIP_BLOCK_SIZE))
+        if not block:
+            raise ValueError("Unexpected end of the data of the series.")
+        fout.write(block)
+        nbytes -= len(block)
+
+
+def _volume_nbytes(hdr):
+    shape = hdr.get_data_shape()
+    return int(np.prod(shape[:3])) * hdr.get_data_dtype().itemsize
+
+
+def _link_data(in_file, out_file):
+    """
+    Hard link ``in_file`` to ``out_file``, or copy it across file systems.
+
+    Unlike symbolic links, outputs remain valid if the directory of the input is
+    removed, and NiPype hashes them as regular files.
+
+    """
+    if os.path.lexists(out_file):
+        os.remove(out_file)
+    try:
+        os.link(os.path.realpath(in_file), out_file)
+    except OSError:
+        shutil.copyfile(in_file, out_file)
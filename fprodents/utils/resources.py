@@ -0,0 +1,359 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Estimation of the memory requirements of nodes.
+
+The memory a node needs is modeled as a linear function of two features read
+from the image headers (never from the data):
+
+``bold_gb``
+    The size of the BOLD series once loaded as ``float32`` in memory
+    (voxels per volume × volumes × 4 bytes).
+``target_gb``
+    The same size, but for the largest output grid the series is resampled
+    onto (the BOLD grid itself if no larger target is known).
+
+Coefficients (``intercept + bold * bold_gb + target * target_gb``) are read
+from a JSON file (``fprodents/data/memory_coefficients.json`` by default).
+Its ``roles`` section gives the generic estimates the BOLD workflows hand down
+to their sub-workflows (``filesize``, ``resampled`` and ``largemem``), and its
+``interfaces`` section, generated by ``fprodents-calibrate-memory`` from
+resource-monitor profiles, overrides the estimate of every node running one
+of the listed interfaces.
+
+Finally, the peaks of memory and CPU usage measured for each node by Nipype's
+resource monitor in a previous run can be summarized into a table of
+resources per node (see :py:func:`summarize_profile` and :py:func:`profile_key`),
+which adjusts the requests of the same nodes in the next build of the workflow
+(see :py:func:`apply_resource_profile`).
+
+"""
+import json
+import re
+from pathlib import Path
+
+import numpy as np
+import nibabel as nb
+from pkg_resources import resource_filename as pkgrf
+
+#: The coefficients shipped with the package.
+DEFAULT_COEFFICIENTS = Path(pkgrf("fprodents", "data/memory_coefficients.json"))
+#: The features of the model, in the order of the design matrix (after the intercept).
+FEATURES = ("bold", "target")
+#: Nodes are never assigned less memory than this (in GB).
+MIN_MEM_GB = 0.01
+#: Headroom over the peaks of memory measured by the resource monitor.
+PROFILE_MEM_MARGIN = 1.2
+#: Percentile of the CPU-usage samples of a node taken as the CPUs it needs.
+PROFILE_CPU_PERCENTILE = 95
+_GB = 1024 ** 3
+
+
+def grid_size(shape):
+    """Number of voxels of one volume."""
+    return int(np.prod(shape[:3], dtype="int64"))
+
+
+def template_grid_size(template, spec, zooms):
+    """
+    Estimate the number of voxels of a standard-space output grid.
+
+    Grids are derived from TemplateFlow's metadata (without fetching any
+    image): with an explicit resolution, the grid of that resolution is
+    returned; otherwise the field of view of the template is sampled at
+    ``zooms`` (as done for outputs at "native" resolution).
+    ``None`` is returned if the template does not describe its grids.
+
+    """
+    from templateflow.api import get_metadata
+
+    try:
+        resolutions = get_metadata(template.split(":")[0]).get("res") or {}
+    except Exception:
+        return None
+    if not resolutions:
+        return None
+
+    res = spec.get("res", spec.get("resolution", "native"))
+    if res != "native":
+        for key, grid in resolutions.items():
+            if str(key).lstrip("0") == str(res).lstrip("0"):
+                return grid_size(grid["shape"])
+
+    grid = next(iter(resolutions.values()))
+    fov = np.array(grid["shape"][:3]) * np.array(grid["zooms"][:3])
+    return int(np.prod(np.ceil(fov / np.array(zooms[:3]))))
+
+
+def bold_features(bold_file, target_sizes=()):
+    """
+    Calculate the features of the memory model for one BOLD series.
+
+    Parameters
+    ----------
+    bold_file : :obj:`str`
+        The BOLD series (only its header is read).
+    target_sizes : :obj:`list` of :obj:`int`
+        The number of voxels of each output grid (``None`` items are skipped).
+
+    Returns
+    -------
+    nvols : :obj:`int`
+        The number of volumes of the series.
+    features : :obj:`dict`
+        The features of the model, in GB.
+
+    >>> import os, tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), "bold.nii")
+    >>> nb.Nifti1Image(np.zeros((64, 64, 32, 128), dtype="int16"), None).to_filename(fname)
+    >>> nvols, features = bold_features(fname, [2 * 64 * 64 * 32])
+    >>> nvols, features["bold"], features["target"]
+    (128, 0.0625, 0.125)
+
+    """
+    shape = nb.load(bold_file).shape
+    nvols = shape[3] if len(shape) > 3 else 1
+    voxels = max([grid_size(shape)] + [s for s in target_sizes if s])
+    return nvols, {
+        "bold": grid_size(shape) * nvols * 4 / _GB,
+        "target": voxels * nvols * 4 / _GB,
+    }
+
+
+class MemoryEstimator:
+    """
+    Estimate the memory of nodes from calibrated coefficients.
+
+    >>> estimator = MemoryEstimator({
+    ...     "roles": {"resampled": {"intercept": 0.5, "bold": 1.0, "target": 2.0}},
+    ...     "interfaces": {"MergeSeries": {"intercept": 0.2, "bold": 0.0, "target": 0.0}},
+    ... })
+    >>> estimator.estimate("resampled", {"bold": 0.25, "target": 0.5})
+    1.75
+    >>> estimator.estimate("MergeSeries", {"bold": 0.25, "target": 0.5})
+    0.2
+    >>> estimator.estimate("ApplyTransforms", {"bold": 0.25, "target": 0.5}) is None
+    True
+
+    """
+
+    def __init__(self, coefficients):
+        self.roles = coefficients.get("roles", {})
+        self.interfaces = coefficients.get("interfaces", {})
+
+    @classmethod
+    def from_file(cls, filename=None):
+        """Read coefficients from a JSON file (the package's default if ``None``)."""
+        return cls(json.loads(Path(filename or DEFAULT_COEFFICIENTS).read_text()))
+
+    def estimate(self, name, features):
+        """Estimate the memory (GB) of a role or an interface, ``None`` if unknown."""
+        coef = self.interfaces.get(name, self.roles.get(name))
+        if coef is None:
+            return None
+        mem_gb = coef.get("intercept", 0.0) + sum(
+            coef.get(key, 0.0) * features[key] for key in FEATURES
+        )
+        return round(max(mem_gb, MIN_MEM_GB), 4)
+
+    def role_estimates(self, features):
+        """Estimate the memory of every role."""
+        return {role: self.estimate(role, features) for role in self.roles}
+
+    def update_nodes(self, workflow, features):
+        """Set the memory of the nodes in ``workflow`` with calibrated interfaces."""
+        for name in workflow.list_node_names():
+            node = workflow.get_node(name)
+            coef = self.interfaces.get(node.interface.__class__.__name__)
+            if coef is not None:
+                node._mem_gb = self.estimate(node.interface.__class__.__name__, features)
+
+
+def fit_coefficients(features, peaks):
+    """
+    Fit the coefficients of one interface to measured peaks of memory.
+
+    A non-negative least-squares fit is shifted up by its largest
+    underestimation, so that no calibration sample is assigned less memory than
+    it actually used.
+
+    >>> features = [{"bold": b, "target": t} for b, t in ((1, 1), (2, 3), (4, 4))]
+    >>> peaks = [0.5 + b + 0.5 * t["target"] for b, t in zip((1, 2, 4), features)]
+    >>> fit = fit_coefficients(features, peaks)
+    >>> {k: round(v, 3) for k, v in fit.items() if k != "samples"}
+    {'intercept': 0.5, 'bold': 1.0, 'target': 0.5}
+
+    """
+    from scipy.optimize import nnls
+
+    design = np.array([[1.0] + [f[key] for key in FEATURES] for f in features])
+    peaks = np.asanyarray(peaks, dtype=float)
+    coef, _ = nnls(design, peaks)
+    coef[0] += max(float(np.max(peaks - design @ coef)), 0.0)
+    return {
+        "intercept": float(coef[0]),
+        **{key: float(c) for key, c in zip(FEATURES, coef[1:])},
+        "samples": int(len(peaks)),
+    }
+
+
+def profile_samples(filename):
+    """
+    Group the samples of a resource-monitor profile by node.
+
+    Returns a dictionary mapping ``(node fullname, interface name, parameterization)``
+    to the lists of memory (RSS, GB) and CPU-usage samples of the node.
+
+    """
+    profile = json.loads(Path(filename).read_text())
+    samples = {}
+    for name, interface, params, rss, cpus in zip(
+        profile["name"],
+        profile["interface"],
+        profile["params"],
+        profile["rss_GiB"],
+        profile["cpus"],
+    ):
+        node = samples.setdefault((name, interface, params), ([], []))
+        node[0].append(rss or 0.0)
+        node[1].append(cpus or 0.0)
+    return samples
+
+
+def profile_key(fullname):
+    """
+    Derive the key of a node in tables of resources from its full name.
+
+    The top-level and subject workflows are dropped, and the names of the BOLD
+    workflows of every run are replaced with ``func_preproc_wf``, so that the
+    same node of different subjects and runs shares one key (iterables are not
+    part of full names).
+
+    >>> profile_key("fmriprep_wf.single_subject_01_wf."
+    ...             "func_preproc_task_rest_run_01_wf.bold_std_trans_wf.merge")
+    'func_preproc_wf.bold_std_trans_wf.merge'
+    >>> profile_key("fmriprep_wf.single_subject_01_wf.anat_preproc_wf.ds_t2w")
+    'anat_preproc_wf.ds_t2w'
+    >>> profile_key("wf.acompcor")
+    'acompcor'
+
+    """
+    parts = fullname.split(".")
+    subject = [i for i, part in enumerate(parts) if part.startswith("single_subject_")]
+    parts = parts[subject[-1] + 1 :] if subject else parts[1:]
+    return ".".join(
+        "func_preproc_wf" if re.fullmatch(r"func_preproc_\w+_wf", part) else part
+        for part in parts
+    )
+
+
+def summarize_profile(filename):
+    """
+    Tabulate the peak resources used by the nodes of a resource-monitor profile.
+
+    Nodes are grouped by :py:func:`profile_key` (i.e., the same node of different
+    subjects, runs or iterables is summarized into one entry), keeping the largest
+    peak of memory and CPU usage.
+    The resource monitor samples CPU usage as percentages (100 per busy core), which
+    are converted into numbers of CPUs.
+
+    >>> import os, tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), "resource_monitor.json")
+    >>> with open(fname, "w") as f:
+    ...     json.dump({
+    ...         "name": [
+    ...             "wf.single_subject_01_wf.func_preproc_run_1_wf.acompcor",
+    ...             "wf.single_subject_01_wf.func_preproc_run_1_wf.acompcor",
+    ...             "wf.single_subject_02_wf.func_preproc_run_2_wf.acompcor",
+    ...             "wf.single_subject_02_wf.func_preproc_run_2_wf.bold_t1_trans_wf.merge",
+    ...         ],
+    ...         "interface": ["ACompCor"] * 3 + ["MergeSeries"],
+    ...         "params": [""] * 4,
+    ...         "rss_GiB": [0.5, 1.5, 1.0, 0.2],
+    ...         "cpus": [100.0, 180.0, 50.0, 90.0],
+    ...     }, f)
+    >>> table = summarize_profile(fname)
+    >>> list(table)
+    ['func_preproc_wf.acompcor', 'func_preproc_wf.bold_t1_trans_wf.merge']
+    >>> table["func_preproc_wf.acompcor"]
+    {'interface': 'ACompCor', 'mem_gb': 1.5, 'cpus': 1.76, 'nodes': 2}
+
+    """
+    table = {}
+    for (name, interface, _), (rss, cpus) in profile_samples(filename).items():
+        entry = table.setdefault(
+            profile_key(name),
+            {"interface": interface, "mem_gb": 0.0, "cpus": 0.0, "nodes": 0},
+        )
+        entry["mem_gb"] = round(max(entry["mem_gb"], max(rss)), 4)
+        entry["cpus"] = round(
+            max(
+                entry["cpus"],
+                float(np.percentile(cpus, PROFILE_CPU_PERCENTILE)) / 100,
+            ),
+            2,
+        )
+        entry["nodes"] += 1
+    return dict(sorted(table.items()))
+
+
+def apply_resource_profile(workflow, table, max_procs=None):
+    """
+    Override the resources requested by nodes with those measured in a previous run.
+
+    Nodes are matched by :py:func:`profile_key` and interface (so that a node
+    running a different interface than that profiled, e.g., after switching the
+    resampling engine, keeps its estimate).
+    Memory requests are set to the measured peak with some headroom
+    (:py:data:`PROFILE_MEM_MARGIN`).
+    CPU requests are only ever raised to the CPUs used (rounded up, and at most
+    ``max_procs``), which also sets the number of threads of interfaces accepting
+    ``num_threads``: the usage measured is bounded by the threads a node was
+    given, so lowering requests after it would keep shrinking them run after run.
+
+    Returns the number of nodes updated.
+
+    >>> from nipype.pipeline import engine as pe
+    >>> from nipype.interfaces import utility as niu
+    >>> workflow = pe.Workflow(name="wf")
+    >>> node = pe.Node(niu.IdentityInterface(fields=["in_file"]), name="acompcor")
+    >>> other = pe.Node(
+    ...     niu.IdentityInterface(fields=["in_file"]), name="merge", n_procs=4
+    ... )
+    >>> workflow.add_nodes([node, other])
+    >>> table = {
+    ...     "acompcor": {"interface": "IdentityInterface", "mem_gb": 1.5,
+    ...                  "cpus": 1.76, "nodes": 2},
+    ...     "merge": {"interface": "IdentityInterface", "mem_gb": 0.5,
+    ...               "cpus": 0.9, "nodes": 1},
+    ... }
+    >>> apply_resource_profile(workflow, table, max_procs=8)
+    2
+    >>> node.n_procs, node.mem_gb, other.n_procs, other.mem_gb
+    (2, 1.8, 4, 0.6)
+
+    """
+    updated = 0
+    for fullname, node in _iter_nodes(workflow):
+        entry = table.get(profile_key(fullname))
+        if entry is None or entry["interface"] != node.interface.__class__.__name__:
+            continue
+        if entry["mem_gb"] > 0:
+            node._mem_gb = round(max(entry["mem_gb"] * PROFILE_MEM_MARGIN, MIN_MEM_GB), 4)
+        n_procs = int(min(np.ceil(entry["cpus"]), max_procs or np.inf))
+        if n_procs > node.n_procs:
+            node.n_procs = n_procs
+        updated += 1
+    return updated
+
+
+def _iter_nodes(workflow, prefix=""):
+    """Iterate over the nodes of a workflow and its sub-workflows, with full names."""
+    from nipype.pipeline.engine import Workflow
+
+    prefix = f"{prefix}{workflow.name}."
+    for node in workflow._graph.nodes():
+        if isinstance(node, Workflow):
+            yield from _iter_nodes(node, prefix)
+        else:
+            yield prefix + node.name, node
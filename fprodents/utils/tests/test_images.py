@@ -0,0 +1,45 @@
+""" Testing module for fprodents.utils.images """
+import shutil
+
+import numpy as np
+import nibabel as nb
+
+from ..images import split_series, trim_series
+
+
+def _large_series(tmp_path):
+    # Data starting after 45 volumes lie at an offset float32 cannot represent
+    data = (np.arange(97 * 97 * 41 * 50) % 32749).astype("int16").reshape(97, 97, 41, 50)
+    in_file = tmp_path / "series.nii"
+    nb.Nifti1Image(data, np.eye(4)).to_filename(str(in_file))
+    return in_file, data
+
+
+def test_trim_series_large_offset(tmp_path):
+    in_file, data = _large_series(tmp_path)
+    out_file = trim_series(str(in_file), 45, str(tmp_path / "cut"))
+
+    assert out_file.endswith(".nii")
+    assert np.array_equal(np.asanyarray(nb.load(out_file).dataobj), data[..., 45:])
+
+
+def test_split_series_large_offset(tmp_path):
+    in_file, data = _large_series(tmp_path)
+    chunks = split_series(str(in_file), 7, str(tmp_path / "split"))
+
+    parts = [np.asanyarray(nb.load(f).dataobj) for f in chunks]
+    assert np.array_equal(np.concatenate(parts, axis=3), data)
+
+
+def test_trim_series_outlives_input(tmp_path):
+    data = np.arange(2 * 3 * 4 * 5, dtype="int16").reshape(2, 3, 4, 5)
+    in_dir = tmp_path / "upstream"
+    in_dir.mkdir()
+    in_file = in_dir / "series.nii"
+    nb.Nifti1Image(data, np.eye(4)).to_filename(str(in_file))
+    out_file = trim_series(str(in_file), 2, str(tmp_path / "cut"))
+
+    assert out_file.endswith(".hdr")
+    assert not (tmp_path / "cut.img").is_symlink()
+    shutil.rmtree(in_dir)
+    assert np.array_equal(np.asanyarray(nb.load(out_file).dataobj), data[..., 2:])
@@ -0,0 +1,36 @@
+""" Testing module for fprodents.utils.resources """
+import os
+
+import numpy as np
+import nibabel as nb
+
+from ..resources import MemoryEstimator, bold_features
+
+
+def _file_size_estimates(bold_fname):
+    # The estimates of the removed ``_create_mem_gb`` (from the size of the file)
+    bold_size_gb = os.path.getsize(bold_fname) / (1024 ** 3)
+    bold_tlen = nb.load(bold_fname).shape[-1]
+    return {
+        "filesize": bold_size_gb,
+        "resampled": bold_size_gb * 4,
+        "largemem": bold_size_gb * (max(bold_tlen / 100, 1.0) + 4),
+    }
+
+
+def test_default_estimates(tmp_path):
+    """Default estimates are not below the file-size heuristics for a rodent run."""
+    shape = (64, 64, 32, 1000)
+    bold_file = tmp_path / "bold.nii"
+    header = nb.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype("int16")
+    with open(bold_file, "wb") as fobj:
+        header.write_to(fobj)
+        # An uncompressed series (gzipped ones are smaller), without writing the data
+        fobj.truncate(int(header["vox_offset"]) + 2 * int(np.prod(shape)))
+
+    _, features = bold_features(str(bold_file))
+    estimates = MemoryEstimator.from_file().role_estimates(features)
+    for role, mem_gb in _file_size_estimates(str(bold_file)).items():
+        assert estimates[role] >= mem_gb
@@ -0,0 +1,193 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Utilities to handle chains of spatial transforms."""
+import numpy as np
+import nibabel as nb
+
+#: Conversion between RAS and LPS coordinates (its own inverse).
+RAS2LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+#: Extension of binary transform stacks.
+XFM_STACK_EXT = ".npy"
+
+
+def is_xfm_stack(fname):
+    """Check whether a file is a binary transform stack (by its extension)."""
+    return str(fname).endswith(XFM_STACK_EXT)
+
+
+def save_xfm_stack(matrices, fname):
+    """
+    Write affines into a binary transform stack.
+
+    Stacks are NumPy (``.npy``) files holding an (N, 3, 4) array of ``float64``,
+    the top three rows of N affines mapping RAS coordinates (in mm) of the
+    reference onto the moving image (i.e., the same convention as ITK
+    transforms, after conversion from LPS).
+    Unlike ITK text files, they are read at full precision without parsing
+    (see :py:func:`load_xfm_stack`).
+
+    >>> import os, tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), "xforms.npy")
+    >>> matrices = np.tile(np.eye(4), (3, 1, 1))
+    >>> matrices[:, 0, 3] = [0.1, 1 / 3, -2.0]
+    >>> save_xfm_stack(matrices, fname) == fname
+    True
+    >>> np.load(fname).shape
+    (3, 3, 4)
+    >>> np.array_equal(load_xfm_stack(fname), matrices)
+    True
+
+    """
+    matrices = np.asanyarray(matrices, dtype="float64")
+    stack = matrices.reshape(-1, *matrices.shape[-2:])[:, :3]
+    np.save(fname, np.ascontiguousarray(stack))
+    return str(fname)
+
+
+def load_xfm_stack(fname):
+    """Read a binary transform stack into an (N, 4, 4) array of RAS affines."""
+    stack = np.load(fname)
+    if stack.ndim != 3 or stack.shape[1:] != (3, 4):
+        raise ValueError(
+            f"<{fname}> is not a transform stack (expected shape (N, 3, 4), got "
+            f"{stack.shape})."
+        )
+    matrices = np.zeros((stack.shape[0], 4, 4))
+    matrices[:, :3] = stack
+    matrices[:, 3, 3] = 1.0
+    return matrices
+
+
+def load_transform(fname):
+    """Load one transform file into a :py:mod:`nitransforms` object."""
+    import nitransforms as nt
+
+    fname = str(fname)
+    if fname.endswith(".h5"):
+        return nt.manip.load(fname, fmt="h5")
+    if fname.endswith((".nii", ".nii.gz")):
+        return nt.nonlinear.load(fname, fmt="itk")
+    return nt.linear.load(fname, fmt="itk")
+
+
+def flatten_chain(transforms):
+    """
+    Load a list of transform files (in ANTs order) as a flat list of transforms.
+
+    Composite (``.h5``) files are expanded into their components.
+
+    """
+    from nitransforms.manip import TransformChain
+
+    flat = []
+    for xfm in (load_transform(f) for f in transforms):
+        if isinstance(xfm, TransformChain):
+            flat += list(xfm.transforms)
+        else:
+            flat.append(xfm)
+    return flat
+
+
+def compose_affines(matrices):
+    """
+    Compose affines listed in ANTs order (i.e., the first is applied first to points).
+
+    >>> shift = np.eye(4)
+    >>> shift[0, 3] = 2.0
+    >>> scale = np.diag([2.0, 2.0, 2.0, 1.0])
+    >>> compose_affines([shift, scale])[:3, 3].tolist()
+    [4.0, 0.0, 0.0]
+    >>> compose_affines([scale, shift])[:3, 3].tolist()
+    [2.0, 0.0, 0.0]
+
+    """
+    out = np.eye(4)
+    for matrix in matrices:
+        out = np.asanyarray(matrix) @ out
+    return out
+
+
+def _is_affine(xfm):
+    matrix = getattr(xfm, "matrix", None)
+    return matrix is not None and np.asanyarray(matrix).shape == (4, 4)
+
+
+def compile_chain(transforms, reference, chunk_size=2 ** 20):
+    """
+    Reduce a chain of transforms to one displacements field and one affine.
+
+    The chain is given in ANTs order.
+    The trailing run of linear transforms is composed analytically into one
+    affine, and everything before it (if any nonlinear transform is present)
+    is sampled once on the grid of ``reference`` into a displacements field.
+    Mapping a point through the chain is then equivalent to adding the
+    displacement at that point and applying the affine.
+
+    Returns
+    -------
+    field : :obj:`numpy.ndarray` or ``None``
+        Displacements (in RAS, mm) with shape ``reference.shape[:3] + (3,)``,
+        or ``None`` if the chain is linear.
+    affine : :obj:`numpy.ndarray`
+        A 4x4 RAS matrix.
+
+    """
+    xforms = flatten_chain(transforms)
+
+    nlinear = 0
+    while nlinear < len(xforms) and _is_affine(xforms[len(xforms) - nlinear - 1]):
+        nlinear += 1
+    split = len(xforms) - nlinear
+    affine = compose_affines([np.asanyarray(x.matrix) for x in xforms[split:]])
+
+    if split == 0:
+        return None, affine
+
+    shape = reference.shape[:3]
+    ijk = np.moveaxis(np.indices(shape, dtype="float32"), 0, -1).reshape(-1, 3)
+    field = np.empty_like(ijk)
+    for start in range(0, ijk.shape[0], chunk_size):
+        points = nb.affines.apply_affine(reference.affine, ijk[start : start + chunk_size])
+        mapped = points
+        for xfm in xforms[:split]:
+            mapped = np.asanyarray(xfm.map(mapped)).reshape(-1, 3)
+        field[start : start + chunk_size] = mapped - points
+    return field.reshape(*shape, 3), affine
+
+
+def itk_affines(matrices):
+    """
+    Serialize RAS affines into the contents of an ITK transform file.
+
+    >>> print(itk_affines([np.eye(4)]))
+    #Insight Transform File V1.0
+    #Transform 0
+    Transform: AffineTransform_double_3_3
+    Parameters: 1 0 0 0 1 0 0 0 1 0 0 0
+    FixedParameters: 0 0 0
+    <BLANKLINE>
+
+    """
+    lps = RAS2LPS @ np.asanyarray(matrices).reshape(-1, 4, 4) @ RAS2LPS
+    params = np.hstack((lps[:, :3, :3].reshape(-1, 9), lps[:, :3, 3])) + 0.0
+    template = (
+        "#Transform {}\nTransform: AffineTransform_double_3_3\nParameters: "
+        + " ".join(["{:.10g}"] * 12)
+        + "\nFixedParameters: 0 0 0\n"
+    )
+    return "#Insight Transform File V1.0\n" + "".join(
+        template.format(i, *row) for i, row in enumerate(params.tolist())
+    )
+
+
+def itk_displacements(field, reference):
+    """Generate an ITK displacements field image from RAS displacements."""
+    data = np.asanyarray(field, dtype="float32")[:, :, :, np.newaxis, :].copy()
+    data[..., (0, 1)] *= -1.0
+    hdr = nb.Nifti1Header()
+    hdr.set_intent("vector")
+    hdr.set_xyzt_units("mm")
+    img = nb.Nifti1Image(data, reference.affine, hdr)
+    img.set_qform(reference.affine, code=1)
+    img.set_sform(reference.affine, code=1)
+    return img
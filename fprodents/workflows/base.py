@@ -112,6 +112,7 @@ def init_single_subject_wf(subject_id):
     from ..patch.interfaces import BIDSDataGrabber
     from ..patch.utils import extract_entities, fix_multi_source_name
     from ..patch.workflows.anatomical import init_anat_preproc_wf
+    from ..patch.workflows.func import apply_reference_window
 
     subject_data = collect_data(
         config.execution.layout,
@@ -323,6 +324,8 @@ tasks and sessions), the following preprocessing was performed.
         #  in anisotropic voxels. The number of N4 iterations are also reduced.
         bold_ref_wf.inputs.n4_avgs.shrink_factor = 1
         bold_ref_wf.inputs.n4_avgs.n_iterations = [50] * 4
+        # Only the leading volumes of the run are needed to generate the reference
+        apply_reference_window(bold_ref_wf, config.workflow.reference_window)
 
         func_preproc_wf = init_func_preproc_wf(bold_file)
 
@@ -338,7 +341,6 @@ tasks and sessions), the following preprocessing was performed.
               ('outputnode.std2anat_xfm', 'inputnode.std2anat_xfm')]),
             (bold_ref_wf, func_preproc_wf,
              [('outputnode.epi_ref_file', 'inputnode.ref_file'),
-              ('outputnode.xfm_files', 'inputnode.bold_ref_xfm'),
               ('outputnode.validation_report', 'inputnode.validation_report'),
               (('outputnode.n_dummy', _pop), 'inputnode.n_dummy_scans')]),
         ])
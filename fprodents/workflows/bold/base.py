@@ -13,7 +13,6 @@ from ... import config
 import os
 
 import nibabel as nb
-from nipype.interfaces.fsl import Split as FSLSplit
 from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
 
@@ -21,12 +20,15 @@ from niworkflows.utils.connections import pop_file, listify
 
 
 from ...utils.meepi import combine_meepi_source
+from ...utils.resources import MemoryEstimator, bold_features, template_grid_size
 
 from ...interfaces import DerivativesDataSink
+from ...interfaces.cache import CachedSplit
 from ...interfaces.reports import FunctionalSummary
 
 # BOLD workflows
 from .confounds import init_bold_confs_wf, init_carpetplot_wf
+from .hmc import init_bold_hmc_wf
 from .stc import init_bold_stc_wf
 from .t2s import init_bold_t2s_wf
 from .registration import init_bold_t1_trans_wf, init_bold_reg_wf
@@ -124,7 +126,6 @@ def init_func_preproc_wf(bold_file):
     from niworkflows.interfaces.fixes import FixHeaderApplyTransforms as ApplyTransforms
     from niworkflows.interfaces.nibabel import ApplyMask
     from niworkflows.interfaces.utility import KeySelect, DictMerge
-    from nipype.interfaces.freesurfer.utils import LTAConvert
 
     from ...patch.utils import extract_entities
 
@@ -134,6 +135,7 @@ def init_func_preproc_wf(bold_file):
     # Have some options handy
     omp_nthreads = config.nipype.omp_nthreads
     spaces = config.workflow.spaces
+    resampling_engine = config.workflow.resampling_engine
     output_dir = str(config.execution.output_dir)
 
     # Extract BIDS entities and metadata from BOLD file(s)
@@ -166,8 +168,11 @@ def init_func_preproc_wf(bold_file):
         )
         ref_file = bold_file[0]  # Reset reference to be the shortest TE
 
+    estimator = MemoryEstimator.from_file(config.execution.memory_coefficients)
+    features = None
     if os.path.isfile(ref_file):
-        bold_tlen, mem_gb = _create_mem_gb(ref_file)
+        bold_tlen, features = _bold_features(ref_file, spaces)
+        mem_gb = estimator.role_estimates(features)
 
     wf_name = _get_wf_name(ref_file)
     config.loggers.workflow.debug(
@@ -199,6 +204,17 @@ def init_func_preproc_wf(bold_file):
         bool(metadata.get("SliceTiming"))
         and 'slicetiming' not in config.workflow.ignore
     )
+    # The native engine may correct slice-timing within its resampling pass
+    fuse_stc = run_stc and config.workflow.stc_engine == "fused"
+    if fuse_stc and (resampling_engine != "native" or multiecho):
+        config.loggers.workflow.warning(
+            "Fused slice-timing correction requires the native resampling engine "
+            "and single-echo data; using 3dTshift instead."
+        )
+        fuse_stc = False
+    stc_metadata = metadata if fuse_stc else None
+    # The native engine resamples all echoes at once, sharing their coordinates
+    batch_echoes = multiecho and resampling_engine == "native"
 
     # Build workflow
     workflow = Workflow(name=wf_name)
@@ -219,7 +235,6 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
             fields=[
                 "bold_file",
                 "ref_file",
-                "bold_ref_xfm",
                 "n_dummy_scans",
                 "validation_report",
                 "subjects_dir",
@@ -264,12 +279,6 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
     # Generate a brain-masked conversion of the t1w and bold reference images
     t1w_brain = pe.Node(ApplyMask(), name="t1w_brain")
 
-    lta_convert = pe.Node(
-        LTAConvert(
-            out_fsl=True,
-            out_itk=True
-        ), name="lta_convert")
-
     # BOLD buffer: an identity used as a pointer to either the original BOLD
     # or the STC'ed one for further use.
     boldbuffer = pe.Node(niu.IdentityInterface(fields=["bold_file"]), name="boldbuffer")
@@ -316,9 +325,22 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
     ])
     # fmt:on
 
-    # Top-level BOLD splitter
+    # Top-level BOLD splitter, sharing its volumes with all other splitters of the run
+    split_cache_dir = str(config.execution.work_dir / "split_cache")
+    # Transform chains are compiled once and shared across resampling workflows
+    xfm_cache_dir = str(config.execution.work_dir / "xfm_cache")
     bold_split = pe.Node(
-        FSLSplit(dimension="t"), name="bold_split", mem_gb=mem_gb["filesize"] * 3
+        CachedSplit(cache_dir=split_cache_dir),
+        name="bold_split",
+        mem_gb=mem_gb["filesize"] * 3,
+    )
+
+    # Head-motion correction: align every volume to the BOLD reference
+    bold_hmc_wf = init_bold_hmc_wf(
+        name="bold_hmc_wf",
+        mem_gb=mem_gb["filesize"],
+        omp_nthreads=omp_nthreads,
+        hmc_engine=config.workflow.hmc_engine,
     )
 
     # calculate BOLD registration to T1w
@@ -339,6 +361,10 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
         mem_gb=mem_gb["resampled"],
         omp_nthreads=omp_nthreads,
         use_compression=False,
+        resampling_engine=resampling_engine,
+        split_cache_dir=split_cache_dir,
+        xfm_cache_dir=xfm_cache_dir,
+        stc_metadata=stc_metadata,
     )
 
     t1w_mask_bold_tfm = pe.Node(
@@ -352,6 +378,8 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
         regressors_all_comps=config.workflow.regressors_all_comps,
         regressors_fd_th=config.workflow.regressors_fd_th,
         regressors_dvars_th=config.workflow.regressors_dvars_th,
+        confounds_encoding=config.workflow.confounds_encoding,
+        confounds_engine=config.workflow.confounds_engine,
         name="bold_confounds_wf",
     )
     bold_confounds_wf.get_node("inputnode").inputs.t1_transform_flags = [False]
@@ -364,12 +392,29 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
         use_compression=not config.execution.low_mem,
         use_fieldwarp=False,
         name="bold_bold_trans_wf",
+        resampling_engine=resampling_engine,
+        split_cache_dir=split_cache_dir,
+        stc_metadata=stc_metadata,
+        batch_echoes=batch_echoes,
     )
     bold_bold_trans_wf.inputs.inputnode.name_source = ref_file
 
     # SLICE-TIME CORRECTION (or bypass) #############################################
-    if run_stc:
-        bold_stc_wf = init_bold_stc_wf(name="bold_stc_wf", metadata=metadata)
+    if fuse_stc:
+        # fmt:off
+        workflow.connect([
+            (inputnode, boldbuffer, [('bold_file', 'bold_file')]),
+            (inputnode, bold_t1_trans_wf, [('n_dummy_scans', 'inputnode.skip_vols')]),
+            (inputnode, bold_bold_trans_wf, [('n_dummy_scans', 'inputnode.skip_vols')]),
+        ])
+        # fmt:on
+    elif run_stc:
+        bold_stc_wf = init_bold_stc_wf(
+            name="bold_stc_wf",
+            metadata=metadata,
+            stc_engine="native" if config.workflow.stc_engine == "native" else "afni",
+            omp_nthreads=omp_nthreads,
+        )
         # fmt:off
         workflow.connect([
             (inputnode, bold_stc_wf, [("n_dummy_scans", "inputnode.skip_vols")]),
@@ -409,9 +454,22 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
 
         inputnode.inputs.bold_file = ref_file  # Replace reference w first echo
 
+        echo_source = "meepi_echos" if run_stc is True else "boldbuffer"
+        if batch_echoes:
+            # Echoes are joined before their resampling, and split again after it
+            join_raw_echos = pe.JoinNode(
+                niu.IdentityInterface(fields=["bold_files"]),
+                joinsource=echo_source,
+                joinfield=["bold_files"],
+                name="join_raw_echos",
+            )
+            select_echo = pe.Node(niu.Select(), name="select_echo")
+            select_echo.iterables = ("index", list(range(len(bold_file))))
+            echo_source = "select_echo"
+
         join_echos = pe.JoinNode(
             niu.IdentityInterface(fields=["bold_files"]),
-            joinsource=("meepi_echos" if run_stc is True else "boldbuffer"),
+            joinsource=echo_source,
             joinfield=["bold_files"],
             name="join_echos",
         )
@@ -421,6 +479,7 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
             echo_times=tes,
             mem_gb=mem_gb["resampled"],
             omp_nthreads=omp_nthreads,
+            t2s_engine=config.workflow.t2s_engine,
             name="bold_t2smap_wf",
         )
 
@@ -440,17 +499,16 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
                                   ('ref_file', 'inputnode.ref_bold_brain')]),
         (inputnode, t1w_brain, [('anat_preproc', 'in_file'),
                                 ('anat_mask', 'in_mask')]),
-        # convert bold reference LTA transform to other formats
-        (inputnode, lta_convert, [('bold_ref_xfm', 'in_lta')]),
-        # BOLD buffer has slice-time corrected if it was run, original otherwise
-        (boldbuffer, bold_split, [('bold_file', 'in_file')]),
+        # estimate head-motion (on the first echo of multi-echo runs)
+        (inputnode, bold_hmc_wf, [('bold_file', 'inputnode.bold_file'),
+                                  ('ref_file', 'inputnode.raw_ref_image')]),
         (inputnode, summary, [('n_dummy_scans', 'algo_dummy_scans')]),
         # EPI-T1 registration workflow
         (inputnode, bold_t1_trans_wf, [('bold_file', 'inputnode.name_source'),
                                        ('anat_mask', 'inputnode.t1w_mask'),
                                        ('ref_file', 'inputnode.ref_bold_brain')]),
         (t1w_brain, bold_t1_trans_wf, [('out_file', 'inputnode.t1w_brain')]),
-        (lta_convert, bold_t1_trans_wf, [('out_itk', 'inputnode.hmc_xforms')]),
+        (bold_hmc_wf, bold_t1_trans_wf, [('outputnode.xforms', 'inputnode.hmc_xforms')]),
         (bold_reg_wf, bold_t1_trans_wf, [('outputnode.bold2anat', 'inputnode.bold2anat')]),
         (bold_t1_trans_wf, outputnode, [('outputnode.bold_t1', 'bold_t1'),
                                         ('outputnode.bold_t1_ref', 'bold_t1_ref')]),
@@ -462,7 +520,7 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
         # Connect bold_confounds_wf
         (inputnode, bold_confounds_wf, [('anat_tpms', 'inputnode.anat_tpms'),
                                         ('anat_mask', 'inputnode.t1w_mask')]),
-        (lta_convert, bold_confounds_wf, [('out_fsl', 'inputnode.movpar_file')]),
+        (bold_hmc_wf, bold_confounds_wf, [('outputnode.movpar_file', 'inputnode.movpar_file')]),
         (bold_reg_wf, bold_confounds_wf, [('outputnode.anat2bold', 'inputnode.anat2bold')]),
         (inputnode, bold_confounds_wf, [('n_dummy_scans', 'inputnode.skip_vols')]),
         (t1w_mask_bold_tfm, bold_confounds_wf, [('output_image', 'inputnode.bold_mask')]),
@@ -471,13 +529,37 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
         # Connect bold_bold_trans_wf
         (inputnode, bold_bold_trans_wf, [('ref_file', 'inputnode.bold_ref')]),
         (t1w_mask_bold_tfm, bold_bold_trans_wf, [('output_image', 'inputnode.bold_mask')]),
-        (bold_split, bold_bold_trans_wf, [('out_files', 'inputnode.bold_file')]),
-        (lta_convert, bold_bold_trans_wf, [('out_itk', 'inputnode.hmc_xforms')]),
+        (bold_hmc_wf, bold_bold_trans_wf, [('outputnode.xforms', 'inputnode.hmc_xforms')]),
         # Summary
         (outputnode, summary, [('confounds', 'confounds_file')]),
     ])
     # fmt:on
 
+    # The native engine resamples the 4D series, ANTs the list of 3D volumes
+    if resampling_engine == "native":
+        bold_series, bold_series_out = boldbuffer, "bold_file"
+        bold_series_in = "inputnode.bold_file"
+    else:
+        bold_series, bold_series_out = bold_split, "out_files"
+        bold_series_in = "inputnode.bold_split"
+        # BOLD buffer has slice-time corrected if it was run, original otherwise
+        workflow.connect([(boldbuffer, bold_split, [("bold_file", "in_file")])])
+
+    if batch_echoes:
+        # fmt:off
+        workflow.connect([
+            (bold_series, join_raw_echos, [(bold_series_out, 'bold_files')]),
+            (join_raw_echos, bold_bold_trans_wf, [('bold_files', 'inputnode.bold_file')]),
+            (bold_bold_trans_wf, select_echo, [('outputnode.bold', 'inlist')]),
+        ])
+        # fmt:on
+    else:
+        # fmt:off
+        workflow.connect([
+            (bold_series, bold_bold_trans_wf, [(bold_series_out, 'inputnode.bold_file')]),
+        ])
+        # fmt:on
+
     # for standard EPI data, pass along correct file
     if not multiecho:
         # fmt:off
@@ -486,8 +568,8 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
                 ('bold_file', 'inputnode.source_file')]),
             (bold_bold_trans_wf, bold_confounds_wf, [
                 ('outputnode.bold', 'inputnode.bold')]),
-            (bold_split, bold_t1_trans_wf, [
-                ('out_files', 'inputnode.bold_split')]),
+            (bold_series, bold_t1_trans_wf, [
+                (bold_series_out, bold_series_in)]),
         ])
         # fmt:on
     else:  # for meepi, create and use optimal combination
@@ -496,12 +578,12 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
             # update name source for optimal combination
             (inputnode, func_derivatives_wf, [
                 (('bold_file', combine_meepi_source), 'inputnode.source_file')]),
-            (bold_bold_trans_wf, skullstrip_bold_wf, [
-                ('outputnode.bold', 'inputnode.in_file')]),
+            (select_echo if batch_echoes else bold_bold_trans_wf, skullstrip_bold_wf, [
+                ('out' if batch_echoes else 'outputnode.bold', 'inputnode.in_file')]),
             (bold_t2s_wf, bold_confounds_wf, [
                 ('outputnode.bold', 'inputnode.bold')]),
             (bold_t2s_wf, bold_t1_trans_wf, [
-                ('outputnode.bold', 'inputnode.bold_split')]),
+                ('outputnode.bold', bold_series_in)]),
         ])
         # fmt:on
 
@@ -529,8 +611,8 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
     if nonstd_spaces.intersection(("func", "run", "bold", "boldref", "sbref")):
         # fmt:off
         workflow.connect([
-            (bold_bold_trans_wf, outputnode, [
-                ('outputnode.bold', 'bold_native')]),
+            (select_echo if batch_echoes else bold_bold_trans_wf, outputnode, [
+                ('out' if batch_echoes else 'outputnode.bold', 'bold_native')]),
             (bold_bold_trans_wf, func_derivatives_wf, [
                 ('outputnode.bold_ref', 'inputnode.bold_native_ref'),
                 ('outputnode.bold_mask', 'inputnode.bold_mask_native')]),
@@ -547,6 +629,9 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
             name="bold_std_trans_wf",
             use_compression=not config.execution.low_mem,
             use_fieldwarp=False,
+            resampling_engine=resampling_engine,
+            xfm_cache_dir=xfm_cache_dir,
+            stc_metadata=stc_metadata,
         )
         # fmt:off
         workflow.connect([
@@ -555,8 +640,8 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
                 ('anat2std_xfm', 'inputnode.anat2std_xfm'),
                 ('bold_file', 'inputnode.name_source')]),
             (t1w_mask_bold_tfm, bold_std_trans_wf, [('output_image', 'inputnode.bold_mask')]),
-            (lta_convert, bold_std_trans_wf, [
-                ('out_itk', 'inputnode.hmc_xforms')]),
+            (bold_hmc_wf, bold_std_trans_wf, [
+                ('outputnode.xforms', 'inputnode.hmc_xforms')]),
             (bold_reg_wf, bold_std_trans_wf, [
                 ('outputnode.bold2anat', 'inputnode.bold2anat')]),
             (bold_std_trans_wf, outputnode, [('outputnode.bold_std', 'bold_std'),
@@ -568,7 +653,20 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
         if not multiecho:
             # fmt:off
             workflow.connect([
-                (bold_split, bold_std_trans_wf, [("out_files", "inputnode.bold_split")]),
+                (bold_series, bold_std_trans_wf, [(bold_series_out, bold_series_in)]),
+            ])
+            # fmt:on
+            if fuse_stc:
+                # fmt:off
+                workflow.connect([
+                    (inputnode, bold_std_trans_wf, [
+                        ('n_dummy_scans', 'inputnode.skip_vols')]),
+                ])
+                # fmt:on
+        elif resampling_engine == "native":
+            # fmt:off
+            workflow.connect([
+                (bold_t2s_wf, bold_std_trans_wf, [('outputnode.bold', bold_series_in)]),
             ])
             # fmt:on
         else:
@@ -635,8 +733,8 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
                 (inputnode, ica_aroma_wf, [
                     ('bold_file', 'inputnode.name_source'),
                     ('n_dummy_scans', 'inputnode.skip_vols')]),
-                (lta_convert, ica_aroma_wf, [
-                    ('out_fsl', 'inputnode.movpar_file')]),
+                (bold_hmc_wf, ica_aroma_wf, [
+                    ('outputnode.movpar_file', 'inputnode.movpar_file')]),
                 (bold_confounds_wf, join, [
                     ('outputnode.confounds_file', 'in_file')]),
                 (bold_confounds_wf, mrg_conf_metadata,
@@ -724,19 +822,30 @@ Non-gridded (surface) resamplings were performed using `mri_vol2surf`
             workflow.get_node(node).inputs.base_directory = output_dir
             workflow.get_node(node).inputs.source_file = ref_file
 
-    return workflow
+        # Configure gzip compression of NIfTI outputs
+        wf_node = workflow.get_node(node)
+        if hasattr(wf_node.inputs, "compresslevel"):
+            wf_node.inputs.compresslevel = config.execution.compression_level
+            if isinstance(wf_node.interface, DerivativesDataSink):
+                wf_node.inputs.num_threads = omp_nthreads
+                wf_node.n_procs = omp_nthreads
+
+    # Nodes running calibrated interfaces get their own memory estimates
+    if features is not None:
+        estimator.update_nodes(workflow, features)
 
+    return workflow
 
-def _create_mem_gb(bold_fname):
-    bold_size_gb = os.path.getsize(bold_fname) / (1024 ** 3)
-    bold_tlen = nb.load(bold_fname).shape[-1]
-    mem_gb = {
-        "filesize": bold_size_gb,
-        "resampled": bold_size_gb * 4,
-        "largemem": bold_size_gb * (max(bold_tlen / 100, 1.0) + 4),
-    }
 
-    return bold_tlen, mem_gb
+def _bold_features(bold_fname, spaces):
+    """Calculate the features of the memory model, sizing standard-space outputs."""
+    zooms = nb.load(bold_fname).header.get_zooms()[:3]
+    target_sizes = [
+        template_grid_size(s.fullname, s.spec, zooms)
+        for s in spaces.references
+        if s.standard and s.dim == 3
+    ]
+    return bold_features(bold_fname, target_sizes)
 
 
 def _get_wf_name(bold_fname):
@@ -764,9 +873,13 @@ def _get_wf_name(bold_fname):
 
 def _to_join(in_file, join_file):
     """Join two tsv files if the join_file is not ``None``."""
-    from niworkflows.interfaces.utility import JoinTSVColumns
+    import os
+    from nipype.utils.filemanip import fname_presuffix
+    from fprodents.utils.confounds import join_confounds
 
     if join_file is None:
         return in_file
-    res = JoinTSVColumns(in_file=in_file, join_file=join_file).run()
-    return res.outputs.out_file
+    out_file = fname_presuffix(
+        in_file, suffix="_joined.tsv", newpath=os.getcwd(), use_ext=False
+    )
+    return join_confounds(in_file, join_file, out_file)
@@ -17,8 +17,10 @@ from templateflow.api import get as get_template
 
 from ...config import DEFAULT_MEMORY_MIN_GB
 from ...interfaces import (
+    FusedConfounds,
     GatherConfounds,
     ICAConfounds,
+    CarpetData,
     FMRISummary,
     DerivativesDataSink,
 )
@@ -30,6 +32,8 @@ def init_bold_confs_wf(
     regressors_all_comps,
     regressors_dvars_th,
     regressors_fd_th,
+    confounds_encoding="dense",
+    confounds_engine="nipype",
     name="bold_confs_wf",
 ):
     """
@@ -91,6 +95,17 @@ def init_bold_confs_wf(
         Criterion for flagging DVARS outliers
     regressors_fd_th : :obj:`float`
         Criterion for flagging framewise displacement outliers
+    confounds_encoding : :obj:`str`
+        Either ``dense`` (the expansion of the confounds model and the spike
+        regressors are written as columns of the confounds file) or ``compact``
+        (the confounds file only holds the base confounds, and the model and
+        spike regressors are described in its metadata, see
+        :py:class:`~fprodents.interfaces.confounds.CompactConfounds`).
+    confounds_engine : :obj:`str`
+        Either ``nipype`` (DVARS, global signals, tCompCor and aCompCor are
+        calculated by separate nodes, each reading the BOLD series) or ``fused``
+        (one :py:class:`~fprodents.interfaces.confounds.FusedConfounds` node
+        reads the series once and calculates them all, with identical outputs).
 
     Inputs
     ------
@@ -125,18 +140,8 @@ def init_bold_confs_wf(
 
     """
     from niworkflows.engine.workflows import LiterateWorkflow as Workflow
-    from niworkflows.interfaces.confounds import ExpandModel, SpikeRegressors
-    from niworkflows.interfaces.fixes import FixHeaderApplyTransforms as ApplyTransforms
-    from niworkflows.interfaces.images import SignalExtraction
     from niworkflows.interfaces.reportlets.masks import ROIsPlot
-    from niworkflows.interfaces.patches import (
-        RobustACompCor as ACompCor,
-        RobustTCompCor as TCompCor,
-    )
-    from niworkflows.interfaces.plotting import (
-        CompCorVariancePlot,
-        ConfoundsCorrelationPlot,
-    )
+    from niworkflows.interfaces.plotting import CompCorVariancePlot
     from niworkflows.interfaces.probmaps import (
         TPM2ROI,
         AddTPMs,
@@ -146,6 +151,13 @@ def init_bold_confs_wf(
         TSV2JSON,
         DictMerge,
     )
+    from ...interfaces.confounds import (
+        CompactConfounds,
+        ConfoundsCorrelationPlot,
+        ExpandModel,
+        SpikeRegressors,
+    )
+    from ...interfaces.resampling import ProjectROIs
 
     workflow = Workflow(name=name)
     workflow.__desc__ = """\
@@ -227,39 +239,16 @@ were annotated as motion outliers.
         name="acc_roi",
     )
 
-    # Map ROIs in T1w space into BOLD space
-    csf_tfm = pe.Node(
-        ApplyTransforms(interpolation="NearestNeighbor", float=True),
-        name="csf_tfm",
-        mem_gb=0.1,
-    )
-    wm_tfm = pe.Node(
-        ApplyTransforms(interpolation="NearestNeighbor", float=True),
-        name="wm_tfm",
-        mem_gb=0.1,
-    )
-    acc_tfm = pe.Node(
-        ApplyTransforms(interpolation="NearestNeighbor", float=True),
-        name="acc_tfm",
-        mem_gb=0.1,
+    # Map ROIs in T1w space into BOLD space, ensuring they don't go off-limits
+    # (reduced FoV)
+    merge_tfm_rois = pe.Node(
+        niu.Merge(4), name="merge_tfm_rois", run_without_submitting=True
     )
-    tcc_tfm = pe.Node(
-        ApplyTransforms(interpolation="NearestNeighbor", float=True),
-        name="tcc_tfm",
-        mem_gb=0.1,
-    )
-
-    # Ensure ROIs don't go off-limits (reduced FoV)
-    csf_msk = pe.Node(niu.Function(function=_maskroi), name="csf_msk")
-    wm_msk = pe.Node(niu.Function(function=_maskroi), name="wm_msk")
-    acc_msk = pe.Node(niu.Function(function=_maskroi), name="acc_msk")
-    tcc_msk = pe.Node(niu.Function(function=_maskroi), name="tcc_msk")
-
-    # DVARS
-    dvars = pe.Node(
-        nac.ComputeDVARS(save_nstd=True, save_std=True, remove_zerovariance=True),
-        name="dvars",
-        mem_gb=mem_gb,
+    project_rois = pe.Node(ProjectROIs(), name="project_rois", mem_gb=0.1)
+    split_rois = pe.Node(
+        niu.Split(splits=[1, 1, 1, 1], squeeze=True),
+        name="split_rois",
+        run_without_submitting=True,
     )
 
     # Frame displacement
@@ -272,56 +261,83 @@ were annotated as motion outliers.
         niu.Merge(3), name="merge_rois_cc", run_without_submitting=True
     )
 
-    tcompcor = pe.Node(
-        TCompCor(
-            components_file="tcompcor.tsv",
-            header_prefix="t_comp_cor_",
-            pre_filter="cosine",
-            save_pre_filter=True,
-            save_metadata=True,
-            percentile_threshold=0.05,
-            failure_mode="NaN",
-        ),
-        name="tcompcor",
-        mem_gb=mem_gb,
-    )
-
-    acompcor = pe.Node(
-        ACompCor(
-            components_file="acompcor.tsv",
-            header_prefix="a_comp_cor_",
-            pre_filter="cosine",
-            save_pre_filter=True,
-            save_metadata=True,
-            mask_names=["combined", "CSF", "WM"],
-            merge_method="none",
-            failure_mode="NaN",
-        ),
-        name="acompcor",
-        mem_gb=mem_gb,
-    )
-
-    # Set number of components
-    if regressors_all_comps:
-        acompcor.inputs.num_components = "all"
-        tcompcor.inputs.num_components = "all"
-    else:
-        acompcor.inputs.variance_threshold = 0.5
-        tcompcor.inputs.variance_threshold = 0.5
-
-    # Set TR if present
-    if "RepetitionTime" in metadata:
-        tcompcor.inputs.repetition_time = metadata["RepetitionTime"]
-        acompcor.inputs.repetition_time = metadata["RepetitionTime"]
-
     # Global and segment regressors
     signals_class_labels = ["csf", "white_matter", "global_signal"]
     mrg_lbl = pe.Node(niu.Merge(3), name="merge_rois", run_without_submitting=True)
-    signals = pe.Node(
-        SignalExtraction(class_labels=signals_class_labels),
-        name="signals",
-        mem_gb=mem_gb,
-    )
+
+    if confounds_engine == "fused":
+        # DVARS, global signals and a/t-CompCor, reading the BOLD series once
+        confounds = pe.Node(
+            FusedConfounds(
+                class_labels=signals_class_labels,
+                acompcor_names=["combined", "CSF", "WM"],
+                percentile_threshold=0.05,
+                failure_mode="NaN",
+            ),
+            name="confounds",
+            mem_gb=mem_gb,
+        )
+        compcor_nodes = [confounds]
+    else:
+        from niworkflows.interfaces.images import SignalExtraction
+        from ...interfaces.patches import (
+            RobustACompCor as ACompCor,
+            RobustTCompCor as TCompCor,
+        )
+
+        # DVARS
+        dvars = pe.Node(
+            nac.ComputeDVARS(save_nstd=True, save_std=True, remove_zerovariance=True),
+            name="dvars",
+            mem_gb=mem_gb,
+        )
+
+        tcompcor = pe.Node(
+            TCompCor(
+                components_file="tcompcor.tsv",
+                header_prefix="t_comp_cor_",
+                pre_filter="cosine",
+                save_pre_filter=True,
+                save_metadata=True,
+                percentile_threshold=0.05,
+                failure_mode="NaN",
+            ),
+            name="tcompcor",
+            mem_gb=mem_gb,
+        )
+
+        acompcor = pe.Node(
+            ACompCor(
+                components_file="acompcor.tsv",
+                header_prefix="a_comp_cor_",
+                pre_filter="cosine",
+                save_pre_filter=True,
+                save_metadata=True,
+                mask_names=["combined", "CSF", "WM"],
+                merge_method="none",
+                failure_mode="NaN",
+            ),
+            name="acompcor",
+            mem_gb=mem_gb,
+        )
+
+        signals = pe.Node(
+            SignalExtraction(class_labels=signals_class_labels),
+            name="signals",
+            mem_gb=mem_gb,
+        )
+        compcor_nodes = [tcompcor, acompcor]
+
+    for compcor in compcor_nodes:
+        # Set number of components
+        if regressors_all_comps:
+            compcor.inputs.num_components = "all"
+        else:
+            compcor.inputs.variance_threshold = 0.5
+
+        # Set TR if present
+        if "RepetitionTime" in metadata:
+            compcor.inputs.repetition_time = metadata["RepetitionTime"]
 
     # Arrange confounds
     add_dvars_header = pe.Node(
@@ -375,7 +391,7 @@ were annotated as motion outliers.
         name="acc_metadata_fmt",
     )
     mrg_conf_metadata = pe.Node(
-        niu.Merge(3), name="merge_confound_metadata", run_without_submitting=True
+        niu.Merge(4), name="merge_confound_metadata", run_without_submitting=True
     )
     mrg_conf_metadata.inputs.in3 = {
         label: {"Method": "Mean"} for label in signals_class_labels
@@ -384,17 +400,30 @@ were annotated as motion outliers.
         DictMerge(), name="merge_confound_metadata2", run_without_submitting=True
     )
 
-    # Expand model to include derivatives and quadratics
-    model_expand = pe.Node(
-        ExpandModel(model_formula="(dd1(rps + wm + csf + gsr))^^2 + others"),
-        name="model_expansion",
-    )
-
-    # Add spike regressors
-    spike_regress = pe.Node(
-        SpikeRegressors(fd_thresh=regressors_fd_th, dvars_thresh=regressors_dvars_th),
-        name="spike_regressors",
-    )
+    model_formula = "(dd1(rps + wm + csf + gsr))^^2 + others"
+    if confounds_encoding == "compact":
+        # Describe the model expansion and spikes in the metadata
+        compact_confounds = pe.Node(
+            CompactConfounds(
+                model_formula=model_formula,
+                fd_thresh=regressors_fd_th,
+                dvars_thresh=regressors_dvars_th,
+            ),
+            name="compact_confounds",
+        )
+    else:
+        # Expand model to include derivatives and quadratics
+        model_expand = pe.Node(
+            ExpandModel(model_formula=model_formula), name="model_expansion",
+        )
+
+        # Add spike regressors
+        spike_regress = pe.Node(
+            SpikeRegressors(
+                fd_thresh=regressors_fd_th, dvars_thresh=regressors_dvars_th
+            ),
+            name="spike_regressors",
+        )
 
     # Generate reportlet (ROIs)
     mrg_compcor = pe.Node(
@@ -465,95 +494,115 @@ were annotated as motion outliers.
                              ('t1w_mask', 'in_mask')]),
         (inputnode, acc_roi, [('t1w_mask', 'in_mask')]),
         (acc_tpm, acc_roi, [('out_file', 'in_tpm')]),
-        # Map ROIs to BOLD
-        (inputnode, csf_tfm, [('bold_mask', 'reference_image'),
-                              ('anat2bold', 'transforms')]),
-        (csf_roi, csf_tfm, [('roi_file', 'input_image')]),
-        (inputnode, wm_tfm, [('bold_mask', 'reference_image'),
-                             ('anat2bold', 'transforms')]),
-        (wm_roi, wm_tfm, [('roi_file', 'input_image')]),
-        (inputnode, acc_tfm, [('bold_mask', 'reference_image'),
-                              ('anat2bold', 'transforms')]),
-        (acc_roi, acc_tfm, [('roi_file', 'input_image')]),
-        (inputnode, tcc_tfm, [('bold_mask', 'reference_image'),
-                              ('anat2bold', 'transforms')]),
-        (csf_roi, tcc_tfm, [('eroded_mask', 'input_image')]),
-        # Mask ROIs with bold_mask
-        (inputnode, csf_msk, [('bold_mask', 'in_mask')]),
-        (inputnode, wm_msk, [('bold_mask', 'in_mask')]),
-        (inputnode, acc_msk, [('bold_mask', 'in_mask')]),
-        (inputnode, tcc_msk, [('bold_mask', 'in_mask')]),
+        # Map ROIs to BOLD (csf, wm, acc, tcc), masked with bold_mask
+        (csf_roi, merge_tfm_rois, [('roi_file', 'in1'),
+                                   ('eroded_mask', 'in4')]),
+        (wm_roi, merge_tfm_rois, [('roi_file', 'in2')]),
+        (acc_roi, merge_tfm_rois, [('roi_file', 'in3')]),
+        (inputnode, project_rois, [('bold_mask', 'reference_image'),
+                                   ('bold_mask', 'in_mask'),
+                                   ('anat2bold', 'transforms')]),
+        (merge_tfm_rois, project_rois, [('out', 'in_files')]),
+        (project_rois, split_rois, [('out_files', 'inlist')]),
         # connect inputnode to each non-anatomical confound node
-        (inputnode, dvars, [('bold', 'in_file'),
-                            ('bold_mask', 'in_mask')]),
         (inputnode, fdisp, [('movpar_file', 'in_file')]),
 
-        # tCompCor
-        (inputnode, tcompcor, [('bold', 'realigned_file')]),
-        (inputnode, tcompcor, [('skip_vols', 'ignore_initial_volumes')]),
-        (tcc_tfm, tcc_msk, [('output_image', 'roi_file')]),
-        (tcc_msk, tcompcor, [('out', 'mask_files')]),
-
         # aCompCor
-        (inputnode, acompcor, [('bold', 'realigned_file')]),
-        (inputnode, acompcor, [('skip_vols', 'ignore_initial_volumes')]),
-        (acc_tfm, acc_msk, [('output_image', 'roi_file')]),
-        (acc_msk, mrg_lbl_cc, [('out', 'in1')]),
-        (csf_msk, mrg_lbl_cc, [('out', 'in2')]),
-        (wm_msk, mrg_lbl_cc, [('out', 'in3')]),
-        (mrg_lbl_cc, acompcor, [('out', 'mask_files')]),
+        (split_rois, mrg_lbl_cc, [('out3', 'in1'),
+                                  ('out1', 'in2'),
+                                  ('out2', 'in3')]),
 
         # Global signals extraction (constrained by anatomy)
-        (inputnode, signals, [('bold', 'in_file')]),
-        (csf_tfm, csf_msk, [('output_image', 'roi_file')]),
-        (csf_msk, mrg_lbl, [('out', 'in1')]),
-        (wm_tfm, wm_msk, [('output_image', 'roi_file')]),
-        (wm_msk, mrg_lbl, [('out', 'in2')]),
+        (split_rois, mrg_lbl, [('out1', 'in1'),
+                               ('out2', 'in2')]),
         (inputnode, mrg_lbl, [('bold_mask', 'in3')]),
-        (mrg_lbl, signals, [('out', 'label_files')]),
 
         # Collate computed confounds together
         (inputnode, add_motion_headers, [('movpar_file', 'in_file')]),
         # (inputnode, add_rmsd_header, [('rmsd_file', 'in_file')]),
-        (dvars, add_dvars_header, [('out_nstd', 'in_file')]),
-        (dvars, add_std_dvars_header, [('out_std', 'in_file')]),
-        (signals, concat, [('out_file', 'signals')]),
         (fdisp, concat, [('out_file', 'fd')]),
-        (tcompcor, concat, [('components_file', 'tcompcor'),
-                            ('pre_filter_file', 'cos_basis')]),
-        (acompcor, concat, [('components_file', 'acompcor')]),
         (add_motion_headers, concat, [('out_file', 'motion')]),
         # (add_rmsd_header, concat, [('out_file', 'rmsd')]),
         (add_dvars_header, concat, [('out_file', 'dvars')]),
         (add_std_dvars_header, concat, [('out_file', 'std_dvars')]),
 
         # Confounds metadata
-        (tcompcor, tcc_metadata_fmt, [('metadata_file', 'in_file')]),
-        (acompcor, acc_metadata_fmt, [('metadata_file', 'in_file')]),
         (tcc_metadata_fmt, mrg_conf_metadata, [('output', 'in1')]),
         (acc_metadata_fmt, mrg_conf_metadata, [('output', 'in2')]),
         (mrg_conf_metadata, mrg_conf_metadata2, [('out', 'in_dicts')]),
 
-        # Expand the model with derivatives, quadratics, and spikes
-        (concat, model_expand, [('confounds_file', 'confounds_file')]),
-        (model_expand, spike_regress, [('confounds_file', 'confounds_file')]),
-
         # Set outputs
-        (spike_regress, outputnode, [('confounds_file', 'confounds_file')]),
         (mrg_conf_metadata2, outputnode, [('out_dict', 'confounds_metadata')]),
-        (inputnode, rois_plot, [('bold', 'in_file'),
-                                ('bold_mask', 'in_mask')]),
-        (tcompcor, mrg_compcor, [('high_variance_masks', 'in1')]),
-        (acc_msk, mrg_compcor, [('out', 'in2')]),
+        (inputnode, rois_plot, [('bold_mask', 'in_mask')]),
+        (split_rois, mrg_compcor, [('out3', 'in2')]),
         (mrg_compcor, rois_plot, [('out', 'in_rois')]),
         (rois_plot, ds_report_bold_rois, [('out_report', 'in_file')]),
-        (tcompcor, mrg_cc_metadata, [('metadata_file', 'in1')]),
-        (acompcor, mrg_cc_metadata, [('metadata_file', 'in2')]),
         (mrg_cc_metadata, compcor_plot, [('out', 'metadata_files')]),
         (compcor_plot, ds_report_compcor, [('out_file', 'in_file')]),
         (concat, conf_corr_plot, [('confounds_file', 'confounds_file')]),
         (conf_corr_plot, ds_report_conf_corr, [('out_file', 'in_file')]),
     ])
+
+    if confounds_encoding == "compact":
+        workflow.connect([
+            (concat, compact_confounds, [('confounds_file', 'confounds_file')]),
+            (compact_confounds, mrg_conf_metadata, [('metadata', 'in4')]),
+            (compact_confounds, outputnode, [('confounds_file', 'confounds_file')]),
+        ])
+    else:
+        workflow.connect([
+            # Expand the model with derivatives, quadratics, and spikes
+            (concat, model_expand, [('confounds_file', 'confounds_file')]),
+            (model_expand, spike_regress, [('confounds_file', 'confounds_file')]),
+            (spike_regress, outputnode, [('confounds_file', 'confounds_file')]),
+        ])
+
+    if confounds_engine == "fused":
+        workflow.connect([
+            (inputnode, confounds, [('bold', 'in_file'),
+                                    ('bold_mask', 'in_mask'),
+                                    ('skip_vols', 'ignore_initial_volumes')]),
+            (split_rois, confounds, [('out4', 'tcompcor_mask')]),
+            (mrg_lbl_cc, confounds, [('out', 'acompcor_masks')]),
+            (mrg_lbl, confounds, [('out', 'signal_masks')]),
+            (confounds, add_dvars_header, [('out_nstd', 'in_file')]),
+            (confounds, add_std_dvars_header, [('out_std', 'in_file')]),
+            (confounds, concat, [('signals_file', 'signals'),
+                                 ('tcompcor_file', 'tcompcor'),
+                                 ('pre_filter_file', 'cos_basis'),
+                                 ('acompcor_file', 'acompcor')]),
+            (confounds, tcc_metadata_fmt, [('tcompcor_metadata', 'in_file')]),
+            (confounds, acc_metadata_fmt, [('acompcor_metadata', 'in_file')]),
+            (confounds, rois_plot, [('ref_file', 'in_file')]),
+            (confounds, mrg_compcor, [('high_variance_mask', 'in1')]),
+            (confounds, mrg_cc_metadata, [('tcompcor_metadata', 'in1'),
+                                          ('acompcor_metadata', 'in2')]),
+        ])
+    else:
+        workflow.connect([
+            (inputnode, dvars, [('bold', 'in_file'),
+                                ('bold_mask', 'in_mask')]),
+            (inputnode, tcompcor, [('bold', 'realigned_file'),
+                                   ('skip_vols', 'ignore_initial_volumes')]),
+            (split_rois, tcompcor, [('out4', 'mask_files')]),
+            (inputnode, acompcor, [('bold', 'realigned_file'),
+                                   ('skip_vols', 'ignore_initial_volumes')]),
+            (mrg_lbl_cc, acompcor, [('out', 'mask_files')]),
+            (inputnode, signals, [('bold', 'in_file')]),
+            (mrg_lbl, signals, [('out', 'label_files')]),
+            (dvars, add_dvars_header, [('out_nstd', 'in_file')]),
+            (dvars, add_std_dvars_header, [('out_std', 'in_file')]),
+            (signals, concat, [('out_file', 'signals')]),
+            (tcompcor, concat, [('components_file', 'tcompcor'),
+                                ('pre_filter_file', 'cos_basis')]),
+            (acompcor, concat, [('components_file', 'acompcor')]),
+            (tcompcor, tcc_metadata_fmt, [('metadata_file', 'in_file')]),
+            (acompcor, acc_metadata_fmt, [('metadata_file', 'in_file')]),
+            (inputnode, rois_plot, [('bold', 'in_file')]),
+            (tcompcor, mrg_compcor, [('high_variance_masks', 'in1')]),
+            (tcompcor, mrg_cc_metadata, [('metadata_file', 'in1')]),
+            (acompcor, mrg_cc_metadata, [('metadata_file', 'in2')]),
+        ])
     # fmt:on
 
     return workflow
@@ -639,8 +688,10 @@ def init_carpetplot_wf(mem_gb, metadata, name="bold_carpet_wf"):
     )
 
     # Carpetplot and confounds plot
+    carpet_data = pe.Node(CarpetData(), name="carpet_data", mem_gb=0.5)
     conf_plot = pe.Node(
         FMRISummary(
+            raster=True,
             tr=metadata["RepetitionTime"],
             confounds_list=[
                 ("global_signal", None, "GS"),
@@ -651,7 +702,7 @@ def init_carpetplot_wf(mem_gb, metadata, name="bold_carpet_wf"):
             ],
         ),
         name="conf_plot",
-        mem_gb=mem_gb,
+        mem_gb=0.2,
     )
     ds_report_bold_conf = pe.Node(
         DerivativesDataSink(
@@ -677,9 +728,10 @@ def init_carpetplot_wf(mem_gb, metadata, name="bold_carpet_wf"):
         (conf_plot, outputnode, [('out_file', 'out_carpetplot')]),
         (mrg_xfms, resample_parc, [('out', 'transforms')]),
         # Carpetplot
-        (inputnode, conf_plot, [('bold', 'in_func'),
-                                ('bold_mask', 'in_mask')]),
-        (resample_parc, conf_plot, [('output_image', 'in_segm')])
+        (inputnode, carpet_data, [('bold', 'in_file'),
+                                  ('bold_mask', 'in_mask')]),
+        (resample_parc, carpet_data, [('output_image', 'in_segm')]),
+        (carpet_data, conf_plot, [('out_file', 'in_carpet')]),
     ])
     # fmt:on
 
@@ -984,55 +1036,26 @@ in the corresponding confounds file.
 
 
 def _remove_volumes(bold_file, skip_vols):
-    """Remove skip_vols from bold_file."""
-    import nibabel as nb
-    from nipype.utils.filemanip import fname_presuffix
+    """Remove skip_vols from bold_file (without rewriting its data if uncompressed)."""
+    import os
+    from nipype.utils.filemanip import split_filename
+    from fprodents.utils.images import trim_series
 
     if skip_vols == 0:
         return bold_file
 
-    out = fname_presuffix(bold_file, suffix="_cut")
-    bold_img = nb.load(bold_file)
-    bold_img.__class__(
-        bold_img.dataobj[..., skip_vols:], bold_img.affine, bold_img.header
-    ).to_filename(out)
-
-    return out
+    _, base, _ = split_filename(bold_file)
+    return trim_series(bold_file, skip_vols, os.path.join(os.getcwd(), f"{base}_cut"))
 
 
 def _add_volumes(bold_file, bold_cut_file, skip_vols):
     """Prepend skip_vols from bold_file onto bold_cut_file."""
-    import nibabel as nb
-    import numpy as np
+    import os
     from nipype.utils.filemanip import fname_presuffix
+    from fprodents.utils.images import prepend_volumes
 
     if skip_vols == 0:
         return bold_cut_file
 
-    bold_img = nb.load(bold_file)
-    bold_cut_img = nb.load(bold_cut_file)
-
-    bold_data = np.concatenate(
-        (bold_img.dataobj[..., :skip_vols], bold_cut_img.dataobj), axis=3
-    )
-
-    out = fname_presuffix(bold_cut_file, suffix="_addnonsteady")
-    bold_img.__class__(bold_data, bold_img.affine, bold_img.header).to_filename(out)
-
-    return out
-
-
-def _maskroi(in_mask, roi_file):
-    import numpy as np
-    import nibabel as nb
-    from nipype.utils.filemanip import fname_presuffix
-
-    roi = nb.load(roi_file)
-    roidata = roi.get_data().astype(np.uint8)
-    msk = nb.load(in_mask).get_data().astype(bool)
-    roidata[~msk] = 0
-    roi.set_data_dtype(np.uint8)
-
-    out = fname_presuffix(roi_file, suffix="_boldmsk")
-    roi.__class__(roidata, roi.affine, roi.header).to_filename(out)
-    return out
+    out = fname_presuffix(bold_cut_file, suffix="_addnonsteady", newpath=os.getcwd())
+    return prepend_volumes(bold_file, bold_cut_file, skip_vols, out)
@@ -10,12 +10,12 @@ Head-Motion Estimation and Correction (HMC) of BOLD images
 
 from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu, afni
-from ...interfaces.mc import Volreg2ITK
+from ...interfaces.mc import RigidHMC, Volreg2ITK
 
 from ...config import DEFAULT_MEMORY_MIN_GB
 
 
-def init_bold_hmc_wf(mem_gb, omp_nthreads, name="bold_hmc_wf"):
+def init_bold_hmc_wf(mem_gb, omp_nthreads, hmc_engine="afni", name="bold_hmc_wf"):
     """
     Build a workflow to estimate head-motion parameters.
 
@@ -39,6 +39,9 @@ def init_bold_hmc_wf(mem_gb, omp_nthreads, name="bold_hmc_wf"):
         Size of BOLD file in GB
     omp_nthreads : :obj:`int`
         Maximum number of threads an individual process may use
+    hmc_engine : :obj:`str`
+        Either ``'afni'`` (``3dVolreg``) or ``'native'`` (in-process rigid-body
+        registration, see :py:class:`~fprodents.interfaces.mc.RigidHMC`).
     name : :obj:`str`
         Name of workflow (default: ``bold_hmc_wf``)
 
@@ -53,6 +56,9 @@ def init_bold_hmc_wf(mem_gb, omp_nthreads, name="bold_hmc_wf"):
     -------
     xforms
         ITKTransform file aligning each volume to ``ref_image``
+    xforms_stack
+        The same affines, as a binary transform stack
+        (see :py:func:`~fprodents.utils.transforms.save_xfm_stack`)
     movpar_file
         MCFLIRT motion parameters, normalized to SPM format (X, Y, Z, Rx, Ry, Rz)
     rms_file
@@ -63,6 +69,44 @@ def init_bold_hmc_wf(mem_gb, omp_nthreads, name="bold_hmc_wf"):
     from niworkflows.interfaces.confounds import NormalizeMotionParams
 
     workflow = Workflow(name=name)
+
+    inputnode = pe.Node(
+        niu.IdentityInterface(fields=["bold_file", "raw_ref_image"]), name="inputnode"
+    )
+    outputnode = pe.Node(
+        niu.IdentityInterface(
+            fields=["xforms", "xforms_stack", "movpar_file", "rmsd_file"]
+        ),
+        name="outputnode",
+    )
+
+    if hmc_engine == "native":
+        workflow.__desc__ = """\
+Head-motion parameters with respect to the BOLD reference
+(transformation matrices, and six corresponding rotation and translation
+parameters) are estimated before any spatiotemporal filtering with a
+least-squares, rigid-body registration of each volume (from coarse to fine
+resolution).
+"""
+        mc = pe.Node(
+            RigidHMC(num_threads=omp_nthreads),
+            name="mc",
+            mem_gb=mem_gb,
+            n_procs=omp_nthreads,
+        )
+        # fmt:off
+        workflow.connect([
+            (inputnode, mc, [
+                ('raw_ref_image', 'ref_file'),
+                ('bold_file', 'in_file'),
+            ]),
+            (mc, outputnode, [('out_file', 'xforms'),
+                              ('out_stack', 'xforms_stack'),
+                              ('movpar_file', 'movpar_file')]),
+        ])
+        # fmt:on
+        return workflow
+
     workflow.__desc__ = """\
 Head-motion parameters with respect to the BOLD reference
 (transformation matrices, and six corresponding rotation and translation
@@ -72,14 +116,6 @@ parameters) are estimated before any spatiotemporal filtering using
         afni_ver=afni.Info().version() or "<ver>"
     )
 
-    inputnode = pe.Node(
-        niu.IdentityInterface(fields=["bold_file", "raw_ref_image"]), name="inputnode"
-    )
-    outputnode = pe.Node(
-        niu.IdentityInterface(fields=["xforms", "movpar_file", "rmsd_file"]),
-        name="outputnode",
-    )
-
     # Head motion correction (hmc)
     # mcflirt = pe.Node(
     #     fsl.MCFLIRT(save_mats=True, save_plots=True, save_rms=True),
@@ -88,11 +124,16 @@ parameters) are estimated before any spatiotemporal filtering using
     # fsl2itk = pe.Node(MCFLIRT2ITK(), name='fsl2itk',
     #                   mem_gb=0.05, n_procs=omp_nthreads)
 
-    mc = pe.Node(
-        afni.Volreg(zpad=4, outputtype="NIFTI_GZ", args="-prefix NULL -twopass"),
-        name="mc",
-        mem_gb=mem_gb * 3,
-    )
+    # Volumes are registered independently: with several threads, the series is
+    # split into as many chunks of volumes, registered concurrently.
+    nchunks = max(omp_nthreads, 1)
+    volreg = afni.Volreg(zpad=4, outputtype="NIFTI_GZ", args="-prefix NULL -twopass")
+    if nchunks > 1:
+        mc = pe.MapNode(
+            volreg, iterfield=["in_file"], name="mc", mem_gb=mem_gb * 3 / nchunks
+        )
+    else:
+        mc = pe.Node(volreg, name="mc", mem_gb=mem_gb * 3)
 
     mc2itk = pe.Node(Volreg2ITK(), name="mcitk", mem_gb=0.05)
 
@@ -119,15 +160,93 @@ parameters) are estimated before any spatiotemporal filtering using
 
     # fmt:off
     workflow.connect([
-        (inputnode, mc, [
-            ('raw_ref_image', 'basefile'),
-            ('bold_file', 'in_file'),
-        ]),
-        (mc, mc2itk, [('oned_matrix_save', 'in_file')]),
-        (mc, normalize_motion, [('oned_file', 'in_file')]),
-        (mc2itk, outputnode, [('out_file', 'xforms')]),
+        (inputnode, mc, [('raw_ref_image', 'basefile')]),
+        (mc2itk, outputnode, [('out_file', 'xforms'),
+                              ('out_stack', 'xforms_stack')]),
         (normalize_motion, outputnode, [('out_file', 'movpar_file')]),
     ])
     # fmt:on
 
+    if nchunks == 1:
+        # fmt:off
+        workflow.connect([
+            (inputnode, mc, [('bold_file', 'in_file')]),
+            (mc, mc2itk, [('oned_matrix_save', 'in_file')]),
+            (mc, normalize_motion, [('oned_file', 'in_file')]),
+        ])
+        # fmt:on
+        return workflow
+
+    split_bold = pe.Node(
+        niu.Function(function=_split_series, output_names=["out_files"]),
+        name="split_bold",
+        mem_gb=DEFAULT_MEMORY_MIN_GB,
+    )
+    split_bold.inputs.nchunks = nchunks
+    concat_matrices = pe.Node(
+        niu.Function(function=_concat_rows, output_names=["out_file"]),
+        name="concat_matrices",
+        mem_gb=DEFAULT_MEMORY_MIN_GB,
+    )
+    concat_movpar = pe.Node(
+        niu.Function(function=_concat_rows, output_names=["out_file"]),
+        name="concat_movpar",
+        mem_gb=DEFAULT_MEMORY_MIN_GB,
+    )
+
+    # fmt:off
+    workflow.connect([
+        (inputnode, split_bold, [('bold_file', 'in_file')]),
+        (split_bold, mc, [('out_files', 'in_file')]),
+        (mc, concat_matrices, [('oned_matrix_save', 'in_files')]),
+        (mc, concat_movpar, [('oned_file', 'in_files')]),
+        (concat_matrices, mc2itk, [('out_file', 'in_file')]),
+        (concat_movpar, normalize_motion, [('out_file', 'in_file')]),
+    ])
+    # fmt:on
+
     return workflow
+
+
+def _split_series(in_file, nchunks):
+    """Split in_file into nchunks consecutive chunks of volumes (views if uncompressed)."""
+    import os
+    from nipype.utils.filemanip import split_filename
+    from fprodents.utils.images import split_series
+
+    _, base, _ = split_filename(in_file)
+    return split_series(in_file, nchunks, os.path.join(os.getcwd(), base))
+
+
+def _concat_rows(in_files):
+    """
+    Concatenate the rows of text files, in order (keeping comments of the first only).
+
+    >>> import os, tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> for i in range(2):
+    ...     with open(os.path.join(tmpdir, f"bold_chunk0{i}.1D"), "w") as fobj:
+    ...         _ = fobj.write(f"# header\\n{i} {i}\\n{i + 1} {i + 1}\\n")
+    >>> os.chdir(tmpdir)
+    >>> out_file = _concat_rows([f"bold_chunk0{i}.1D" for i in range(2)])
+    >>> os.path.basename(out_file)
+    'bold.1D'
+    >>> print(open(out_file).read().strip())
+    # header
+    0 0
+    1 1
+    1 1
+    2 2
+
+    """
+    import os
+    from pathlib import Path
+
+    out_file = os.path.join(os.getcwd(), Path(in_files[0]).name.replace("_chunk00", ""))
+    with open(out_file, "w") as fout:
+        for i, in_file in enumerate(in_files):
+            with open(in_file) as fin:
+                for line in fin:
+                    if i == 0 or not line.startswith("#"):
+                        fout.write(line)
+    return out_file
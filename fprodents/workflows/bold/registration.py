@@ -14,6 +14,7 @@ from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu, fsl, c3
 
 from ...interfaces import DerivativesDataSink
+from .stc import fuse_stc
 
 DEFAULT_MEMORY_MIN_GB = config.DEFAULT_MEMORY_MIN_GB
 LOGGER = config.loggers.workflow
@@ -179,6 +180,10 @@ def init_bold_t1_trans_wf(
     use_fieldwarp=False,
     use_compression=True,
     name="bold_t1_trans_wf",
+    resampling_engine="ants",
+    split_cache_dir=None,
+    xfm_cache_dir=None,
+    stc_metadata=None,
 ):
     """
     Co-register the reference BOLD image to T1w-space.
@@ -206,6 +211,20 @@ def init_bold_t1_trans_wf(
         Save registered BOLD series as ``.nii.gz``
     name : :obj:`str`
         Name of workflow (default: ``bold_reg_wf``)
+    resampling_engine : :obj:`str`
+        Either ``'ants'`` (one ``antsApplyTransforms`` call per volume) or
+        ``'native'`` (single-pass, in-process resampling of the 4D series).
+    split_cache_dir : :obj:`str`
+        Directory where split volumes are shared with other nodes of the run
+        (default: each splitter keeps its volumes within its working directory)
+    xfm_cache_dir : :obj:`str`
+        Directory where compiled transform chains are cached
+        (default: within the working directory of the compiling node)
+    stc_metadata : :obj:`dict`
+        BIDS metadata (``SliceTiming``, ``RepetitionTime``) to correct slice-timing
+        within the resampling (``'native'`` engine only, see
+        :py:func:`~fprodents.workflows.bold.stc.fuse_stc`).
+        If ``None`` (default), the series is resampled as given.
 
     Inputs
     ------
@@ -219,6 +238,8 @@ def init_bold_t1_trans_wf(
         Skull-stripped bias-corrected structural template image
     t1w_mask
         Mask of the skull-stripped template image
+    bold_file
+        BOLD series (4D), not motion corrected (``'native'`` engine only)
     bold_split
         Individual 3D BOLD volumes, not motion corrected
     hmc_xforms
@@ -227,6 +248,9 @@ def init_bold_t1_trans_wf(
         Affine transform from ``ref_bold_brain`` to T1 space (ITK format)
     fieldwarp
         a :abbr:`DFM (displacements field map)` in ITK format
+    skip_vols
+        Number of non-steady-state volumes, left out of slice-timing correction
+        (only with ``stc_metadata``)
 
     Outputs
     -------
@@ -241,7 +265,12 @@ def init_bold_t1_trans_wf(
     from niworkflows.interfaces.fixes import FixHeaderApplyTransforms as ApplyTransforms
     from niworkflows.interfaces.itk import MultiApplyTransforms
     from niworkflows.interfaces.nibabel import GenerateSamplingReference
-    from niworkflows.interfaces.nilearn import Merge
+
+    from ...interfaces.resampling import (
+        CompileTransforms,
+        MergeSeries,
+        ResampleSeries,
+    )
 
     workflow = Workflow(name=name)
     inputnode = pe.Node(
@@ -251,10 +280,12 @@ def init_bold_t1_trans_wf(
                 "ref_bold_brain",
                 "t1w_brain",
                 "t1w_mask",
+                "bold_file",
                 "bold_split",
                 "fieldwarp",
                 "hmc_xforms",
                 "bold2anat",
+                "skip_vols",
             ]
         ),
         name="inputnode",
@@ -285,21 +316,9 @@ def init_bold_t1_trans_wf(
     ])
     # fmt:on
 
-    bold_to_t1w_transform = pe.Node(
-        MultiApplyTransforms(
-            interpolation="LanczosWindowedSinc", float=True, copy_dtype=True
-        ),
-        name="bold_to_t1w_transform",
-        mem_gb=mem_gb * 3 * omp_nthreads,
-        n_procs=omp_nthreads,
-    )
-
-    # merge 3D volumes into 4D timeseries
-    merge = pe.Node(Merge(compress=use_compression), name="merge", mem_gb=mem_gb)
-
     if not multiecho:
-        # Merge transforms placing the head motion correction last
-        nforms = 2 + int(use_fieldwarp)
+        # Merge the fixed transforms, head motion correction is composed last
+        nforms = 1 + int(use_fieldwarp)
         merge_xforms = pe.Node(
             niu.Merge(nforms),
             name="merge_xforms",
@@ -313,22 +332,96 @@ def init_bold_t1_trans_wf(
             ])
             # fmt:on
 
+        compile_xforms = pe.Node(
+            CompileTransforms(itk_text=resampling_engine == "ants"),
+            name="compile_xforms",
+            mem_gb=1,
+        )
+        if xfm_cache_dir:
+            compile_xforms.inputs.cache_dir = xfm_cache_dir
+
+        # fmt:off
+        workflow.connect([
+            (inputnode, merge_xforms, [('bold2anat', 'in1')]),
+            (inputnode, compile_xforms, [('hmc_xforms', 'hmc_xforms')]),
+            (merge_xforms, compile_xforms, [('out', 'transforms')]),
+            (gen_ref, compile_xforms, [('out_file', 'reference_image')]),
+        ])
+        # fmt:on
+
+    if resampling_engine == "native":
+        bold_to_t1w_transform = pe.Node(
+            ResampleSeries(
+                interpolation="LanczosWindowedSinc",
+                float=True,
+                copy_dtype=True,
+                compress=use_compression,
+                num_threads=omp_nthreads,
+            ),
+            name="bold_to_t1w_transform",
+            mem_gb=mem_gb * 3,
+            n_procs=omp_nthreads,
+        )
+
+        if not multiecho:
+            # fmt:off
+            workflow.connect([
+                (compile_xforms, bold_to_t1w_transform, [
+                    ('fixed_transforms', 'transforms'),
+                    ('out_xforms', 'hmc_xforms')]),
+            ])
+            # fmt:on
+        else:
+            # fmt:off
+            workflow.connect([
+                (inputnode, bold_to_t1w_transform, [('bold2anat', 'transforms')]),
+            ])
+            # fmt:on
+
+        # fmt:off
+        workflow.connect([
+            (inputnode, bold_to_t1w_transform, [('bold_file', 'in_file'),
+                                                ('name_source', 'header_source')]),
+            (gen_ref, bold_to_t1w_transform, [('out_file', 'ref_file')]),
+            (bold_to_t1w_transform, outputnode, [('out_file', 'bold_t1')]),
+        ])
+        # fmt:on
+        if stc_metadata:
+            fuse_stc(workflow, inputnode, bold_to_t1w_transform, stc_metadata)
+        return workflow
+
+    bold_to_t1w_transform = pe.Node(
+        MultiApplyTransforms(
+            interpolation="LanczosWindowedSinc", float=True, copy_dtype=True
+        ),
+        name="bold_to_t1w_transform",
+        mem_gb=mem_gb * 3 * omp_nthreads,
+        n_procs=omp_nthreads,
+    )
+
+    # merge 3D volumes into 4D timeseries, streaming one volume at a time
+    merge = pe.Node(
+        MergeSeries(compress=use_compression, num_threads=omp_nthreads),
+        name="merge",
+        mem_gb=0.3,
+        n_procs=omp_nthreads,
+    )  # 256x256x256 * 64 / 8 ~ 150MB
+
+    if not multiecho:
         # fmt:off
         workflow.connect([
-            # merge transforms
-            (inputnode, merge_xforms, [
-                ('hmc_xforms', 'in%d' % nforms),
-                ('bold2anat', 'in1')]),
-            (merge_xforms, bold_to_t1w_transform, [('out', 'transforms')]),
+            (compile_xforms, bold_to_t1w_transform, [('out_transforms', 'transforms')]),
             (inputnode, bold_to_t1w_transform, [('bold_split', 'input_image')]),
         ])
         # fmt:on
     else:
-        from nipype.interfaces.fsl import Split as FSLSplit
+        from ...interfaces.cache import CachedSplit
 
         bold_split = pe.Node(
-            FSLSplit(dimension="t"), name="bold_split", mem_gb=DEFAULT_MEMORY_MIN_GB
+            CachedSplit(), name="bold_split", mem_gb=DEFAULT_MEMORY_MIN_GB
         )
+        if split_cache_dir:
+            bold_split.inputs.cache_dir = split_cache_dir
 
         # fmt:off
         workflow.connect([
@@ -13,9 +13,10 @@ from ...config import DEFAULT_MEMORY_MIN_GB
 
 from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
-from nipype.interfaces.fsl import Split as FSLSplit
 import nipype.interfaces.workbench as wb
 
+from .stc import fuse_stc
+
 
 def init_bold_std_trans_wf(
     mem_gb,
@@ -24,6 +25,9 @@ def init_bold_std_trans_wf(
     name="bold_std_trans_wf",
     use_compression=True,
     use_fieldwarp=False,
+    resampling_engine="ants",
+    xfm_cache_dir=None,
+    stc_metadata=None,
 ):
     """
     Sample fMRI into standard space with a single-step resampling of the original BOLD series.
@@ -73,16 +77,31 @@ def init_bold_std_trans_wf(
         Save registered BOLD series as ``.nii.gz``
     use_fieldwarp : :obj:`bool`
         Include SDC warp in single-shot transform from BOLD to MNI
+    resampling_engine : :obj:`str`
+        Either ``'ants'`` (one ``antsApplyTransforms`` call per volume) or
+        ``'native'`` (single-pass, in-process resampling of the 4D series).
+        The ``'native'`` engine resamples all standard-space targets in the
+        same pass over the BOLD series.
+    xfm_cache_dir : :obj:`str`
+        Directory where compiled transform chains are cached
+        (default: within the working directory of the compiling node)
+    stc_metadata : :obj:`dict`
+        BIDS metadata (``SliceTiming``, ``RepetitionTime``) to correct slice-timing
+        within the resampling (``'native'`` engine only, see
+        :py:func:`~fprodents.workflows.bold.stc.fuse_stc`).
+        If ``None`` (default), the series is resampled as given.
 
     Inputs
     ------
     anat2std_xfm
         List of anatomical-to-standard space transforms generated during
         spatial normalization.
+    bold_file
+        BOLD series (4D), not motion corrected (``'native'`` engine only)
     bold_mask
         Skull-stripping mask of reference image
     bold_split
-        Individual 3D volumes, not motion corrected
+        Individual 3D volumes, not motion corrected (``'ants'`` engine only)
     fieldwarp
         a :abbr:`DFM (displacements field map)` in ITK format
     hmc_xforms
@@ -92,6 +111,9 @@ def init_bold_std_trans_wf(
     name_source
         BOLD series NIfTI file
         Used to recover original information lost during processing
+    skip_vols
+        Number of non-steady-state volumes, left out of slice-timing correction
+        (only with ``stc_metadata``)
     templates
         List of templates that were applied as targets during
         spatial normalization.
@@ -114,9 +136,14 @@ def init_bold_std_trans_wf(
     from niworkflows.interfaces.itk import MultiApplyTransforms
     from niworkflows.interfaces.utility import KeySelect
     from niworkflows.interfaces.nibabel import GenerateSamplingReference
-    from niworkflows.interfaces.nilearn import Merge
     from niworkflows.utils.spaces import format_reference
 
+    from ...interfaces.resampling import (
+        CompileTransforms,
+        MergeSeries,
+        MultiResampleSeries,
+    )
+
     workflow = Workflow(name=name)
     output_references = spaces.cached.get_spaces(nonstandard=False, dim=(3,))
     std_vol_references = [
@@ -143,12 +170,14 @@ preprocessed BOLD runs*: {tpl}.
         niu.IdentityInterface(
             fields=[
                 "anat2std_xfm",
+                "bold_file",
                 "bold_mask",
                 "bold_split",
                 "fieldwarp",
                 "hmc_xforms",
                 "bold2anat",
                 "name_source",
+                "skip_vols",
                 "templates",
             ]
         ),
@@ -203,28 +232,24 @@ preprocessed BOLD runs*: {tpl}.
         mem_gb=DEFAULT_MEMORY_MIN_GB,
     )
 
-    nxforms = 3 + use_fieldwarp
+    # Fixed part of the chain, head-motion correction is composed by compile_xforms
     merge_xforms = pe.Node(
-        niu.Merge(nxforms),
+        niu.Merge(2 + use_fieldwarp),
         name="merge_xforms",
         run_without_submitting=True,
         mem_gb=DEFAULT_MEMORY_MIN_GB,
     )
-    workflow.connect([(inputnode, merge_xforms, [("hmc_xforms", "in%d" % nxforms)])])
-
-    if use_fieldwarp:
-        workflow.connect([(inputnode, merge_xforms, [("fieldwarp", "in3")])])
 
-    bold_to_std_transform = pe.Node(
-        MultiApplyTransforms(
-            interpolation="LanczosWindowedSinc", float=True, copy_dtype=True
-        ),
-        name="bold_to_std_transform",
-        mem_gb=mem_gb * 3 * omp_nthreads,
-        n_procs=omp_nthreads,
+    compile_xforms = pe.Node(
+        CompileTransforms(itk_text=resampling_engine == "ants"),
+        name="compile_xforms",
+        mem_gb=1,
     )
+    if xfm_cache_dir:
+        compile_xforms.inputs.cache_dir = xfm_cache_dir
 
-    merge = pe.Node(Merge(compress=use_compression), name="merge", mem_gb=mem_gb * 3)
+    if use_fieldwarp:
+        workflow.connect([(inputnode, merge_xforms, [("fieldwarp", "in3")])])
 
     # fmt:off
     workflow.connect([
@@ -234,27 +259,92 @@ preprocessed BOLD runs*: {tpl}.
                                  ('templates', 'keys')]),
         (inputnode, mask_std_tfm, [('bold_mask', 'input_image')]),
         (inputnode, ref_std_tfm, [('bold_mask', 'input_image')]),
-        (inputnode, gen_ref, [(('bold_split', _first), 'moving_image')]),
         (inputnode, merge_xforms, [
             (('bold2anat', _aslist), 'in2')]),
-        (inputnode, merge, [('name_source', 'header_source')]),
         (inputnode, mask_merge_tfms, [(('bold2anat', _aslist), 'in2')]),
-        (inputnode, bold_to_std_transform, [('bold_split', 'input_image')]),
         (split_target, select_std, [('space', 'key')]),
         (select_std, merge_xforms, [('anat2std_xfm', 'in1')]),
         (select_std, mask_merge_tfms, [('anat2std_xfm', 'in1')]),
         (split_target, gen_ref, [(('spec', _is_native), 'keep_native')]),
         (select_tpl, gen_ref, [('out', 'fixed_image')]),
-        (merge_xforms, bold_to_std_transform, [('out', 'transforms')]),
-        (gen_ref, bold_to_std_transform, [('out_file', 'reference_image')]),
         (gen_ref, mask_std_tfm, [('out_file', 'reference_image')]),
         (mask_merge_tfms, mask_std_tfm, [('out', 'transforms')]),
         (gen_ref, ref_std_tfm, [('out_file', 'reference_image')]),
         (mask_merge_tfms, ref_std_tfm, [('out', 'transforms')]),
-        (bold_to_std_transform, merge, [('out_files', 'in_files')]),
+        (inputnode, compile_xforms, [('hmc_xforms', 'hmc_xforms')]),
+        (merge_xforms, compile_xforms, [('out', 'transforms')]),
+        (gen_ref, compile_xforms, [('out_file', 'reference_image')]),
     ])
     # fmt:on
 
+    if resampling_engine == "native":
+        # Gather the sampling grid and compiled chain of every target, so that
+        # all of them are resampled within one pass over the BOLD series
+        join_targets = pe.JoinNode(
+            niu.IdentityInterface(fields=["ref_file", "transforms", "hmc_xforms"]),
+            name="join_targets",
+            joinsource="iterablesource",
+            run_without_submitting=True,
+        )
+
+        bold_to_std_transform = pe.Node(
+            MultiResampleSeries(
+                interpolation="LanczosWindowedSinc",
+                float=True,
+                copy_dtype=True,
+                compress=use_compression,
+                num_threads=omp_nthreads,
+            ),
+            name="bold_to_std_transform",
+            mem_gb=mem_gb * 3 * len(std_vol_references),
+            n_procs=omp_nthreads,
+        )
+        # fmt:off
+        workflow.connect([
+            (inputnode, gen_ref, [('bold_mask', 'moving_image')]),
+            (gen_ref, join_targets, [('out_file', 'ref_file')]),
+            (compile_xforms, join_targets, [
+                ('fixed_transforms', 'transforms'),
+                ('out_xforms', 'hmc_xforms')]),
+            (inputnode, bold_to_std_transform, [('bold_file', 'in_file'),
+                                                ('name_source', 'header_source')]),
+            (join_targets, bold_to_std_transform, [
+                ('ref_file', 'ref_file'),
+                ('transforms', 'transforms'),
+                ('hmc_xforms', 'hmc_xforms')]),
+        ])
+        # fmt:on
+        if stc_metadata:
+            fuse_stc(workflow, inputnode, bold_to_std_transform, stc_metadata)
+    else:
+        bold_to_std_transform = pe.Node(
+            MultiApplyTransforms(
+                interpolation="LanczosWindowedSinc", float=True, copy_dtype=True
+            ),
+            name="bold_to_std_transform",
+            mem_gb=mem_gb * 3 * omp_nthreads,
+            n_procs=omp_nthreads,
+        )
+
+        # Merge streams one volume at a time into the output
+        merge = pe.Node(
+            MergeSeries(compress=use_compression, num_threads=omp_nthreads),
+            name="merge",
+            mem_gb=0.3,
+            n_procs=omp_nthreads,
+        )  # 256x256x256 * 64 / 8 ~ 150MB
+
+        # fmt:off
+        workflow.connect([
+            (inputnode, gen_ref, [(('bold_split', _first), 'moving_image')]),
+            (inputnode, merge, [('name_source', 'header_source')]),
+            (inputnode, bold_to_std_transform, [('bold_split', 'input_image')]),
+            (compile_xforms, bold_to_std_transform, [('out_transforms', 'transforms')]),
+            (gen_ref, bold_to_std_transform, [('out_file', 'reference_image')]),
+            (bold_to_std_transform, merge, [('out_files', 'in_files')]),
+        ])
+        # fmt:on
+
     output_names = [
         "bold_mask_std",
         "bold_std",
@@ -271,7 +361,6 @@ preprocessed BOLD runs*: {tpl}.
         # Connecting outputnode
         (iterablesource, poutputnode, [
             (('std_target', format_reference), 'spatial_reference')]),
-        (merge, poutputnode, [('out_file', 'bold_std')]),
         (ref_std_tfm, poutputnode, [('output_image', 'bold_std_ref')]),
         (mask_std_tfm, poutputnode, [('output_image', 'bold_mask_std')]),
         (select_std, poutputnode, [('key', 'template')]),
@@ -279,16 +368,26 @@ preprocessed BOLD runs*: {tpl}.
     # fmt:on
 
     # Connect parametric outputs to a Join outputnode
+    joined_names = output_names
+    if resampling_engine == "native":
+        # All targets come out of the same node, already as a list
+        joined_names = [f for f in output_names if f != "bold_std"]
     outputnode = pe.JoinNode(
         niu.IdentityInterface(fields=output_names),
         name="outputnode",
         joinsource="iterablesource",
+        joinfield=joined_names,
     )
     # fmt:off
     workflow.connect([
-        (poutputnode, outputnode, [(f, f) for f in output_names]),
+        (poutputnode, outputnode, [(f, f) for f in joined_names]),
     ])
     # fmt:on
+
+    if resampling_engine == "native":
+        workflow.connect([(bold_to_std_transform, outputnode, [("out_files", "bold_std")])])
+    else:
+        workflow.connect([(merge, poutputnode, [("out_file", "bold_std")])])
     return workflow
 
 
@@ -300,6 +399,10 @@ def init_bold_preproc_trans_wf(
     use_fieldwarp=False,
     split_file=False,
     interpolation="LanczosWindowedSinc",
+    resampling_engine="ants",
+    split_cache_dir=None,
+    stc_metadata=None,
+    batch_echoes=False,
 ):
     """
     Resample in native (original) space.
@@ -333,6 +436,23 @@ def init_bold_preproc_trans_wf(
     interpolation : :obj:`str`
         Interpolation type to be used by ANTs' ``applyTransforms``
         (default ``'LanczosWindowedSinc'``)
+    resampling_engine : :obj:`str`
+        Either ``'ants'`` (one ``antsApplyTransforms`` call per volume) or
+        ``'native'`` (single-pass, in-process resampling of the 4D series).
+        With ``'native'``, ``split_file`` is ignored and ``bold_file`` must
+        be the 4D series.
+    split_cache_dir : :obj:`str`
+        Directory where split volumes are shared with other nodes of the run
+        (default: the splitter keeps its volumes within its working directory)
+    stc_metadata : :obj:`dict`
+        BIDS metadata (``SliceTiming``, ``RepetitionTime``) to correct slice-timing
+        within the resampling (``'native'`` engine only, see
+        :py:func:`~fprodents.workflows.bold.stc.fuse_stc`).
+        If ``None`` (default), the series is resampled as given.
+    batch_echoes : :obj:`bool`
+        Resample all the echoes of a multi-echo run in one pass (``'native'``
+        engine only, see :py:class:`~fprodents.interfaces.resampling.ResampleEchoes`):
+        ``bold_file`` is the list of echoes, and ``bold`` the list of resampled echoes.
 
     Inputs
     ------
@@ -349,6 +469,9 @@ def init_bold_preproc_trans_wf(
         List of affine transforms aligning each volume to ``ref_image`` in ITK format
     fieldwarp
         a :abbr:`DFM (displacements field map)` in ITK format
+    skip_vols
+        Number of non-steady-state volumes, left out of slice-timing correction
+        (only with ``stc_metadata``)
 
     Outputs
     -------
@@ -359,7 +482,8 @@ def init_bold_preproc_trans_wf(
     from bids.utils import listify
     from niworkflows.engine.workflows import LiterateWorkflow as Workflow
     from niworkflows.interfaces.itk import MultiApplyTransforms
-    from niworkflows.interfaces.nilearn import Merge
+
+    from ...interfaces.resampling import MergeSeries, ResampleEchoes, ResampleSeries
 
     workflow = Workflow(name=name)
     workflow.__desc__ = """\
@@ -379,13 +503,48 @@ the transforms to correct for head-motion"""
 
     inputnode = pe.Node(
         niu.IdentityInterface(
-            fields=["name_source", "bold_file", "bold_mask", "bold_ref", "hmc_xforms", "fieldwarp"]
+            fields=[
+                "name_source",
+                "bold_file",
+                "bold_mask",
+                "bold_ref",
+                "hmc_xforms",
+                "fieldwarp",
+                "skip_vols",
+            ]
         ),
         name="inputnode",
     )
 
     outputnode = pe.Node(niu.IdentityInterface(fields=["bold"]), name="outputnode")
 
+    if resampling_engine == "native":
+        bold_transform = pe.Node(
+            (ResampleEchoes if batch_echoes else ResampleSeries)(
+                interpolation=interpolation,
+                float=True,
+                copy_dtype=True,
+                compress=use_compression,
+                num_threads=omp_nthreads,
+            ),
+            name="bold_transform",
+            mem_gb=mem_gb * 3,
+            n_procs=omp_nthreads,
+        )
+        # fmt:off
+        workflow.connect([
+            (inputnode, bold_transform, [('bold_file', 'in_file'),
+                                         ('hmc_xforms', 'hmc_xforms'),
+                                         ('bold_ref', 'ref_file'),
+                                         ('name_source', 'header_source')]),
+            (bold_transform, outputnode, [
+                ('out_files' if batch_echoes else 'out_file', 'bold')]),
+        ])
+        # fmt:on
+        if stc_metadata:
+            fuse_stc(workflow, inputnode, bold_transform, stc_metadata)
+        return workflow
+
     bold_transform = pe.Node(
         MultiApplyTransforms(interpolation=interpolation, float=True, copy_dtype=True),
         name="bold_transform",
@@ -393,7 +552,13 @@ the transforms to correct for head-motion"""
         n_procs=omp_nthreads,
     )
 
-    merge = pe.Node(Merge(compress=use_compression), name="merge", mem_gb=mem_gb * 3)
+    # Merge streams one volume at a time into the output
+    merge = pe.Node(
+        MergeSeries(compress=use_compression, num_threads=omp_nthreads),
+        name="merge",
+        mem_gb=0.3,
+        n_procs=omp_nthreads,
+    )  # 256x256x256 * 64 / 8 ~ 150MB
 
     # fmt:off
     workflow.connect([
@@ -408,9 +573,11 @@ the transforms to correct for head-motion"""
 
     # Input file is not splitted
     if split_file:
-        bold_split = pe.Node(
-            FSLSplit(dimension="t"), name="bold_split", mem_gb=mem_gb * 3
-        )
+        from ...interfaces.cache import CachedSplit
+
+        bold_split = pe.Node(CachedSplit(), name="bold_split", mem_gb=mem_gb * 3)
+        if split_cache_dir:
+            bold_split.inputs.cache_dir = split_cache_dir
         # fmt:off
         workflow.connect([
             (inputnode, bold_split, [('bold_file', 'in_file')]),
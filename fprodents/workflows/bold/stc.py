@@ -5,6 +5,7 @@ Slice-Timing Correction (STC) of BOLD images
 ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
 
 .. autofunction:: init_bold_stc_wf
+.. autofunction:: fuse_stc
 
 """
 from nipype.pipeline import engine as pe
@@ -16,7 +17,7 @@ from ... import config
 LOGGER = config.loggers.workflow
 
 
-def init_bold_stc_wf(metadata, name="bold_stc_wf"):
+def init_bold_stc_wf(metadata, stc_engine="afni", omp_nthreads=1, name="bold_stc_wf"):
     """
     Create a workflow for :abbr:`STC (slice-timing correction)`.
 
@@ -38,6 +39,12 @@ def init_bold_stc_wf(metadata, name="bold_stc_wf"):
     ----------
     metadata : :obj:`dict`
         BIDS metadata for BOLD file
+    stc_engine : :obj:`str`
+        Either ``'afni'`` (``3dTshift``, and the header restored by ``CopyXForm``)
+        or ``'native'`` (in-process Fourier interpolation, see
+        :py:class:`~fprodents.interfaces.stc.SliceTimingCorrection`).
+    omp_nthreads : :obj:`int`
+        Maximum number of threads an individual process may use
     name : :obj:`str`
         Name of workflow (default: ``bold_stc_wf``)
 
@@ -58,12 +65,6 @@ def init_bold_stc_wf(metadata, name="bold_stc_wf"):
     from niworkflows.interfaces.header import CopyXForm
 
     workflow = Workflow(name=name)
-    workflow.__desc__ = """\
-BOLD runs were slice-time corrected using `3dTshift` from
-AFNI {afni_ver} [@afni, RRID:SCR_005927].
-""".format(
-        afni_ver="".join(["%02d" % v for v in afni.Info().version() or []])
-    )
     inputnode = pe.Node(
         niu.IdentityInterface(fields=["bold_file", "skip_vols"]), name="inputnode"
     )
@@ -71,6 +72,39 @@ AFNI {afni_ver} [@afni, RRID:SCR_005927].
 
     LOGGER.log(25, "Slice-timing correction will be included.")
 
+    if stc_engine == "native":
+        from ...interfaces.stc import SliceTimingCorrection
+
+        workflow.__desc__ = """\
+BOLD runs were slice-time corrected with a Fourier interpolation of the time
+series of each slice (after linear detrending).
+"""
+        slice_timing_correction = pe.Node(
+            SliceTimingCorrection(
+                repetition_time=metadata["RepetitionTime"],
+                slice_timing=metadata["SliceTiming"],
+                slice_encoding_direction=metadata.get("SliceEncodingDirection", "k"),
+                num_threads=omp_nthreads,
+            ),
+            name="slice_timing_correction",
+            n_procs=omp_nthreads,
+        )
+        # fmt:off
+        workflow.connect([
+            (inputnode, slice_timing_correction, [('bold_file', 'in_file'),
+                                                  ('skip_vols', 'ignore')]),
+            (slice_timing_correction, outputnode, [('out_file', 'stc_file')]),
+        ])
+        # fmt:on
+        return workflow
+
+    workflow.__desc__ = """\
+BOLD runs were slice-time corrected using `3dTshift` from
+AFNI {afni_ver} [@afni, RRID:SCR_005927].
+""".format(
+        afni_ver="".join(["%02d" % v for v in afni.Info().version() or []])
+    )
+
     # It would be good to fingerprint memory use of afni.TShift
     slice_timing_correction = pe.Node(
         afni.TShift(
@@ -95,3 +129,24 @@ AFNI {afni_ver} [@afni, RRID:SCR_005927].
     # fmt:on
 
     return workflow
+
+
+def fuse_stc(workflow, inputnode, resampler, metadata):
+    """
+    Correct slice-timing within a native resampling node, instead of with ``3dTshift``.
+
+    Sets the slice-timing inputs of ``resampler`` (a
+    :py:class:`~fprodents.interfaces.resampling.ResampleSeries` or
+    :py:class:`~fprodents.interfaces.resampling.MultiResampleSeries` node) from
+    the BIDS ``metadata``, and connects the ``skip_vols`` field of ``inputnode``,
+    so that non-steady-state volumes are left out of the correction.
+    Each slice is interpolated in time with a cubic polynomial (see
+    :py:func:`~fprodents.interfaces.resampling.slice_timing_weights`).
+
+    """
+    resampler.inputs.slice_timing = metadata["SliceTiming"]
+    resampler.inputs.repetition_time = metadata["RepetitionTime"]
+    resampler.inputs.slice_encoding_direction = metadata.get(
+        "SliceEncodingDirection", "k"
+    )
+    workflow.connect([(inputnode, resampler, [("skip_vols", "stc_ignore")])])
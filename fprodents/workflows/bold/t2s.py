@@ -10,7 +10,7 @@ Generate T2* map from multi-echo BOLD images
 from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
 
-from ...interfaces import T2SMap
+from ...interfaces import FitT2SMap, T2SMap
 from ... import config
 
 
@@ -18,7 +18,9 @@ LOGGER = config.loggers.workflow
 
 
 # pylint: disable=R0914
-def init_bold_t2s_wf(echo_times, mem_gb, omp_nthreads, name="bold_t2s_wf"):
+def init_bold_t2s_wf(
+    echo_times, mem_gb, omp_nthreads, t2s_engine="tedana", name="bold_t2s_wf"
+):
     """
     Combine multiple echos of :abbr:`ME-EPI (multi-echo echo-planar imaging)`.
 
@@ -41,6 +43,9 @@ def init_bold_t2s_wf(echo_times, mem_gb, omp_nthreads, name="bold_t2s_wf"):
         Size of BOLD file in GB
     omp_nthreads : :obj:`int`
         Maximum number of threads an individual process may use
+    t2s_engine : :obj:`str`
+        Either ``'tedana'`` (``t2smap``) or ``'native'`` (in-process fit, see
+        :py:class:`~fprodents.interfaces.multiecho.FitT2SMap`).
     name : :obj:`str`
         Name of workflow (default: ``bold_t2s_wf``)
 
@@ -75,7 +80,15 @@ The optimally combined time series was carried forward as the *preprocessed BOLD
 
     LOGGER.log(25, "Generating T2* map and optimally combined ME-EPI time series.")
 
-    t2smap_node = pe.Node(T2SMap(echo_times=list(echo_times)), name="t2smap_node")
+    if t2s_engine == "native":
+        t2smap_node = pe.Node(
+            FitT2SMap(echo_times=list(echo_times), num_threads=omp_nthreads),
+            name="t2smap_node",
+            mem_gb=mem_gb,
+            n_procs=omp_nthreads,
+        )
+    else:
+        t2smap_node = pe.Node(T2SMap(echo_times=list(echo_times)), name="t2smap_node")
 
     # fmt:off
     workflow.connect([